@@ -0,0 +1,225 @@
+# Script:   batch_modules.py
+# Desc:     Batch mode analysing a directory or glob of captures in a
+#           pool of worker processes, with per capture reports and one
+#           merged aggregate report
+# Author:   Jacob Connell Nov 2019
+# Note: Run setup.py before use!
+
+import contextlib
+import glob
+import json
+import os
+from parse_modules import ANALYSERS, analyser_names
+from cache_modules import DEFAULT_CACHE_SIZE, AnalysisCache, capture_key
+from core_modules import create_directory, save
+from export_modules import export_analysers, write_manifest
+from metrics_modules import Metrics
+from reader_modules import open_capture
+from report_modules import DEFAULT_REPORT_WORKERS, DEFAULT_TOP, render_reports
+from shard_modules import analyse
+
+CAPTURE_EXTENSIONS = ('.pcap', '.pcapng', '.cap')
+DEFAULT_BATCH_JOBS = min(os.cpu_count() or 1, 4)
+LEDGER_NAME = 'Batch Ledger.json'
+# Directories of the batch that are not capture reports
+STATE_DIR = 'States'
+AGGREGATE_DIR = 'Aggregate'
+
+
+def find_captures(source):
+    '''Returns the capture files in a directory, or matching a glob
+    pattern, sorted by path'''
+    if os.path.isdir(source):
+        paths = [entry.path for entry in os.scandir(source)
+                 if entry.is_file() and
+                 entry.name.lower().endswith(CAPTURE_EXTENSIONS)]
+    else:
+        paths = [path for path in glob.glob(source) if os.path.isfile(path)]
+    return sorted(paths)
+
+
+def first_timestamp(pcapfile):
+    '''Returns the time of the first record of a capture, or None when
+    it has none'''
+    with open_capture(pcapfile) as capture:
+        for ts, buf in capture.records():
+            return ts
+    return None
+
+
+def report_folders(captures):
+    '''Names the report directory of each capture after its file,
+    numbering repeated names'''
+    folders = {}
+    used = {STATE_DIR, AGGREGATE_DIR}
+    for path in captures:
+        stem = os.path.splitext(os.path.basename(path))[0]
+        name, number = stem, 1
+        while name in used:
+            number += 1
+            name = f'{stem}-{number}'
+        used.add(name)
+        folders[path] = name
+    return folders
+
+
+def load_ledger(batch_path):
+    '''Returns the ledger of processed captures keyed by capture key'''
+    try:
+        with open(os.path.join(batch_path, LEDGER_NAME)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def save_ledger(batch_path, ledger):
+    '''Saves the ledger, replacing the old one in one step so an
+    interrupted batch keeps what it finished'''
+    path = os.path.join(batch_path, LEDGER_NAME)
+    with open(path + '.tmp', 'w') as f:
+        json.dump(ledger, f, indent=1)
+    os.replace(path + '.tmp', path)
+
+
+def process_capture(pcapfile, key, file_path, names, options=None,
+                    columnar=False, packet_filter=None, state_dir=STATE_DIR,
+                    cache_size=DEFAULT_CACHE_SIZE, top=DEFAULT_TOP,
+                    report_workers=1, export=()):
+    '''Analyses one capture in a worker process, stores the analyser
+    states for the aggregate and saves its reports. The console output
+    is saved to report.log in the report directory. Returns the ledger
+    entry of the capture'''
+    create_directory(file_path)
+    with open(os.path.join(file_path, 'report.log'), 'w') as log, \
+            contextlib.redirect_stdout(log):
+        analysers, error_count, columns, metrics = analyse(
+            pcapfile, names, 1, options, columnar,
+            packet_filter=packet_filter, metrics=Metrics())
+        # Stored before reporting, which leaves tables on the analysers
+        AnalysisCache(state_dir, cache_size).store(
+            key, pcapfile, analysers, error_count=error_count,
+            options=options)
+        print(f'[!] {error_count} packets could not be decoded')
+        metrics.output(file_path)
+        failed = render_reports(analysers, names, file_path, report_workers,
+                                top)
+        tables = []
+        if export:
+            tables = export_analysers(analysers, list(analysers), file_path,
+                                      export)
+        write_manifest(file_path, pcapfile, names, error_count, tables)
+    return {'capture': os.path.abspath(pcapfile), 'reports': file_path,
+            'first_ts': first_timestamp(pcapfile), 'packets': metrics.packets,
+            'undecoded_packets': error_count, 'failed_reports': failed}
+
+
+def merge_states(entries, cache, names, options=None, columnar=False,
+                 packet_filter=None):
+    '''Merges the stored analyser states of the (key, ledger entry)
+    pairs in order of their first packet. A capture whose states are
+    no longer stored is analysed again. Returns the merged analysers,
+    the undecodable packet count and the captures in merge order'''
+    needed = {name: ANALYSERS[name] for name in analyser_names(names)}
+    merged = None
+    error_count = 0
+    order = sorted(entries, key=lambda item: (item[1]['first_ts'] is None,
+                                              item[1]['first_ts'] or 0,
+                                              item[1]['capture']))
+    for key, entry in order:
+        analysers, columns, errors = cache.load(key, needed, options)
+        if len(analysers) < len(needed):
+            print(f'[!] States of {entry["capture"]} not stored, '
+                  'analysing it again...')
+            analysers, errors, columns, metrics = analyse(
+                entry['capture'], names, 1, options, columnar,
+                packet_filter=packet_filter)
+        error_count += errors
+        if merged is None:
+            merged = {name: analysers[name] for name in needed}
+        else:
+            for name, analyser in merged.items():
+                analyser.merge(analysers[name])
+    return merged, error_count, [entry for key, entry in order]
+
+
+def run_batch(source, batch_path, names, jobs=DEFAULT_BATCH_JOBS,
+              options=None, columnar=False, packet_filter=None,
+              cache_size=DEFAULT_CACHE_SIZE, top=DEFAULT_TOP,
+              report_workers=DEFAULT_REPORT_WORKERS, export=()):
+    '''Analyses every capture of a directory or glob with up to jobs
+    worker processes, saving the reports of each capture in its own
+    directory of batch_path. Captures listed in the ledger whose
+    analyser states are stored are skipped, so a batch can be run again
+    as new captures arrive. The stored states of all the captures are
+    then merged, in order of their first packet, into the Aggregate
+    report without reading the packets again. Returns the number of
+    captures that could not be analysed or not all of whose reports
+    could be saved, counting the Aggregate as one more'''
+    captures = find_captures(source)
+    if not captures:
+        raise FileNotFoundError(f'No captures found in {source}')
+    os.makedirs(batch_path, exist_ok=True)
+    ledger = load_ledger(batch_path)
+    state_dir = os.path.join(batch_path, STATE_DIR)
+    cache = AnalysisCache(state_dir, cache_size)
+    needed = {name: ANALYSERS[name] for name in analyser_names(names)}
+    folders = report_folders(captures)
+    keys = {path: capture_key(path, packet_filter=packet_filter)
+            for path in captures}
+    todo = [path for path in captures if keys[path] not in ledger or
+            not cache.has(keys[path], needed, options)]
+    print(f'[!] Found {len(captures)} captures, '
+          f'{len(captures) - len(todo)} already processed')
+    failed = 0
+    if todo:
+        print(f'[!] Analysing {len(todo)} captures with {jobs} jobs...')
+        from concurrent.futures import ProcessPoolExecutor, as_completed
+        with ProcessPoolExecutor(max_workers=max(jobs, 1)) as pool:
+            futures = {pool.submit(process_capture, path, keys[path],
+                                   os.path.join(batch_path, folders[path]),
+                                   names, options, columnar, packet_filter,
+                                   state_dir, cache_size, top, 1, export): path
+                       for path in todo}
+            for done, future in enumerate(as_completed(futures), 1):
+                path = futures[future]
+                try:
+                    entry = future.result()
+                except Exception as error:
+                    failed += 1
+                    print(f'[!] Error - {path} not analysed: {error}')
+                    continue
+                ledger[keys[path]] = entry
+                save_ledger(batch_path, ledger)
+                print(f'[!] {done}/{len(todo)} Analysed {path} '
+                      f'({entry["packets"]} packets)')
+                if entry['failed_reports']:
+                    failed += 1
+                    print(f'[!] Error - {entry["failed_reports"]} reports of '
+                          f'{path} not saved')
+    entries = [(keys[path], ledger[keys[path]]) for path in captures
+               if keys[path] in ledger]
+    if not entries:
+        return failed
+    print(f'\n[!] Merging {len(entries)} captures in time order...')
+    analysers, error_count, order = merge_states(
+        entries, cache, names, options, columnar, packet_filter)
+    file_path = os.path.join(batch_path, AGGREGATE_DIR)
+    create_directory(file_path)
+    save([{'capture': entry['capture'], 'first_ts': entry['first_ts'],
+           'packets': entry['packets']} for entry in order],
+         'Captures', file_path)
+    print(f'[!] {error_count} packets could not be decoded')
+    if render_reports(analysers, names, file_path, report_workers, top):
+        failed += 1
+    tables = []
+    if export:
+        print(f'\n[!] Exporting tables as {", ".join(export)}...')
+        tables = export_analysers(analysers, list(analysers), file_path,
+                                  export)
+    write_manifest(file_path, source, names, error_count, tables)
+    return failed
+
+
+# Boiler Plate
+if __name__ == '__main__':
+    print("[!]Nothing to run here.")
@@ -0,0 +1,401 @@
+# Script:   benchmark.py
+# Desc:     Benchmarks the analysers on deterministic synthetic captures
+# Author:   Jacob Connell Nov 2019
+# Note: Run setup.py before use!
+
+import argparse
+import datetime
+import json
+import os
+import platform
+import random
+import socket
+import statistics
+import subprocess
+import sys
+import time
+import dpkt
+from parse_modules import ANALYSERS, analyser_names
+from reader_modules import open_capture
+from shard_modules import analyse
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+GENERATOR_VERSION = 1
+BASE_TS = 1573000000.0
+DEFAULT_SIZES = (10000, 100000)
+DEFAULT_DATA_DIR = 'benchmark_data'
+HTTP_IMAGES = ('/img/cat.gif', '/img/dog.jpeg', '/img/logo.png',
+               '/img/photo.jpg', '/index.html', '/style.css', '/app.js')
+EMAILS = ('alice@example.com', 'bob@example.org', 'carol@mail.example.net',
+          'dave@example.co.uk')
+# Entry points timed by --startup and the dependencies they should only
+# load when a report needs them
+STARTUP_MODULES = ('pcap_analyser', 'shard_modules', 'batch_modules',
+                   'live_modules', 'parse_modules')
+HEAVY_MODULES = ('matplotlib', 'networkx', 'numpy', 'geoip2', 'pyarrow',
+                 'dpkt', 'tkinter')
+STARTUP_REPEAT = 10
+
+
+class CaptureGenerator:
+    '''Writes a synthetic Ethernet/IPv4 capture. The same seed always
+    gives the same file. Traffic is a mix of HTTP image requests split
+    across segments, SMTP sessions, UDP, IGMP, ICMP, port scans over
+    many hosts and ARP. Some packets are written with earlier
+    timestamps and some TCP segments are swapped so the capture is
+    out of order'''
+    def __init__(self, seed=0):
+        self.random = random.Random(seed)
+        self.ts = BASE_TS
+        self.seqs = {}
+        self.clients = [f'10.0.{i // 250}.{i % 250 + 1}' for i in range(200)]
+        self.servers = [f'93.184.{i}.{i * 7 % 250 + 1}' for i in range(40)] + \
+            ['8.8.8.8', '1.1.1.1']
+
+    def frame(self, src, dst, p, l4):
+        '''Returns an Ethernet frame carrying l4 from src to dst'''
+        ip = dpkt.ip.IP(src=socket.inet_aton(src), dst=socket.inet_aton(dst),
+                        p=p, data=l4)
+        ip.len = len(ip)
+        return bytes(dpkt.ethernet.Ethernet(
+            src=b'\x02\x00\x00\x00\x00\x01', dst=b'\x02\x00\x00\x00\x00\x02',
+            type=dpkt.ethernet.ETH_TYPE_IP, data=ip))
+
+    def tcp(self, src, dst, sport, dport, payload=b'',
+            flags=dpkt.tcp.TH_ACK | dpkt.tcp.TH_PUSH):
+        '''Returns a TCP segment frame, advancing the stream sequence'''
+        key = (src, sport, dst, dport)
+        seq = self.seqs.get(key, 1000)
+        self.seqs[key] = seq + len(payload) + (1 if flags & dpkt.tcp.TH_SYN
+                                               else 0)
+        return self.frame(src, dst, dpkt.ip.IP_PROTO_TCP, dpkt.tcp.TCP(
+            sport=sport, dport=dport, seq=seq, flags=flags, data=payload))
+
+    def http_image(self):
+        '''A GET request split over two segments, sometimes swapped'''
+        client = self.random.choice(self.clients)
+        server = self.random.choice(self.servers)
+        sport = self.random.randint(40000, 40999)
+        uri = self.random.choice(HTTP_IMAGES)
+        request = (f'GET {uri}?v={self.random.randint(0, 99)} HTTP/1.1\r\n'
+                   f'Host: www{self.random.randint(1, 9)}.example.com\r\n'
+                   'User-Agent: benchmark\r\n\r\n').encode()
+        cut = self.random.randint(1, len(request) - 1)
+        frames = [self.tcp(client, server, sport, 80, request[:cut]),
+                  self.tcp(client, server, sport, 80, request[cut:])]
+        if self.random.random() < 0.05:
+            frames.reverse()
+        frames.append(self.tcp(server, client, 80, sport,
+                               b'HTTP/1.1 200 OK\r\nContent-Length: 0\r\n\r\n'))
+        return frames
+
+    def smtp_session(self):
+        '''An SMTP envelope, one command per segment'''
+        client = self.random.choice(self.clients)
+        server = self.random.choice(self.servers)
+        sport = self.random.randint(50000, 50999)
+        commands = [b'HELO bench\r\n',
+                    f'MAIL FROM: <{self.random.choice(EMAILS)}>\r\n'.encode(),
+                    f'RCPT TO: <{self.random.choice(EMAILS)}>\r\n'.encode(),
+                    b'QUIT\r\n']
+        return [self.tcp(client, server, sport, 25, command)
+                for command in commands]
+
+    def udp(self):
+        client = self.random.choice(self.clients)
+        server = self.random.choice(self.servers)
+        udp = dpkt.udp.UDP(sport=self.random.randint(1024, 65535), dport=53,
+                           data=b'q' * self.random.randint(0, 64))
+        udp.ulen = len(udp)
+        return [self.frame(client, server, dpkt.ip.IP_PROTO_UDP, udp)]
+
+    def igmp(self):
+        return [self.frame(self.random.choice(self.clients), '239.1.1.1',
+                           dpkt.ip.IP_PROTO_IGMP, dpkt.igmp.IGMP(
+                               type=0x16, group=socket.inet_aton('239.1.1.1')))]
+
+    def icmp(self):
+        return [self.frame(self.random.choice(self.clients),
+                           self.random.choice(self.servers),
+                           dpkt.ip.IP_PROTO_ICMP, dpkt.icmp.ICMP(
+                               type=8, data=dpkt.icmp.ICMP.Echo(id=1, seq=1)))]
+
+    def scan(self):
+        '''SYNs from one scanner to many hosts and ports'''
+        return [self.tcp('10.9.9.9', f'10.{self.random.randint(100, 200)}.'
+                                     f'{self.random.randint(0, 255)}.'
+                                     f'{self.random.randint(1, 254)}',
+                         self.random.randint(30000, 30999),
+                         self.random.randint(1, 1024), flags=dpkt.tcp.TH_SYN)
+                for i in range(8)]
+
+    def arp(self):
+        return [bytes(dpkt.ethernet.Ethernet(
+            src=b'\x02\x00\x00\x00\x00\x01', dst=b'\xff' * 6,
+            type=dpkt.ethernet.ETH_TYPE_ARP, data=dpkt.arp.ARP()))]
+
+    def write(self, path, packets):
+        '''Writes a capture of about the given number of packets'''
+        scenarios = (self.http_image, self.smtp_session, self.udp, self.igmp,
+                     self.icmp, self.scan, self.arp)
+        weights = (30, 15, 30, 5, 5, 3, 1)
+        written = 0
+        with open(path, 'wb') as f:
+            writer = dpkt.pcap.Writer(f)
+            while written < packets:
+                scenario = self.random.choices(scenarios, weights)[0]
+                for frame in scenario():
+                    self.ts += self.random.expovariate(200)
+                    ts = self.ts
+                    if self.random.random() < 0.02:
+                        ts -= self.random.random()
+                    writer.writepkt(frame, ts)
+                    written += 1
+        return written
+
+
+def capture_path(data_dir, packets, seed):
+    '''Returns the path of a generated capture, generating it once'''
+    os.makedirs(data_dir, exist_ok=True)
+    path = os.path.join(data_dir,
+                        f'synthetic-v{GENERATOR_VERSION}-{packets}-{seed}.pcap')
+    if not os.path.exists(path):
+        print(f'[!] Generating {path}...')
+        CaptureGenerator(seed).write(path + '.tmp', packets)
+        os.replace(path + '.tmp', path)
+    return path
+
+
+def peak_rss_mb():
+    '''Returns the peak resident set size of this process in MB'''
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports KB and macOS bytes
+    return round(peak / (1 << 20 if sys.platform == 'darwin' else 1 << 10), 1)
+
+
+def time_analysers(names):
+    '''Wraps the per packet and per message methods of the analyser
+    classes to add up the time spent in each. Returns the totals'''
+    totals = {}
+    for name in names:
+        cls = ANALYSERS[name]
+        totals[name] = 0.0
+        for method in ('add_packet', 'add_message', 'load_table'):
+            original = getattr(cls, method, None)
+            if original is None:
+                continue
+
+            def timed(self, *args, _original=original, _name=name):
+                start = time.perf_counter()
+                try:
+                    return _original(self, *args)
+                finally:
+                    totals[_name] += time.perf_counter() - start
+            setattr(cls, method, timed)
+    return totals
+
+
+def run_one(path, names, workers=1, columnar=False):
+    '''Analyses the capture in this process and returns the timings.
+    Run in a fresh process so the peak RSS belongs to this run'''
+    with open_capture(path) as capture:
+        packets = sum(1 for record in capture.records())
+    names = analyser_names(names)
+    totals = time_analysers(names) if workers == 1 else {}
+    baseline = peak_rss_mb()
+    start = time.perf_counter()
+    analysers, error_count, columns, metrics = analyse(path, names, workers,
+                                              columnar=columnar)
+    seconds = time.perf_counter() - start
+    return {'packets': packets, 'undecoded': error_count,
+            'seconds': round(seconds, 4),
+            'packets_per_sec': round(packets / seconds),
+            'baseline_rss_mb': baseline, 'peak_rss_mb': peak_rss_mb(),
+            'analyser_seconds': {name: round(total, 4)
+                                 for name, total in totals.items()}}
+
+
+def measure(path, names, workers=1, columnar=False):
+    '''Runs run_one in a child process and returns its result'''
+    command = [sys.executable, os.path.abspath(__file__), '--run-one', path,
+               '--workers', str(workers)] + (['--columnar'] if columnar else [])
+    command += ['--analysers'] + list(names)
+    output = subprocess.run(command, check=True, capture_output=True,
+                            text=True, cwd=os.path.dirname(os.path.abspath(
+                                __file__))).stdout
+    return json.loads(output.splitlines()[-1])
+
+
+def time_import(module):
+    '''Imports module in a fresh interpreter. Returns the seconds the
+    import took, the seconds the whole process took and the heavy
+    dependencies it loaded'''
+    code = ('import sys, time\n'
+            'start = time.perf_counter()\n'
+            f'import {module}\n'
+            'print(time.perf_counter() - start)\n'
+            f'print(",".join(name for name in {HEAVY_MODULES!r} '
+            'if name in sys.modules))')
+    start = time.perf_counter()
+    output = subprocess.run([sys.executable, '-c', code], check=True,
+                            capture_output=True, text=True,
+                            cwd=os.path.dirname(os.path.abspath(__file__))
+                            ).stdout
+    process_seconds = time.perf_counter() - start
+    lines = output.splitlines()
+    return float(lines[-2]), process_seconds, \
+        [name for name in lines[-1].split(',') if name]
+
+
+def measure_startup(modules=STARTUP_MODULES, repeat=STARTUP_REPEAT):
+    '''Times the import of each entry point over repeat fresh processes
+    and returns the fastest and median times in milliseconds'''
+    results = []
+    for module in modules:
+        runs = [time_import(module) for i in range(max(repeat, 1))]
+        imports = [run[0] * 1000 for run in runs]
+        processes = [run[1] * 1000 for run in runs]
+        results.append({'module': module, 'repeat': len(runs),
+                        'import_ms_min': round(min(imports), 1),
+                        'import_ms_median': round(statistics.median(imports), 1),
+                        'process_ms_min': round(min(processes), 1),
+                        'process_ms_median': round(
+                            statistics.median(processes), 1),
+                        'loaded': runs[-1][2]})
+        print(f'[!] {module:>14}: import {results[-1]["import_ms_min"]:>7} ms '
+              f'min, {results[-1]["import_ms_median"]:>7} ms median, process '
+              f'{results[-1]["process_ms_median"]:>7} ms median, loads '
+              f'{", ".join(results[-1]["loaded"]) or "nothing heavy"}')
+    return results
+
+
+def git_commit():
+    '''Returns the current commit, or None outside a git checkout'''
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'],
+                              capture_output=True, text=True, check=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))
+                              ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results, baseline_file, threshold=0.1):
+    '''Prints the change in throughput against an earlier results
+    file and returns the number of runs slower than threshold'''
+    with open(baseline_file) as f:
+        old = {(r['packets_target'], r['run'], tuple(r['analysers'])): r
+               for r in json.load(f)['results']}
+    regressions = 0
+    print(f'\n[!] Compared with {baseline_file}:')
+    for result in results:
+        before = old.get((result['packets_target'], result['run'],
+                          tuple(result['analysers'])))
+        if before is None:
+            continue
+        change = result['packets_per_sec'] / before['packets_per_sec'] - 1
+        flag = ''
+        if change < -threshold:
+            regressions += 1
+            flag = '  <-- slower'
+        print(f'    {result["run"]:>10} {result["packets_target"]:>9}: '
+              f'{change:+.1%}{flag}')
+    return regressions
+
+
+def main(argv=None):
+    '''Benchmarks every analyser alone and the full pipeline, or the
+    import time of the entry points with --startup'''
+    parser = argparse.ArgumentParser(description="Benchmarks PCAP_Analyser")
+    parser.add_argument('--sizes', type=int, nargs='+', default=DEFAULT_SIZES,
+                        metavar='PACKETS', help="Capture sizes to generate")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--data-dir', default=DEFAULT_DATA_DIR,
+                        help="Where generated captures are kept")
+    parser.add_argument('-a', '--analysers', nargs='+', choices=list(ANALYSERS),
+                        default=list(ANALYSERS), metavar='ANALYSER')
+    parser.add_argument('-w', '--workers', type=int, default=1)
+    parser.add_argument('--columnar', action='store_true')
+    parser.add_argument('--repeat', type=int,
+                        help="Runs of each benchmark, the fastest is kept "
+                             f'(default: 1, {STARTUP_REPEAT} with --startup)')
+    parser.add_argument('--startup', nargs='*', metavar='MODULE',
+                        help="Time importing the entry points in fresh "
+                             "processes instead (default: "
+                             f'{", ".join(STARTUP_MODULES)})')
+    parser.add_argument('-o', '--output', metavar='FILE',
+                        help="Results file (default: "
+                             "benchmark-<date>-<commit>.json)")
+    parser.add_argument('--compare', metavar='FILE',
+                        help="Earlier results to check for regressions")
+    parser.add_argument('--threshold', type=float, default=0.1,
+                        help="Slowdown that counts as a regression "
+                             "(default: 0.1)")
+    parser.add_argument('--run-one', metavar='PCAP', help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.run_one:
+        print(json.dumps(run_one(args.run_one, args.analysers, args.workers,
+                                 args.columnar)))
+        return 0
+
+    commit = git_commit()
+    if args.startup is not None:
+        results = measure_startup(args.startup or STARTUP_MODULES,
+                                  args.repeat or STARTUP_REPEAT)
+        output = args.output or f'benchmark-startup-' \
+            f'{datetime.datetime.now():%Y%m%d-%H%M%S}-{commit or "local"}.json'
+        with open(output, 'w') as f:
+            json.dump({'created': datetime.datetime.now(
+                           datetime.timezone.utc).isoformat(),
+                       'commit': commit, 'python': platform.python_version(),
+                       'platform': platform.platform(),
+                       'startup': results}, f, indent=1)
+        print(f'[!] Saved results to {output}')
+        return 0
+
+    results = []
+    for packets in args.sizes:
+        path = capture_path(args.data_dir, packets, args.seed)
+        runs = [(name, [name]) for name in args.analysers]
+        runs.append(('pipeline', args.analysers))
+        for run, names in runs:
+            result = min((measure(path, names, args.workers, args.columnar)
+                          for i in range(args.repeat or 1)),
+                         key=lambda r: r['seconds'])
+            result.update({'run': run, 'packets_target': packets,
+                           'analysers': names})
+            results.append(result)
+            print(f'[!] {run:>10} {packets:>9} packets: '
+                  f'{result["packets_per_sec"]:>9,} packets/s, '
+                  f'peak RSS {result["peak_rss_mb"]} MB')
+        pipeline = results[-1]['analyser_seconds']
+        if pipeline:
+            print('    pipeline time by analyser: ' + ', '.join(
+                f'{name} {seconds:.2f}s' for name, seconds in pipeline.items()))
+
+    output = args.output or \
+        f'benchmark-{datetime.datetime.now():%Y%m%d-%H%M%S}-{commit or "local"}.json'
+    with open(output, 'w') as f:
+        json.dump({'created': datetime.datetime.now(
+                       datetime.timezone.utc).isoformat(),
+                   'commit': commit, 'python': platform.python_version(),
+                   'platform': platform.platform(),
+                   'generator_version': GENERATOR_VERSION, 'seed': args.seed,
+                   'workers': args.workers, 'columnar': args.columnar,
+                   'results': results}, f, indent=1)
+    print(f'[!] Saved results to {output}')
+    if args.compare:
+        return 1 if compare(results, args.compare, args.threshold) else 0
+    return 0
+
+
+# Boiler Plate
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,207 @@
+# Script:   cache_modules.py
+# Desc:     On-disk cache of parsed captures so a report can be produced
+#           again without re-reading the PCAP file
+# Author:   Jacob Connell Nov 2019
+# Note: Run setup.py before use!
+
+import hashlib
+import json
+import os
+import pickle
+import shutil
+import time
+from core_modules import replace_file
+from packet_modules import DECODER_VERSION
+
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache',
+                                 'pcap_analyser')
+DEFAULT_CACHE_SIZE = 1 << 30
+
+
+def capture_key(pcapfile, content_hash=False, packet_filter=None):
+    '''Returns the cache key of a capture. By default the key is built
+    from the path, size and mtime. content_hash hashes the file itself
+    so renamed or copied captures share an entry. A packet filter and
+    the decoder version are part of the key'''
+    info = os.stat(pcapfile)
+    digest = hashlib.sha256()
+    if content_hash:
+        with open(pcapfile, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                digest.update(block)
+        digest.update(str(info.st_size).encode())
+    else:
+        digest.update(f'{os.path.realpath(pcapfile)}|{info.st_size}|'
+                      f'{info.st_mtime_ns}'.encode())
+    if packet_filter:
+        digest.update(repr(packet_filter).encode())
+    digest.update(f'|decoder {DECODER_VERSION}'.encode())
+    return digest.hexdigest()
+
+
+class AnalysisCache:
+    '''Stores the columnar packet table and the final state of each
+    analyser for a capture. An analyser is only reused when its class
+    version and analysis options match the cached ones. The options in
+    its report_options only change the reports, so they are left out
+    of the match and set again on the loaded analyser. The least
+    recently used entries are removed once the cache grows past
+    max_bytes'''
+    def __init__(self, directory=DEFAULT_CACHE_DIR, max_bytes=DEFAULT_CACHE_SIZE):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        os.makedirs(directory, exist_ok=True)
+
+    def entry_path(self, key):
+        '''Returns the directory holding a cache entry'''
+        return os.path.join(self.directory, key)
+
+    def read_meta(self, key):
+        '''Returns the metadata of an entry or None'''
+        try:
+            with open(os.path.join(self.entry_path(key), 'meta.json')) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def write_meta(self, key, meta):
+        '''Writes the metadata of an entry'''
+        with replace_file(os.path.join(self.entry_path(key),
+                                       'meta.json')) as f:
+            json.dump(meta, f)
+
+    @staticmethod
+    def analysis_options(name, cls, options):
+        '''Returns the repr of the options that change what an analyser
+        collects. Analysers fed TCP streams also depend on the stream
+        reassembly options'''
+        report_options = getattr(cls, 'report_options', ())
+        keyed = {option: value for option, value
+                 in options.get(name, {}).items()
+                 if option not in report_options}
+        if getattr(cls, 'streams', False):
+            keyed = (keyed, options.get('streams', {}))
+        return repr(keyed)
+
+    @staticmethod
+    def set_report_options(analyser, name, options):
+        '''Gives a loaded analyser the current report options'''
+        report_options = getattr(analyser, 'report_options', ())
+        if report_options:
+            fresh = type(analyser)(**options.get(name, {}))
+            for option in report_options:
+                setattr(analyser, option, getattr(fresh, option))
+
+    def reusable(self, meta, name, cls, options):
+        '''Returns whether the cached state of an analyser matches its
+        class version and analysis options'''
+        entry = meta['analysers'].get(name)
+        return entry is not None and entry['version'] == cls.version and \
+            entry['options'] == self.analysis_options(name, cls, options)
+
+    def has(self, key, analysers, options=None):
+        '''Returns whether every analyser of the (name -> class) mapping
+        can be reused from the entry, without loading them'''
+        meta = self.read_meta(key)
+        return meta is not None and all(
+            self.reusable(meta, name, cls, options or {})
+            for name, cls in analysers.items())
+
+    def load(self, key, analysers, options=None):
+        '''Returns the cached analysers that can be reused for the given
+        (name -> class) mapping, the packet table columns if cached and
+        the undecodable packet count'''
+        meta = self.read_meta(key)
+        if meta is None:
+            return {}, None, 0
+        options = options or {}
+        found = {}
+        for name, cls in analysers.items():
+            if not self.reusable(meta, name, cls, options):
+                continue
+            try:
+                with open(os.path.join(self.entry_path(key),
+                                       f'{name}.pickle'), 'rb') as f:
+                    found[name] = pickle.load(f)
+            except (OSError, pickle.UnpicklingError, EOFError):
+                continue
+            self.set_report_options(found[name], name, options)
+        columns = None
+        if meta.get('table'):
+            import numpy as np
+            try:
+                columns = np.load(os.path.join(self.entry_path(key),
+                                               'packets.npy'))
+            except (OSError, ValueError):
+                columns = None
+        meta['last_used'] = time.time()
+        self.write_meta(key, meta)
+        return found, columns, meta['error_count']
+
+    def store(self, key, pcapfile, analysers, columns=None, error_count=0,
+              options=None):
+        '''Adds analyser states, and the packet table if given, to the
+        entry for a capture then evicts old entries. Each file is
+        replaced whole, so batch workers storing the same entry at once
+        leave the states of the last writer'''
+        path = self.entry_path(key)
+        os.makedirs(path, exist_ok=True)
+        meta = self.read_meta(key) or {'capture': os.path.abspath(pcapfile),
+                                       'analysers': {}, 'table': False}
+        options = options or {}
+        for name, analyser in analysers.items():
+            with replace_file(os.path.join(path, f'{name}.pickle'),
+                              'wb') as f:
+                pickle.dump(analyser, f, protocol=pickle.HIGHEST_PROTOCOL)
+            cls = type(analyser)
+            meta['analysers'][name] = {
+                'version': cls.version,
+                'options': self.analysis_options(name, cls, options)}
+        if columns is not None:
+            import numpy as np
+            with replace_file(os.path.join(path, 'packets.npy'),
+                              'wb') as f:
+                np.save(f, columns)
+            meta['table'] = True
+        meta['error_count'] = error_count
+        meta['last_used'] = time.time()
+        self.write_meta(key, meta)
+        self.evict(keep=key)
+
+    def entry_size(self, key):
+        '''Returns the bytes used by an entry. Files another process
+        removes meanwhile are not counted'''
+        path = self.entry_path(key)
+        size = 0
+        try:
+            names = os.listdir(path)
+        except OSError:
+            return 0
+        for name in names:
+            try:
+                size += os.path.getsize(os.path.join(path, name))
+            except OSError:
+                continue
+        return size
+
+    def evict(self, keep=None):
+        '''Removes least recently used entries until the cache fits'''
+        entries = []
+        for key in os.listdir(self.directory):
+            meta = self.read_meta(key)
+            if meta is None:
+                continue
+            entries.append((meta.get('last_used', 0), key, self.entry_size(key)))
+        total = sum(size for last_used, key, size in entries)
+        for last_used, key, size in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            if key == keep:
+                continue
+            shutil.rmtree(self.entry_path(key), ignore_errors=True)
+            total -= size
+
+
+# Boiler Plate
+if __name__ == '__main__':
+    print("[!]Nothing to run here.")
@@ -0,0 +1,183 @@
+# Script:   columnar_modules.py
+# Desc:     Columnar packet table and vectorised statistics for
+#           PCAP_Analyser
+# Author:   Jacob Connell Nov 2019
+# Note: Run setup.py before use!
+
+import struct
+import numpy as np
+
+# One packed row per packet. Addresses are stored as 16 raw bytes with
+# IPv4 addresses mapped into IPv6 (::ffff:a.b.c.d)
+PACKET_DTYPE = np.dtype([('ts', '<f8'), ('src', 'V16'), ('dst', 'V16'),
+                         ('proto', 'u1'), ('sport', '<u2'), ('dport', '<u2'),
+                         ('length', '<u4')])
+PACKET_ROW = struct.Struct('<d16s16sBHHI')
+V4_MAPPED = bytes(10) + b'\xff\xff'
+
+# Analysers that can be filled from the table instead of per packet
+COLUMNAR_ANALYSERS = ('summary', 'traffic', 'graph', 'flow')
+
+
+class PacketTable:
+    '''Collects the packet metadata into preallocated chunks which are
+    viewed as numpy columns once ingest is finished'''
+    protocols = None
+
+    def __init__(self, chunk_size=1 << 18):
+        self.chunk_size = chunk_size
+        self.chunks = []
+        self.columns = None
+        self.new_chunk()
+
+    def new_chunk(self):
+        '''Preallocates the next chunk of rows'''
+        self.chunk = bytearray(self.chunk_size * PACKET_DTYPE.itemsize)
+        self.chunks.append(self.chunk)
+        self.position = 0
+
+    def add_packet(self, pkt):
+        '''Packs the packet metadata into the current chunk'''
+        if self.position == self.chunk_size:
+            self.new_chunk()
+        src, dst = pkt.src, pkt.dst
+        if len(src) == 4:
+            src, dst = V4_MAPPED + src, V4_MAPPED + dst
+        PACKET_ROW.pack_into(self.chunk, self.position * PACKET_DTYPE.itemsize,
+                             pkt.ts, src, dst, pkt.p, pkt.sport, pkt.dport,
+                             pkt.length)
+        self.position += 1
+
+    def merge(self, other):
+        '''Appends the rows of another table'''
+        self.columns = self.concatenate((self.finalize(), other.finalize()))
+
+    @staticmethod
+    def concatenate(tables):
+        '''Joins finalised column arrays in order'''
+        return np.concatenate(tables)
+
+    def finalize(self):
+        '''Returns the rows as a numpy record array'''
+        if self.columns is None:
+            rows = [np.frombuffer(chunk, dtype=PACKET_DTYPE)
+                    for chunk in self.chunks[:-1]]
+            rows.append(np.frombuffer(self.chunks[-1], dtype=PACKET_DTYPE)
+                        [:self.position])
+            self.columns = np.concatenate(rows)
+            self.chunks = []
+        return self.columns
+
+    def __getstate__(self):
+        return {'chunk_size': self.chunk_size, 'columns': self.finalize()}
+
+    def __setstate__(self, state):
+        self.chunk_size = state['chunk_size']
+        self.columns = state['columns']
+        self.chunks = []
+
+
+def address_columns(columns):
+    '''Returns the src and dst address columns. When every address is
+    IPv4 they are returned as uint32, which sort much faster than the
+    16 byte values'''
+    src = np.ascontiguousarray(columns['src']).view(np.uint8).reshape(-1, 16)
+    dst = np.ascontiguousarray(columns['dst']).view(np.uint8).reshape(-1, 16)
+    mapped = np.frombuffer(V4_MAPPED, dtype=np.uint8)
+    if (src[:, :12] == mapped).all() and (dst[:, :12] == mapped).all():
+        return (np.ascontiguousarray(src[:, 12:]).view('>u4').ravel(),
+                np.ascontiguousarray(dst[:, 12:]).view('>u4').ravel())
+    return src.view('V16').ravel(), dst.view('V16').ravel()
+
+
+def address_bytes(values):
+    '''Converts uint32 or 16 byte addresses back to raw 4 or 16 byte
+    strings'''
+    if values.dtype.kind == 'V':
+        return [raw[12:] if raw[:12] == V4_MAPPED else raw
+                for raw in values.tolist()]
+    return [int(value).to_bytes(4, 'big') for value in values]
+
+
+def first_seen(values):
+    '''Returns the distinct values in order of first appearance along
+    with the index of each input value into that order'''
+    unique, index, inverse = np.unique(values, return_index=True,
+                                       return_inverse=True)
+    order = np.argsort(index, kind='stable')
+    rank = np.empty_like(order)
+    rank[order] = np.arange(len(order))
+    return unique[order], rank[inverse.ravel()]
+
+
+def protocol_summary(columns, proto):
+    '''Returns the count, total length and min/max ts of a protocol'''
+    rows = columns[columns['proto'] == proto]
+    if len(rows) == 0:
+        return 0, 0, 0, 0
+    return (len(rows), int(rows['length'].sum(dtype=np.uint64)),
+            float(rows['ts'].min()), float(rows['ts'].max()))
+
+
+def address_counts(columns, volumes=False):
+    '''Returns the distinct addresses in first-seen order with the
+    number of packets each sent and received. With volumes the bytes
+    each sent and received are returned as well'''
+    # Interleave src/dst so first-seen order matches per packet updates
+    addresses = np.column_stack(address_columns(columns)).ravel()
+    unique, rank = first_seen(addresses)
+    sent = np.bincount(rank[0::2], minlength=len(unique))
+    received = np.bincount(rank[1::2], minlength=len(unique))
+    if not volumes:
+        return unique, sent, received
+    lengths = columns['length']
+    return (unique, sent, received,
+            np.bincount(rank[0::2], lengths, len(unique)).astype(np.int64),
+            np.bincount(rank[1::2], lengths, len(unique)).astype(np.int64))
+
+
+def connection_counts(columns, volumes=False):
+    '''Returns the distinct src->dst pairs in first-seen order and
+    the number of packets for each. With volumes the bytes of each
+    pair are returned as well'''
+    src, dst = address_columns(columns)
+    if src.dtype.kind == 'V':
+        pairs = np.column_stack((src.view(np.uint8).reshape(-1, 16),
+                                 dst.view(np.uint8).reshape(-1, 16)))
+        unique, rank = first_seen(pairs.view('V32').ravel())
+        unique = unique.view(np.uint8).reshape(-1, 32)
+        srcs = np.ascontiguousarray(unique[:, :16]).view('V16').ravel()
+        dsts = np.ascontiguousarray(unique[:, 16:]).view('V16').ravel()
+    else:
+        pairs = (src.astype(np.uint64) << np.uint64(32)) | \
+            dst.astype(np.uint64)
+        unique, rank = first_seen(pairs)
+        srcs, dsts = unique >> np.uint64(32), unique & np.uint64(0xffffffff)
+    counts = np.bincount(rank, minlength=len(unique))
+    if not volumes:
+        return srcs, dsts, counts
+    return srcs, dsts, counts, np.bincount(rank, columns['length'],
+                                           len(unique)).astype(np.int64)
+
+
+def top_talkers(columns, count=10):
+    '''Returns the count addresses with the most packets sent and
+    received, busiest first, with their packet totals and the packets
+    and bytes each sent and received'''
+    unique, sent, received, sent_bytes, received_bytes = \
+        address_counts(columns, volumes=True)
+    totals = sent + received
+    order = np.argsort(-totals, kind='stable')[:count]
+    return (unique[order], totals[order], sent[order], received[order],
+            sent_bytes[order], received_bytes[order])
+
+
+def time_histogram(columns, width):
+    '''Returns the epoch aligned bin numbers and packet counts'''
+    keys = np.floor_divide(columns['ts'], width).astype(np.int64)
+    return np.unique(keys, return_counts=True)
+
+
+# Boiler Plate
+if __name__ == '__main__':
+    print("[!]Nothing to run here.")
@@ -3,25 +3,44 @@
 # Author:   Jacob Connell Nov 2019
 # Note: Run setup.py before use!
 
+import contextlib
 import json
 import os
-import tarfile
-import urllib.request
+import subprocess
+import sys
 import shutil
-from parse_modules import *
+import tempfile
 
 
-def download_geo_db():
-    '''Downloads and unzips GEODB for code, adapted
+GEO_DB_URL = ('https://download.maxmind.com/app/geoip_download?'
+              'edition_id=GeoLite2-City&license_key={}&suffix=tar.gz')
+
+
+class MissingDatabase(OSError):
+    '''Raised when an optional database a report needs is not there.
+    The report is skipped rather than counted as failed'''
+
+
+def download_geo_db(license_key, db_path='GeoLite2-City.mmdb'):
+    '''Downloads GEODB and extracts the .mmdb file to db_path. MaxMind
+        needs a free license key for downloads. Adapted
         from https://www.programcreek.com/python/
         example/81585/urllib.request.urlretrieve
         (Example 5)'''
-    url = 'https://geolite.maxmind.com/download/geoip/database/GeoLite2-City.tar.gz'
-    file_tmp = urllib.request.urlretrieve(url, filename=False)[0]
-    base_name = os.path.basename(url)
-    file_name, file_extension = os.path.splitext(base_name)
-    tar = tarfile.open(file_tmp)
-    tar.extractall(file_name)
+    import tarfile
+    import urllib.request
+    file_tmp = urllib.request.urlretrieve(GEO_DB_URL.format(license_key))[0]
+    with tarfile.open(file_tmp) as tar:
+        for member in tar.getmembers():
+            if member.name.endswith('.mmdb'):
+                with tar.extractfile(member) as src, \
+                        open(db_path + '.tmp', 'wb') as dst:
+                    shutil.copyfileobj(src, dst)
+                os.replace(db_path + '.tmp', db_path)
+                break
+        else:
+            raise ValueError("No .mmdb file in the GEO DB download")
+    os.remove(file_tmp)
 
 
 def create_directory(file_name):
@@ -37,6 +56,36 @@ def create_directory(file_name):
         os.mkdir(new_dir)
 
 
+def open_file(path):
+    '''Opens a file in the default desktop application. Raises OSError
+    when there is no way to open it'''
+    if sys.platform.startswith('win'):
+        os.startfile(path)
+    else:
+        opener = 'open' if sys.platform == 'darwin' else 'xdg-open'
+        subprocess.Popen([opener, path], stdout=subprocess.DEVNULL,
+                         stderr=subprocess.DEVNULL)
+
+
+@contextlib.contextmanager
+def replace_file(path, mode='w'):
+    '''Yields a temporary file of its own next to path and renames it
+    over path once written, so processes writing the same file at once
+    never share a temporary file and readers see a whole file. The
+    last writer wins'''
+    f = tempfile.NamedTemporaryFile(mode, dir=os.path.dirname(path) or '.',
+                                    prefix=os.path.basename(path) + '.',
+                                    suffix='.tmp', delete=False)
+    try:
+        with f:
+            yield f
+        os.replace(f.name, path)
+    except BaseException:
+        with contextlib.suppress(OSError):
+            os.remove(f.name)
+        raise
+
+
 def save(data_dict, filename, file_path):
     '''Saves data to json file'''
     with open(f'{file_path}/{filename}.json', 'w') as json_file:
@@ -44,6 +93,13 @@ def save(data_dict, filename, file_path):
     json_file.close()
 
 
+def save_lines(rows, filename, file_path):
+    '''Saves rows to a json lines file, one object per line'''
+    with open(f'{file_path}/{filename}.jsonl', 'w') as json_file:
+        for row in rows:
+            json_file.write(json.dumps(row) + '\n')
+
+
 # Boiler Plate
 if __name__ == '__main__':
     print("[!]Nothing to run here.")
@@ -0,0 +1,179 @@
+# Script:   export_modules.py
+# Desc:     Columnar export of the analyser results and run manifest
+# Author:   Jacob Connell Nov 2019
+# Note: Run setup.py before use!
+
+import csv
+import datetime
+import json
+import os
+from itertools import islice
+
+# Column types used in the table schemas
+STRING = 'string'
+INT = 'int64'
+FLOAT = 'float64'
+
+
+class CsvWriter:
+    '''Writes a table as CSV with a header row'''
+    extension = 'csv'
+
+    def __init__(self, path, columns):
+        self.file = open(path, 'w', newline='')
+        self.writer = csv.writer(self.file)
+        self.writer.writerow([name for name, kind in columns])
+
+    def write_batch(self, rows):
+        '''Writes a list of row tuples'''
+        self.writer.writerows(rows)
+
+    def close(self):
+        self.file.close()
+
+
+class JsonLinesWriter:
+    '''Writes a table as one json object per line'''
+    extension = 'jsonl'
+
+    def __init__(self, path, columns):
+        self.file = open(path, 'w')
+        self.names = [name for name, kind in columns]
+
+    def write_batch(self, rows):
+        '''Writes a list of row tuples'''
+        names = self.names
+        self.file.writelines(json.dumps(dict(zip(names, row))) + '\n'
+                             for row in rows)
+
+    def close(self):
+        self.file.close()
+
+
+def arrow():
+    '''Returns the pyarrow module, imported on first use so runs that
+    do not export Parquet or Arrow never load it'''
+    try:
+        import pyarrow
+        import pyarrow.ipc
+        import pyarrow.parquet
+    except ImportError:
+        raise ImportError("pyarrow is needed for Parquet and Arrow export, "
+                          "install it with pip install pyarrow") from None
+    return pyarrow
+
+
+def arrow_schema(columns):
+    '''Returns the pyarrow schema of a table'''
+    pa = arrow()
+    return pa.schema([(name, pa.type_for_alias(kind))
+                      for name, kind in columns])
+
+
+def record_batch(schema, rows):
+    '''Converts a list of row tuples into a pyarrow record batch'''
+    return arrow().record_batch([list(column) for column in zip(*rows)],
+                                schema=schema)
+
+
+class ParquetWriter:
+    '''Writes a table as Parquet, one row group per batch'''
+    extension = 'parquet'
+
+    def __init__(self, path, columns):
+        self.schema = arrow_schema(columns)
+        self.writer = arrow().parquet.ParquetWriter(path, self.schema)
+
+    def write_batch(self, rows):
+        '''Writes a list of row tuples'''
+        self.writer.write_batch(record_batch(self.schema, rows))
+
+    def close(self):
+        self.writer.close()
+
+
+class ArrowWriter:
+    '''Writes a table in the Arrow IPC file format'''
+    extension = 'arrow'
+
+    def __init__(self, path, columns):
+        self.schema = arrow_schema(columns)
+        pa = arrow()
+        self.sink = pa.OSFile(path, 'wb')
+        self.writer = pa.ipc.new_file(self.sink, self.schema)
+
+    def write_batch(self, rows):
+        '''Writes a list of row tuples'''
+        self.writer.write_batch(record_batch(self.schema, rows))
+
+    def close(self):
+        self.writer.close()
+        self.sink.close()
+
+
+WRITERS = {'csv': CsvWriter, 'jsonl': JsonLinesWriter,
+           'parquet': ParquetWriter, 'arrow': ArrowWriter}
+
+
+def export_table(name, columns, rows, file_path, formats, batch_size=65536):
+    '''Streams the rows of one table to a file in each format, batch_size
+    rows at a time. Returns the manifest entry for the table'''
+    writers = [WRITERS[fmt](os.path.join(
+        file_path, f'{name}.{WRITERS[fmt].extension}'), columns)
+        for fmt in formats]
+    count = 0
+    rows = iter(rows)
+    try:
+        while True:
+            batch = list(islice(rows, batch_size))
+            if not batch:
+                break
+            count += len(batch)
+            for writer in writers:
+                writer.write_batch(batch)
+    finally:
+        for writer in writers:
+            writer.close()
+    return {'table': name, 'rows': count,
+            'columns': [{'name': column, 'type': kind}
+                        for column, kind in columns],
+            'files': {fmt: f'{name}.{WRITERS[fmt].extension}'
+                      for fmt in formats}}
+
+
+def export_analysers(analysers, names, file_path, formats, batch_size=65536):
+    '''Exports every table of the named analysers. Returns the manifest
+    entries of the tables'''
+    entries = []
+    for name in names:
+        if not hasattr(analysers[name], 'tables'):
+            continue
+        for table, columns, rows in analysers[name].tables():
+            print(f'[!] Exporting {table}...')
+            entries.append(export_table(table, columns, rows, file_path,
+                                        formats, batch_size))
+    return entries
+
+
+def write_manifest(file_path, pcapfile, names, error_count, tables=()):
+    '''Saves manifest.json listing the capture, the analysers run, the
+    exported tables with their schemas and every file in the report
+    directory'''
+    files = []
+    for entry in sorted(os.scandir(file_path), key=lambda e: e.name):
+        if entry.is_file() and entry.name != 'manifest.json':
+            files.append({'file': entry.name, 'bytes': entry.stat().st_size})
+    manifest = {'capture': os.path.abspath(pcapfile),
+                'created': datetime.datetime.now(
+                    datetime.timezone.utc).isoformat(),
+                'analysers': list(names),
+                'undecoded_packets': error_count,
+                'tables': list(tables),
+                'files': files}
+    with open(os.path.join(file_path, 'manifest.json'), 'w') as json_file:
+        json.dump(manifest, json_file, indent=1)
+
+
+# Boiler Plate
+if __name__ == '__main__':
+    print("[!]Nothing to run here.")
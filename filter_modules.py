@@ -0,0 +1,323 @@
+# Script:   filter_modules.py
+# Desc:     BPF style packet filters checked on the raw frame bytes
+#           before a packet is decoded
+# Author:   Jacob Connell Nov 2019
+# Note: Run setup.py before use!
+
+import datetime
+import math
+import re
+import socket
+from packet_modules import LINKTYPE_ETHERNET, locate_ip
+
+TOKEN = re.compile(r'\s*(\(|\)|&&|\|\||!|[^\s()!&|]+)')
+PROTOCOLS = {'icmp': 1, 'igmp': 2, 'tcp': 6, 'udp': 17, 'icmp6': 58}
+DIRECTIONS = ('src', 'dst')
+TYPES = ('host', 'net', 'port', 'portrange')
+
+# Python expressions on the frame b and h, the (addresses, size, p, l4,
+# end, later_fragment) tuple from locate_ip, set before the filter
+# expression runs
+ADDRESS = {'src': 'b[h[0]:h[0] + h[1]]', 'dst': 'b[h[0] + h[1]:h[0] + 2 * h[1]]'}
+PORT = {'src': '(b[h[3]] << 8 | b[h[3] + 1])',
+        'dst': '(b[h[3] + 2] << 8 | b[h[3] + 3])'}
+PORT_BYTES = {'src': 'b[h[3]:h[3] + 2]', 'dst': 'b[h[3] + 2:h[3] + 4]'}
+# Ports are only read from the first fragment of a TCP or UDP packet
+HAS_PORTS = '(h[2] == 6 or h[2] == 17) and not h[5] and h[3] + 4 <= h[4]'
+VERSIONS = {'ip': 'h[1] == 4', 'ip6': 'h[1] == 16'}
+# Protocols that only exist over one IP version
+PROTOCOL_VERSIONS = {'icmp': 'ip', 'igmp': 'ip', 'icmp6': 'ip6'}
+
+
+def parse_time(text):
+    '''Reads a time as epoch seconds or an ISO 8601 date and time,
+    taken as UTC when no offset is given'''
+    try:
+        when = float(text)
+    except ValueError:
+        pass
+    else:
+        if not math.isfinite(when):
+            raise ValueError(f'Bad time: {text}')
+        return when
+    try:
+        when = datetime.datetime.fromisoformat(text)
+    except ValueError:
+        raise ValueError(f'Bad time: {text}') from None
+    if when.tzinfo is None:
+        when = when.replace(tzinfo=datetime.timezone.utc)
+    return when.timestamp()
+
+
+class FilterParser:
+    '''Compiles a subset of the BPF filter language into a Python
+    expression on the raw frame. Supports host, net (a.b.c.d/len,
+    a.b.c, a.b.c.d mask m.m.m.m or an IPv6 prefix/len), port,
+    portrange, src/dst, tcp, udp, icmp, icmp6, igmp, ip, ip6, ip proto,
+    ip6 proto, and/or/not (&&, ||, !) and parentheses. A bare value
+    reuses the qualifiers before it, so "port 80 or 443" works as in
+    tcpdump'''
+    def __init__(self, expression):
+        self.tokens = TOKEN.findall(expression)
+        if ''.join(self.tokens) != re.sub(r'\s', '', expression):
+            raise ValueError(f'Bad filter expression: {expression}')
+        self.position = 0
+        self.last = None
+
+    def peek(self):
+        if self.position < len(self.tokens):
+            return self.tokens[self.position]
+        return None
+
+    def take(self):
+        token = self.peek()
+        if token is None:
+            raise ValueError("Filter expression ended early")
+        self.position += 1
+        return token
+
+    def compile(self):
+        '''Returns the Python expression of the whole filter'''
+        code = self.parse_or()
+        if self.peek() is not None:
+            raise ValueError(f'Unexpected "{self.peek()}" in filter')
+        return code
+
+    def parse_or(self):
+        terms = [self.parse_and()]
+        while self.peek() in ('or', '||'):
+            self.take()
+            terms.append(self.parse_and())
+        return terms[0] if len(terms) == 1 else '(' + ' or '.join(terms) + ')'
+
+    def parse_and(self):
+        terms = [self.parse_not()]
+        while self.peek() in ('and', '&&'):
+            self.take()
+            terms.append(self.parse_not())
+        return terms[0] if len(terms) == 1 else '(' + ' and '.join(terms) + ')'
+
+    def parse_not(self):
+        if self.peek() in ('not', '!'):
+            self.take()
+            return f'not {self.parse_not()}'
+        if self.peek() == '(':
+            self.take()
+            code = self.parse_or()
+            if self.take() != ')':
+                raise ValueError("Missing ) in filter")
+            return code
+        return self.parse_primitive()
+
+    def parse_primitive(self):
+        '''Parses [proto] [src|dst] [host|net|port|portrange] value'''
+        proto = direction = kind = None
+        token = self.take()
+        version = None
+        if token in VERSIONS:
+            version = token
+            if self.peek() != 'proto':
+                return VERSIONS[version]
+            token = self.take()
+        if token == 'proto':
+            number = self.take()
+            number = PROTOCOLS.get(number.lstrip('\\'), number)
+            if not str(number).isdigit():
+                raise ValueError(f'Bad protocol: {number}')
+            if version is None:
+                return f'h[2] == {int(number)}'
+            return f'({VERSIONS[version]} and h[2] == {int(number)})'
+        if token in PROTOCOLS:
+            proto = token
+            if self.peek() not in DIRECTIONS + TYPES:
+                return self.protocol(proto)
+            token = self.take()
+        if token in DIRECTIONS:
+            direction = token
+            token = self.take()
+        if token in TYPES:
+            kind = token
+            token = self.take()
+        if proto is None and direction is None and kind is None:
+            if self.last is None:
+                raise ValueError(f'Unknown filter term "{token}"')
+            proto, direction, kind = self.last
+        self.last = (proto, direction, kind)
+        kind = kind or ('port' if token.isdigit() else 'host')
+        if kind in ('port', 'portrange'):
+            code = self.port(direction, kind, token)
+            if proto is not None:
+                code = f'({self.protocol(proto)} and {code})'
+            return code
+        if proto is not None:
+            raise ValueError(f'{proto} {kind} is not supported')
+        if kind == 'net' and self.peek() == 'mask':
+            self.take()
+            token += '/' + self.take()
+        return self.address(direction, kind, token)
+
+    @staticmethod
+    def protocol(proto):
+        '''Compiles a transport protocol test'''
+        code = f'h[2] == {PROTOCOLS[proto]}'
+        if proto in PROTOCOL_VERSIONS:
+            code = f'({VERSIONS[PROTOCOL_VERSIONS[proto]]} and {code})'
+        return code
+
+    def either(self, direction, test):
+        '''Applies test to one or both directions'''
+        if direction is not None:
+            return test(direction)
+        return f'({test("src")} or {test("dst")})'
+
+    def address(self, direction, kind, value):
+        '''Compiles a host or net test'''
+        if kind == 'host':
+            if ':' not in value and value.count('.') != 3:
+                raise ValueError(f'Bad address: {value}')
+            raw = self.inet_pton(value)
+            return self.either(direction, lambda d: f'{ADDRESS[d]} == {raw!r}')
+        network, _, length = value.partition('/')
+        if ':' in network:
+            raw = self.inet_pton(network)
+            length = length or '128'
+        else:
+            parts = network.split('.')
+            if not length:
+                length = str(8 * len(parts))
+            parts += ['0'] * (4 - len(parts))
+            raw = self.inet_pton('.'.join(parts))
+        bits = len(raw) * 8
+        full = (1 << bits) - 1
+        if '.' in length and bits == 32:
+            mask = int.from_bytes(self.inet_pton(length), 'big')
+        elif length.isdigit() and int(length) <= bits:
+            mask = (full << (bits - int(length))) & full
+        else:
+            raise ValueError(f'Bad network: {value}')
+        version = VERSIONS['ip' if bits == 32 else 'ip6']
+        if mask == 0:
+            return version
+        size = bits - (mask ^ full).bit_length()
+        if size % 8 == 0 and mask == (full << (bits - size)) & full:
+            # Whole byte prefixes compare a slice of the address
+            prefix = raw[:size // 8]
+            test = self.either(direction, lambda d: f'{ADDRESS[d]}'
+                               f'[:{size // 8}] == {prefix!r}')
+        else:
+            value = int.from_bytes(raw, 'big') & mask
+            test = self.either(direction, lambda d: f'int.from_bytes('
+                               f'{ADDRESS[d]}, "big") & {mask} == {value}')
+        return f'({version} and {test})'
+
+    def port(self, direction, kind, value):
+        '''Compiles a port or portrange test'''
+        if kind == 'port':
+            number = self.port_number(value)
+            raw = number.to_bytes(2, 'big')
+            test = self.either(direction,
+                               lambda d: f'{PORT_BYTES[d]} == {raw!r}')
+        else:
+            low, _, high = value.partition('-')
+            low, high = self.port_number(low), self.port_number(high)
+            test = self.either(direction,
+                               lambda d: f'{low} <= {PORT[d]} <= {high}')
+        return f'({HAS_PORTS} and {test})'
+
+    @staticmethod
+    def port_number(value):
+        if value.isdigit() and int(value) < 65536:
+            return int(value)
+        try:
+            return socket.getservbyname(value)
+        except OSError:
+            raise ValueError(f'Bad port: {value}') from None
+
+    @staticmethod
+    def inet_pton(value):
+        '''Returns the raw bytes of an IPv4 or IPv6 address'''
+        try:
+            if ':' in value:
+                return socket.inet_pton(socket.AF_INET6, value)
+            return socket.inet_aton(value)
+        except OSError:
+            raise ValueError(f'Bad address: {value}') from None
+
+
+class PacketFilter:
+    '''Keeps the (ts, buf) records that match a filter expression and
+    fall in [start, end). The checks are compiled into one function on
+    the raw frame for each link type, so packets that do not match are
+    never decoded. Frames that do not carry IP never match an
+    expression. Only the expression and times are pickled so filters
+    can be sent to worker processes'''
+    def __init__(self, expression='', start=None, end=None):
+        self.expression = expression.strip()
+        self.start = start
+        self.end = end
+        # Parse once so bad expressions fail straight away
+        self.code = FilterParser(self.expression).compile() \
+            if self.expression else None
+        self.matchers = {}
+
+    def compile(self, linktype=LINKTYPE_ETHERNET):
+        '''Returns the match function for frames of a pcap link type,
+        or None to keep every record'''
+        checks = []
+        # The bounds are passed in as names rather than formatted into
+        # the source, which would not work for every float
+        if self.start is not None:
+            checks.append('record[0] >= start')
+        if self.end is not None:
+            checks.append('record[0] < end')
+        if self.code is not None:
+            checks.append('(b := record[1]) is not None')
+            checks.append(f'(h := locate_ip(b, {int(linktype)})) is not None')
+            checks.append(self.code)
+        if not checks:
+            return None
+        return eval('lambda record: ' + ' and '.join(checks),
+                    {'locate_ip': locate_ip, 'start': self.start,
+                     'end': self.end})
+
+    def match(self, record, linktype=LINKTYPE_ETHERNET):
+        '''Checks a single record'''
+        matcher = self.matcher(linktype)
+        return matcher is None or matcher(record)
+
+    def matcher(self, linktype=LINKTYPE_ETHERNET):
+        '''Returns the cached match function of a link type'''
+        if linktype not in self.matchers:
+            self.matchers[linktype] = self.compile(linktype)
+        return self.matchers[linktype]
+
+    def apply(self, records, linktype=LINKTYPE_ETHERNET, linktypes=False):
+        '''Returns an iterator over the matching records. With linktypes
+        set the records are (ts, buf, linktype) and each is matched for
+        its own link type'''
+        matcher = self.matcher(linktype)
+        if matcher is None:
+            return records
+        if linktypes:
+            return (record for record in records
+                    if self.matcher(record[2])(record))
+        return filter(matcher, records)
+
+    def __bool__(self):
+        return self.code is not None or self.start is not None or \
+            self.end is not None
+
+    def __repr__(self):
+        return f'PacketFilter({self.expression!r}, {self.start!r}, {self.end!r})'
+
+    def __getstate__(self):
+        return {'expression': self.expression, 'start': self.start,
+                'end': self.end}
+
+    def __setstate__(self, state):
+        self.__init__(**state)
+
+
+# Boiler Plate
+if __name__ == '__main__':
+    print("[!]Nothing to run here.")
@@ -0,0 +1,336 @@
+# Script:   flow_modules.py
+# Desc:     Bidirectional flow table with per flow statistics
+# Author:   Jacob Connell Nov 2019
+# Note: Run setup.py before use!
+
+import bisect
+import copy
+import heapq
+from array import array
+from collections import OrderedDict
+from prettytable import PrettyTable
+from core_modules import save_lines
+from export_modules import FLOAT, INT, STRING
+from packet_modules import IP_PROTO_TCP, TH_FIN, TH_RST, endpoint_str, \
+    ip_to_str
+
+TCP_FLAG_NAMES = 'FSRPAUEC'
+
+
+def flag_string(flags):
+    '''Returns TCP flags as letters, e.g. SAF for SYN, ACK and FIN'''
+    return ''.join(name for bit, name in enumerate(TCP_FLAG_NAMES)
+                   if flags & (1 << bit))
+
+
+class Flow:
+    '''Statistics of one flow. src/sport is the side that sent the
+    first packet and the fwd counters are for that direction'''
+    __slots__ = ('proto', 'src', 'sport', 'dst', 'dport', 'first_ts',
+                 'last_ts', 'packets_fwd', 'packets_rev', 'bytes_fwd',
+                 'bytes_rev', 'flags', 'fin_fwd', 'fin_rev')
+
+    def __init__(self, pkt):
+        self.proto = pkt.p
+        self.src = pkt.src
+        self.sport = pkt.sport
+        self.dst = pkt.dst
+        self.dport = pkt.dport
+        self.first_ts = pkt.ts
+        self.last_ts = pkt.ts
+        self.packets_fwd = 0
+        self.packets_rev = 0
+        self.bytes_fwd = 0
+        self.bytes_rev = 0
+        self.flags = 0
+        self.fin_fwd = False
+        self.fin_rev = False
+
+    def add(self, pkt):
+        '''Counts a packet in the direction it travelled'''
+        if pkt.ts > self.last_ts:
+            self.last_ts = pkt.ts
+        elif pkt.ts < self.first_ts:
+            self.first_ts = pkt.ts
+        forward = pkt.src == self.src and pkt.sport == self.sport
+        if forward:
+            self.packets_fwd += 1
+            self.bytes_fwd += pkt.length
+        else:
+            self.packets_rev += 1
+            self.bytes_rev += pkt.length
+        self.flags |= pkt.flags
+        if pkt.flags & TH_FIN:
+            if forward:
+                self.fin_fwd = True
+            else:
+                self.fin_rev = True
+
+    @classmethod
+    def from_record(cls, record):
+        '''Returns the flow of an expired record'''
+        flow = cls.__new__(cls)
+        (flow.src, flow.sport, flow.dst, flow.dport, flow.proto,
+         flow.first_ts, flow.last_ts, flow.packets_fwd, flow.packets_rev,
+         flow.bytes_fwd, flow.bytes_rev, flow.flags, reason) = record
+        flow.fin_fwd = flow.fin_rev = False
+        return flow
+
+    def join(self, later):
+        '''Adds the counters of a later part of the same flow, e.g. from
+        the next shard, keeping the direction of this one'''
+        self.first_ts = min(self.first_ts, later.first_ts)
+        self.last_ts = max(self.last_ts, later.last_ts)
+        if later.src == self.src and later.sport == self.sport:
+            self.packets_fwd += later.packets_fwd
+            self.packets_rev += later.packets_rev
+            self.bytes_fwd += later.bytes_fwd
+            self.bytes_rev += later.bytes_rev
+            self.fin_fwd = self.fin_fwd or later.fin_fwd
+            self.fin_rev = self.fin_rev or later.fin_rev
+        else:
+            self.packets_fwd += later.packets_rev
+            self.packets_rev += later.packets_fwd
+            self.bytes_fwd += later.bytes_rev
+            self.bytes_rev += later.bytes_fwd
+            self.fin_fwd = self.fin_fwd or later.fin_rev
+            self.fin_rev = self.fin_rev or later.fin_fwd
+        self.flags |= later.flags
+
+    def record(self, reason):
+        '''Returns the flow as a compact tuple for output'''
+        return (self.src, self.sport, self.dst, self.dport, self.proto,
+                self.first_ts, self.last_ts, self.packets_fwd,
+                self.packets_rev, self.bytes_fwd, self.bytes_rev,
+                self.flags, reason)
+
+
+def flow_key(pkt):
+    '''Returns the direction independent 5-tuple of a packet'''
+    a = (pkt.src, pkt.sport)
+    b = (pkt.dst, pkt.dport)
+    return (pkt.p,) + (a + b if a <= b else b + a)
+
+
+def record_key(record):
+    '''Returns the direction independent 5-tuple of a flow record'''
+    a = (record[0], record[1])
+    b = (record[2], record[3])
+    return (record[4],) + (a + b if a <= b else b + a)
+
+
+class FlowTable:
+    '''Tracks flows keyed on the normalised 5-tuple and expires them as
+    records after idle_timeout seconds without packets, after
+    active_timeout seconds in total, or when a TCP flow is reset or
+    closed from both sides.
+
+    New flows wait in an embryonic table until a second packet is
+    seen. When max_flows are tracked the oldest embryonic flow is
+    expired first, so a SYN scan cannot push out established flows.
+    At most max_records expired flows are kept, later ones are only
+    counted in dropped'''
+    protocols = None
+    version = 2
+
+    def __init__(self, idle_timeout=60, active_timeout=1800, max_flows=200000,
+                 max_records=1000000):
+        self.idle_timeout = idle_timeout
+        self.active_timeout = active_timeout
+        self.max_flows = max_flows
+        self.max_records = max_records
+        # Both ordered by last activity so the oldest flow is first
+        self.embryonic = OrderedDict()
+        self.established = OrderedDict()
+        self.records = []
+        self.evicted = 0
+        self.dropped = 0
+        self.last_sweep = 0
+        self.next_sweep = 0
+        # Times of every sweep, so merge can tell which flows a single
+        # table would have expired between shards
+        self.sweeps = array('d')
+
+    def add_packet(self, pkt):
+        '''Adds the packet to its flow'''
+        key = flow_key(pkt)
+        flow = self.established.get(key)
+        if flow is not None:
+            self.established.move_to_end(key)
+        else:
+            flow = self.embryonic.pop(key, None)
+            if flow is None:
+                if len(self.embryonic) + len(self.established) >= self.max_flows:
+                    self.evict()
+                flow = Flow(pkt)
+                self.embryonic[key] = flow
+            else:
+                self.established[key] = flow
+        if pkt.ts - flow.first_ts >= self.active_timeout:
+            self.expire(key, 'active')
+            flow = Flow(pkt)
+            self.embryonic[key] = flow
+        flow.add(pkt)
+        if flow.proto == IP_PROTO_TCP and (pkt.flags & TH_RST or
+                                           (flow.fin_fwd and flow.fin_rev)):
+            self.expire(key, 'closed')
+        # Sweeps on the first packet of every second, so shards of a
+        # capture sweep at the same times as a single table
+        if pkt.ts >= self.next_sweep:
+            self.sweep(pkt.ts)
+
+    def expire(self, key, reason):
+        '''Removes a flow and keeps its record'''
+        flow = self.established.pop(key, None) or self.embryonic.pop(key)
+        if len(self.records) < self.max_records:
+            self.records.append(flow.record(reason))
+        else:
+            self.dropped += 1
+
+    def evict(self):
+        '''Expires the oldest flow, embryonic ones first'''
+        self.evicted += 1
+        table = self.embryonic if self.embryonic else self.established
+        self.expire(next(iter(table)), 'evicted')
+
+    def sweep(self, ts):
+        '''Expires flows that have been idle for too long'''
+        self.last_sweep = ts
+        self.next_sweep = int(ts) + 1
+        self.sweeps.append(ts)
+        for table in (self.embryonic, self.established):
+            while table:
+                key, flow = next(iter(table.items()))
+                if ts - flow.last_ts < self.idle_timeout:
+                    break
+                self.expire(key, 'idle')
+
+    def flush(self):
+        '''Expires every flow still being tracked'''
+        for table in (self.embryonic, self.established):
+            while table:
+                self.expire(next(iter(table)), 'end')
+
+    def merge(self, other):
+        '''Adds the flows of the FlowTable of the next shard. A flow
+        still open at the end of this shard is joined with the first
+        flow of the same key in the other shard, unless a sweep of the
+        other shard found it idle in between, so flows crossing shards
+        are counted once. The other table is left as it was'''
+        records = list(other.records)
+        embryonic = OrderedDict((key, copy.copy(flow))
+                                for key, flow in other.embryonic.items())
+        established = OrderedDict((key, copy.copy(flow))
+                                  for key, flow in other.established.items())
+        first = {}
+        for index, record in enumerate(records):
+            first.setdefault(record_key(record), index)
+        for table in (self.embryonic, self.established):
+            for key, flow in list(table.items()):
+                index = first.get(key)
+                later = established.get(key) or embryonic.get(key)
+                if index is not None:
+                    later = Flow.from_record(records[index])
+                if later is None:
+                    continue
+                sweep = bisect.bisect_left(other.sweeps,
+                                           flow.last_ts + self.idle_timeout)
+                if sweep < len(other.sweeps) and \
+                        other.sweeps[sweep] < later.first_ts:
+                    self.expire(key, 'idle')
+                    continue
+                del table[key]
+                flow.join(later)
+                if index is not None:
+                    records[index] = flow.record(records[index][-1])
+                elif flow.proto == IP_PROTO_TCP and flow.fin_fwd and \
+                        flow.fin_rev:
+                    established.pop(key, None)
+                    embryonic.pop(key, None)
+                    records.append(flow.record('closed'))
+                # Keeps the place of the later part, which is ordered
+                # by its last activity
+                elif key in established:
+                    established[key] = flow
+                else:
+                    embryonic[key] = flow
+        room = max(self.max_records - len(self.records), 0)
+        self.records.extend(records[:room])
+        self.dropped += other.dropped + max(len(records) - room, 0)
+        self.embryonic.update(embryonic)
+        self.established.update(established)
+        self.evicted += other.evicted
+        self.sweeps.extend(other.sweeps)
+        # Flows of this shard that the other shard never saw again
+        self.sweep(max(self.last_sweep, other.last_sweep))
+        while len(self.embryonic) + len(self.established) > self.max_flows:
+            self.evict()
+
+    def tables(self):
+        '''Yields the flow records as an export table'''
+        self.flush()
+        yield ('flows', [('src', STRING), ('sport', INT), ('dst', STRING),
+                         ('dport', INT), ('proto', INT), ('first_ts', FLOAT),
+                         ('last_ts', FLOAT), ('packets_fwd', INT),
+                         ('packets_rev', INT), ('bytes_fwd', INT),
+                         ('bytes_rev', INT), ('tcp_flags', STRING),
+                         ('end', STRING)],
+               ((ip_to_str(src), sport, ip_to_str(dst), dport,
+                 proto, first_ts, last_ts, packets_fwd, packets_rev,
+                 bytes_fwd, bytes_rev, flag_string(flags), reason)
+                for (src, sport, dst, dport, proto, first_ts, last_ts,
+                     packets_fwd, packets_rev, bytes_fwd, bytes_rev, flags,
+                     reason) in self.records))
+
+    def get_rows(self):
+        '''Yields each flow record as a dict'''
+        self.flush()
+        for (src, sport, dst, dport, proto, first_ts, last_ts, packets_fwd,
+             packets_rev, bytes_fwd, bytes_rev, flags, reason) in self.records:
+            yield {'src': ip_to_str(src), 'sport': sport,
+                   'dst': ip_to_str(dst), 'dport': dport,
+                   'proto': proto, 'first_ts': first_ts, 'last_ts': last_ts,
+                   'duration': last_ts - first_ts,
+                   'packets_fwd': packets_fwd, 'packets_rev': packets_rev,
+                   'bytes_fwd': bytes_fwd, 'bytes_rev': bytes_rev,
+                   'tcp_flags': flag_string(flags), 'end': reason}
+
+    def print_table(self, top=20):
+        '''Prints the largest flows'''
+        self.flush()
+        table = PrettyTable(['Source', 'Destination', 'Proto', 'Packets',
+                             'Bytes', 'Duration', 'Flags', 'End'])
+        largest = heapq.nlargest(top, self.records, key=lambda r: r[9] + r[10])
+        for (src, sport, dst, dport, proto, first_ts, last_ts, packets_fwd,
+             packets_rev, bytes_fwd, bytes_rev, flags, reason) in largest:
+            table.add_row([endpoint_str(src, sport),
+                           endpoint_str(dst, dport), proto,
+                           packets_fwd + packets_rev, bytes_fwd + bytes_rev,
+                           round(last_ts - first_ts, 3), flag_string(flags),
+                           reason])
+        print(f'[!] Displaying the {len(largest)} largest of '
+              f'{len(self.records)} flows...\n')
+        print(table)
+        if self.evicted:
+            print(f'[!] {self.evicted} flows were expired early to stay '
+                  f'under {self.max_flows} flows')
+        if self.dropped:
+            print(f'[!] {self.dropped} flows were not recorded to stay '
+                  f'under {self.max_records} flow records')
+
+    def report_files(self, file_path):
+        '''Returns the (name, job) pairs that save the report files'''
+        return [('Flow Table', lambda: save_lines(self.get_rows(),
+                                                  'Flow Table', file_path))]
+
+    def output(self, file_path, top=20):
+        '''Outputs the largest flows and saves every flow record'''
+        print("\n[!] Creating Flow Table...")
+        self.print_table(top)
+        print("\n[!] Saving Flow Table...")
+        save_lines(self.get_rows(), 'Flow Table', file_path)
+
+
+# Boiler Plate
+if __name__ == '__main__':
+    print("[!]Nothing to run here.")
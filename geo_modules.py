@@ -0,0 +1,249 @@
+# Script:   geo_modules.py
+# Desc:     Local GeoLite2 lookups with a bounded, persistent cache and
+#           streaming KML and GeoJSON map writers
+# Author:   Jacob Connell Nov 2019
+# Note: Run setup.py before use!
+
+import ipaddress
+import json
+import os
+from collections import OrderedDict
+from html import escape
+from core_modules import replace_file
+
+DEFAULT_GEO_DB = os.environ.get('GEOIP_DB', 'GeoLite2-City.mmdb')
+DEFAULT_GEO_CACHE = os.path.join(os.path.expanduser('~'), '.cache',
+                                 'pcap_analyser', 'geoip.json')
+# Addresses listed in the description of a clustered point
+CLUSTER_NAMES = 10
+# Addresses looked up together by the map
+LOOKUP_BATCH = 4096
+
+
+def is_public(address):
+    '''Checks if a dotted address is globally routable. Private,
+    loopback, multicast and reserved ranges have no location'''
+    try:
+        ip = ipaddress.ip_address(address)
+    except ValueError:
+        return False
+    return ip.is_global and not ip.is_multicast
+
+
+class GeoLookup:
+    '''Looks up locations from a local GeoLite2 City database. The
+    database is memory mapped and opened once, and results go through
+    an LRU cache that is saved between runs. The cache is dropped when
+    the database build changes. geoip2 is only imported when a
+    database is opened'''
+    def __init__(self, db_path=DEFAULT_GEO_DB, cache_path=DEFAULT_GEO_CACHE,
+                 max_entries=200000):
+        import geoip2.database
+        import geoip2.errors
+        self.not_found = geoip2.errors.AddressNotFoundError
+        self.reader = geoip2.database.Reader(db_path,
+                                             mode=geoip2.database.MODE_MMAP)
+        self.build = self.reader.metadata().build_epoch
+        self.cache_path = cache_path
+        self.max_entries = max_entries
+        self.cache = OrderedDict()
+        self.load_cache()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def load_cache(self):
+        '''Loads the lookups saved by earlier runs'''
+        if not self.cache_path:
+            return
+        try:
+            with open(self.cache_path) as f:
+                saved = json.load(f)
+        except (OSError, ValueError):
+            return
+        if saved.get('build') == self.build:
+            self.cache.update(saved['locations'])
+
+    def save_cache(self):
+        '''Saves the cached lookups for later runs'''
+        if not self.cache_path:
+            return
+        os.makedirs(os.path.dirname(self.cache_path) or '.', exist_ok=True)
+        with replace_file(self.cache_path) as f:
+            json.dump({'build': self.build, 'locations': self.cache}, f)
+
+    def lookup(self, address):
+        '''Returns the location of a dotted address as a dict with
+        country, city, longitude and latitude, or None'''
+        if address in self.cache:
+            self.cache.move_to_end(address)
+            return self.cache[address]
+        if not is_public(address):
+            return None
+        return self.read(address)
+
+    def lookup_many(self, addresses):
+        '''Returns the locations of several dotted addresses keyed by
+        address. Repeated addresses are looked up once and cached ones
+        are answered first. The rest are read from the database in
+        address order, so neighbouring addresses share the tree nodes
+        and pages already read'''
+        locations = {}
+        misses = []
+        for address in addresses:
+            if address in locations:
+                continue
+            if address in self.cache:
+                self.cache.move_to_end(address)
+                locations[address] = self.cache[address]
+            else:
+                locations[address] = None
+                if is_public(address):
+                    ip = ipaddress.ip_address(address)
+                    # IPv4 addresses sort before IPv6 ones
+                    misses.append(((ip.version, ip), address))
+        for key, address in sorted(misses):
+            locations[address] = self.read(address)
+        return locations
+
+    def read(self, address):
+        '''Reads the location of a public address from the database
+        and caches it'''
+        try:
+            rec = self.reader.city(address)
+            location = {"country": rec.country.name or "",
+                        "city": rec.city.name or "",
+                        "longitude": rec.location.longitude,
+                        "latitude": rec.location.latitude}
+            if location["longitude"] is None or location["latitude"] is None:
+                location = None
+        except self.not_found:
+            location = None
+        self.cache[address] = location
+        if len(self.cache) > self.max_entries:
+            self.cache.popitem(last=False)
+        return location
+
+    def close(self):
+        '''Saves the cache and closes the database'''
+        self.save_cache()
+        self.reader.close()
+
+
+class KmlWriter:
+    '''Writes map points to a KML document as they are added'''
+    extension = 'kml'
+
+    def __init__(self, path):
+        self.file = open(path, 'w', encoding='utf-8')
+        self.file.write('<?xml version="1.0" encoding="UTF-8"?>\n'
+                        '<kml xmlns="http://www.opengis.net/kml/2.2">\n'
+                        '<Document>\n')
+
+    def write_point(self, name, longitude, latitude, description, data):
+        '''Writes a placemark with the data dict as extended data'''
+        extended = ''.join(f'<Data name="{escape(key)}"><value>'
+                           f'{escape(str(value))}</value></Data>'
+                           for key, value in data.items())
+        self.file.write(f'<Placemark><name>{escape(name)}</name>'
+                        f'<description>{escape(description)}</description>'
+                        f'<ExtendedData>{extended}</ExtendedData>'
+                        f'<Point><coordinates>{longitude},{latitude},0.0'
+                        '</coordinates></Point></Placemark>\n')
+
+    def close(self):
+        self.file.write('</Document>\n</kml>\n')
+        self.file.close()
+
+
+class GeoJsonWriter:
+    '''Writes map points to a GeoJSON feature collection as they are
+    added'''
+    extension = 'geojson'
+
+    def __init__(self, path):
+        self.file = open(path, 'w', encoding='utf-8')
+        self.file.write('{"type": "FeatureCollection", "features": [\n')
+        self.separator = ''
+
+    def write_point(self, name, longitude, latitude, description, data):
+        '''Writes a point feature with the data dict as properties'''
+        feature = {'type': 'Feature',
+                   'geometry': {'type': 'Point',
+                                'coordinates': [longitude, latitude]},
+                   'properties': dict(name=name, description=description,
+                                      **data)}
+        self.file.write(self.separator + json.dumps(feature))
+        self.separator = ',\n'
+
+    def close(self):
+        self.file.write('\n]}\n')
+        self.file.close()
+
+
+GEO_WRITERS = {'kml': KmlWriter, 'geojson': GeoJsonWriter}
+
+
+def write_map(points, path, formats=('kml',), cluster=False):
+    '''Streams (address, location, packets, bytes) points to a map file
+    per format, path being the file name without its extension. With
+    cluster set the addresses sharing coordinates become one point
+    weighted by their traffic, so memory grows with the number of
+    places rather than hosts. Returns the number of points written'''
+    writers = [GEO_WRITERS[geo_format](f'{path}.{geo_format}')
+               for geo_format in formats]
+    written = 0
+    try:
+        if cluster:
+            points = cluster_points(points)
+        for address, location, packets, volume, *hosts in points:
+            place = ' '.join(filter(None, (location['city'],
+                                           location['country'])))
+            data = {'packets': packets, 'bytes': volume}
+            description = place
+            if hosts:
+                count, names = hosts
+                data = dict(hosts=count, addresses=names, **data)
+                if count > 1:
+                    description = f'{count} hosts in {place or "unknown"}: ' \
+                        + ', '.join(names) + \
+                        (', ...' if count > len(names) else '')
+            description += f' ({packets} packets, {volume} bytes)'
+            for writer in writers:
+                writer.write_point(address, location['longitude'],
+                                   location['latitude'], description, data)
+            written += 1
+    finally:
+        for writer in writers:
+            writer.close()
+    return written
+
+
+def cluster_points(points):
+    '''Groups points by coordinates. Yields (label, location, packets,
+    bytes, hosts, addresses) for each place, heaviest first, listing
+    its first CLUSTER_NAMES addresses'''
+    places = {}
+    for address, location, packets, volume in points:
+        key = (location['longitude'], location['latitude'])
+        place = places.get(key)
+        if place is None:
+            places[key] = [location, packets, volume, 1, [address]]
+            continue
+        place[1] += packets
+        place[2] += volume
+        place[3] += 1
+        if len(place[4]) < CLUSTER_NAMES:
+            place[4].append(address)
+    for location, packets, volume, count, names in sorted(
+            places.values(), key=lambda place: place[1], reverse=True):
+        label = names[0] if count == 1 else f'{count} hosts'
+        yield label, location, packets, volume, count, names
+
+
+# Boiler Plate
+if __name__ == '__main__':
+    print("[!]Nothing to run here.")
@@ -0,0 +1,163 @@
+# Script:   graph_modules.py
+# Desc:     Host aggregation, pruning and streamed export of the node graph
+# Author:   Jacob Connell Nov 2019
+# Note: Run setup.py before use!
+
+import heapq
+import os
+from collections import deque
+from html import escape
+from packet_modules import ip_to_str
+
+DEFAULT_ASN_DB = os.environ.get('GEOIP_ASN_DB', 'GeoLite2-ASN.mmdb')
+AGGREGATES = ('none', '24', 'asn')
+
+
+def subnet_label(address):
+    '''Returns the /24 network of a raw IPv4 address, or the /64 of an
+    IPv6 one'''
+    if len(address) == 4:
+        return ip_to_str(address[:3] + b'\0') + '/24'
+    return ip_to_str(address[:8] + bytes(8)) + '/64'
+
+
+class AsnLabeler:
+    '''Labels raw addresses with their autonomous system from a local
+    GeoLite2 ASN database. Addresses without an AS, such as private
+    ones, fall back to their subnet'''
+    def __init__(self, db_path=DEFAULT_ASN_DB):
+        import geoip2.database
+        import geoip2.errors
+        self.not_found = geoip2.errors.AddressNotFoundError
+        self.reader = geoip2.database.Reader(db_path,
+                                             mode=geoip2.database.MODE_MMAP)
+        self.labels = {}
+
+    def __call__(self, address):
+        label = self.labels.get(address)
+        if label is None:
+            try:
+                rec = self.reader.asn(ip_to_str(address))
+                label = f'AS{rec.autonomous_system_number} ' \
+                        f'{rec.autonomous_system_organization or ""}'.strip()
+            except (self.not_found, ValueError):
+                label = subnet_label(address)
+            self.labels[address] = label
+        return label
+
+    def close(self):
+        self.reader.close()
+
+
+def labeler(aggregate='none', asn_db=DEFAULT_ASN_DB):
+    '''Returns the function that names the graph node of a raw address'''
+    if aggregate == '24':
+        return subnet_label
+    if aggregate == 'asn':
+        return AsnLabeler(asn_db)
+    return ip_to_str
+
+
+def edge_weights(network_map, label=ip_to_str):
+    '''Yields (src, dst, weight) edges of the network map with each
+    address replaced by its label. Edges that meet after aggregation
+    are added together'''
+    if label is ip_to_str:
+        for src, dsts in network_map.items():
+            for dst, count in dsts.items():
+                yield ip_to_str(src), ip_to_str(dst), count
+        return
+    edges = {}
+    for src, dsts in network_map.items():
+        src_label = label(src)
+        for dst, count in dsts.items():
+            key = (src_label, label(dst))
+            edges[key] = edges.get(key, 0) + count
+    for (src, dst), count in edges.items():
+        yield src, dst, count
+
+
+def top_edges(edges, n):
+    '''Returns the n heaviest edges'''
+    return heapq.nlargest(n, edges, key=lambda edge: edge[2])
+
+
+def k_core(edges, k):
+    '''Returns the edges between nodes of the k-core, the largest
+    subgraph where every node has at least k neighbours. Nodes are
+    peeled off in linear time, ignoring direction and self loops'''
+    edges = list(edges)
+    neighbours = {}
+    for src, dst, weight in edges:
+        if src != dst:
+            neighbours.setdefault(src, set()).add(dst)
+            neighbours.setdefault(dst, set()).add(src)
+    degree = {node: len(adjacent) for node, adjacent in neighbours.items()}
+    queue = deque(node for node, d in degree.items() if d < k)
+    removed = set(queue)
+    while queue:
+        node = queue.popleft()
+        for adjacent in neighbours[node]:
+            if adjacent not in removed:
+                degree[adjacent] -= 1
+                if degree[adjacent] < k:
+                    removed.add(adjacent)
+                    queue.append(adjacent)
+    return [edge for edge in edges if edge[0] in degree and edge[1] in degree
+            and edge[0] not in removed and edge[1] not in removed]
+
+
+def quoteattr(value):
+    '''Returns value escaped and quoted as an XML attribute'''
+    return f'"{escape(value)}"'
+
+
+def write_graphml(edges, path):
+    '''Streams edges, a function returning an edge iterator, to a
+    GraphML file. Nodes are written the first time they are seen so
+    only their names are kept in memory'''
+    seen = set()
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write('<?xml version="1.0" encoding="UTF-8"?>\n'
+                '<graphml xmlns="http://graphml.graphdrawing.org/xmlns">\n'
+                '<key id="weight" for="edge" attr.name="weight" '
+                'attr.type="long"/>\n'
+                '<graph id="network" edgedefault="directed">\n')
+        for src, dst, weight in edges():
+            for node in (src, dst):
+                if node not in seen:
+                    seen.add(node)
+                    f.write(f'<node id={quoteattr(node)}/>\n')
+            f.write(f'<edge source={quoteattr(src)} target={quoteattr(dst)}>'
+                    f'<data key="weight">{weight}</data></edge>\n')
+        f.write('</graph>\n</graphml>\n')
+
+
+def write_gexf(edges, path):
+    '''Streams edges, a function returning an edge iterator, to a GEXF
+    file. GEXF lists the nodes before the edges so the edges are read
+    twice'''
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write('<?xml version="1.0" encoding="UTF-8"?>\n'
+                '<gexf xmlns="http://gexf.net/1.3" version="1.3">\n'
+                '<graph defaultedgetype="directed">\n<nodes>\n')
+        seen = set()
+        for src, dst, weight in edges():
+            for node in (src, dst):
+                if node not in seen:
+                    seen.add(node)
+                    node = escape(node)
+                    f.write(f'<node id="{node}" label="{node}"/>\n')
+        f.write('</nodes>\n<edges>\n')
+        for number, (src, dst, weight) in enumerate(edges()):
+            f.write(f'<edge id="{number}" source={quoteattr(src)} '
+                    f'target={quoteattr(dst)} weight="{weight}"/>\n')
+        f.write('</edges>\n</graph>\n</gexf>\n')
+
+
+GRAPH_WRITERS = {'graphml': write_graphml, 'gexf': write_gexf}
+
+
+# Boiler Plate
+if __name__ == '__main__':
+    print("[!]Nothing to run here.")
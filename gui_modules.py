@@ -0,0 +1,106 @@
+# Script:   gui_modules.py
+# Desc:     Tkinter GUI for PCAP_Analyser, only imported when the GUI
+#           is started so headless runs never load tkinter
+# Author:   Jacob Connell Nov 2019
+# Note: Run setup.py before use!
+
+from tkinter import *
+from tkinter import messagebox
+from tkinter.filedialog import askopenfilename
+from cache_modules import AnalysisCache
+from filter_modules import PacketFilter, parse_time
+
+
+class Window(object):
+    '''Creates and displays GUI'''
+    def __init__(self, window, run_program):
+
+        self.window = window
+        self.run_program = run_program
+
+        self.window.wm_title("PCAP Analyser")
+
+        l1 = Label(window, text="PCAP File")
+        l1.grid(row=0, column=0)
+
+        self.file_text = StringVar()
+        self.file1 = Entry(window, textvariable=self.file_text, width=60)
+        self.file1.grid(row=0, column=1)
+
+        b1 = Button(window, text="Browse", width=12, command=self.find_file)
+        b1.grid(row=0, column=2)
+
+        l2 = Label(window, text="New Directory Name")
+        l2.grid(row=1, column=0, padx=30)
+
+        self.folder_text = StringVar()
+        self.folder1 = Entry(window, textvariable=self.folder_text, width=20)
+        self.folder1.grid(row=2, column=0)
+
+        l3 = Label(window, text="Filter (e.g. tcp port 80)")
+        l3.grid(row=1, column=1)
+
+        self.filter_text = StringVar()
+        self.filter1 = Entry(window, textvariable=self.filter_text, width=40)
+        self.filter1.grid(row=2, column=1)
+
+        b3 = Button(window, text="Analyses File", width=12,
+                    command=self.go_command)
+        b3.grid(row=2, column=2)
+
+        l4 = Label(window, text="From (epoch or ISO 8601 UTC)")
+        l4.grid(row=3, column=0, padx=30)
+
+        self.start_text = StringVar()
+        self.start1 = Entry(window, textvariable=self.start_text, width=20)
+        self.start1.grid(row=4, column=0)
+
+        l5 = Label(window, text="To (epoch or ISO 8601 UTC)")
+        l5.grid(row=3, column=1)
+
+        self.end_text = StringVar()
+        self.end1 = Entry(window, textvariable=self.end_text, width=20)
+        self.end1.grid(row=4, column=1)
+
+    def find_file(self):
+        '''Opens file browser for PCAP'''
+        name = askopenfilename(initialdir="C:",
+                               filetypes=(("PCAP", "*.pcap *.pcapng"),
+                            ("All Files", "*.*")), title="Choose a file.")
+        self.file_text.set(name)
+
+    def go_command(self):
+        '''Runs the main program'''
+        if (len(self.file_text.get())) > 0:
+            if (len(self.folder_text.get())) > 0:
+                try:
+                    start = self.start_text.get().strip()
+                    end = self.end_text.get().strip()
+                    packet_filter = PacketFilter(
+                        self.filter_text.get(),
+                        parse_time(start) if start else None,
+                        parse_time(end) if end else None)
+                except ValueError as error:
+                    messagebox.showwarning("Error", f'Error - {error}')
+                    return
+                self.window.destroy()
+                self.run_program(self.file_text.get(), self.folder_text.get(),
+                                 cache=AnalysisCache(),
+                                 packet_filter=packet_filter)
+            else:
+                messagebox.showwarning("Error", "Error - Invalid Folder Name")
+        else:
+            messagebox.showwarning("Error", "Error - Invalid File Path!")
+
+
+def start_gui(run_program):
+    '''Displays the GUI until a file is analysed by run_program or
+    the window is closed'''
+    window = Tk()
+    Window(window, run_program)
+    window.mainloop()
+
+
+# Boiler Plate
+if __name__ == '__main__':
+    print("[!]Nothing to run here.")
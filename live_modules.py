@@ -0,0 +1,198 @@
+# Script:   live_modules.py
+# Desc:     Rolling window analysis of a live or growing capture
+# Author:   Jacob Connell Nov 2019
+# Note: Run setup.py before use!
+
+import datetime
+import json
+from collections import OrderedDict, deque
+from packet_modules import LINKTYPE_ETHERNET, Dispatcher, ip_to_str
+from parse_modules import ANALYSERS, create_analysers
+from reader_modules import PcapStream
+from stream_modules import StreamReassembler
+
+LIVE_ANALYSERS = ('summary', 'traffic', 'flow', 'emails', 'images')
+
+
+class PaneConsumer:
+    '''Stands in for a stream analyser in the reassembler, which lives
+    across panes, and passes messages to the analyser of the current
+    pane'''
+    def __init__(self, windows, name):
+        self.windows = windows
+        self.name = name
+
+    def wants_stream(self, pkt):
+        return self.windows.pane[self.name].wants_stream(pkt)
+
+    def split_messages(self, buffer, final=False):
+        return self.windows.pane[self.name].split_messages(buffer, final)
+
+    def add_message(self, flow, ts, message):
+        self.windows.pane[self.name].add_message(flow, ts, message)
+
+
+class RollingWindows:
+    '''Runs the analysers over time windows of window seconds that
+    move on every slide seconds (tumbling when slide equals window).
+    Packets go into panes of slide seconds, each with its own
+    analysers, and a window is the merge of its last window / slide
+    panes. Older panes are dropped so memory stays bounded. A summary
+    of each window is passed to emit. Frames are decoded for the pcap
+    link type in linktype'''
+    def __init__(self, emit, names=LIVE_ANALYSERS, window=60, slide=None,
+                 options=None, top=10, max_seen=100000,
+                 linktype=LINKTYPE_ETHERNET):
+        self.slide = slide or window
+        if window < self.slide or window % self.slide:
+            raise ValueError("The window must be a multiple of the slide")
+        self.emit = emit
+        self.names = list(names)
+        self.options = options or {}
+        self.top = top
+        self.max_seen = max_seen
+        self.linktype = linktype
+        self.panes = deque(maxlen=int(window // self.slide))
+        self.seen_emails = OrderedDict()
+        self.error_count = 0
+        self.pane = None
+        self.pane_start = None
+        self.reassembler = StreamReassembler(**self.options.get('streams', {}))
+        for name in self.names:
+            if getattr(ANALYSERS[name], 'streams', False):
+                self.reassembler.subscribe(PaneConsumer(self, name))
+
+    def new_pane(self, start):
+        '''Starts the analysers of the next pane'''
+        self.pane = create_analysers(self.names, self.options)
+        self.pane_start = start
+        self.pane_packets = 0
+        self.dispatcher = Dispatcher(self.linktype)
+        self.dispatcher.register(self.reassembler)
+        for analyser in self.pane.values():
+            if not getattr(analyser, 'streams', False):
+                self.dispatcher.register(analyser)
+
+    def add(self, ts, buf):
+        '''Adds a record, closing the panes it has moved past. Late
+        records go into the current pane'''
+        if self.pane is None:
+            self.new_pane(ts // self.slide * self.slide)
+        while ts >= self.pane_start + self.slide:
+            self.close_pane(ts)
+        self.dispatcher.dispatch(ts, buf)
+        self.pane_packets += 1
+
+    def close_pane(self, ts=None):
+        '''Ends the current pane and emits the window it completes.
+        Runs of empty windows are skipped'''
+        self.error_count += self.dispatcher.error_count
+        self.panes.append((self.pane_start, self.pane_packets, self.pane))
+        if any(packets for start, packets, pane in self.panes):
+            self.emit(self.summarise())
+            next_start = self.pane_start + self.slide
+        else:
+            self.panes.clear()
+            next_start = ts // self.slide * self.slide
+        self.new_pane(next_start)
+
+    def summarise(self):
+        '''Merges the panes of the window and returns its summary'''
+        merged = create_analysers(self.names, self.options)
+        for start, packets, pane in self.panes:
+            for name, analyser in merged.items():
+                analyser.merge(pane[name])
+        latest = self.panes[-1][2]
+        summary = {'start': self.panes[0][0],
+                   'end': self.pane_start + self.slide,
+                   'packets': sum(packets for start, packets, pane
+                                  in self.panes)}
+        if 'summary' in merged:
+            stats = merged['summary']
+            summary['protocols'] = {'TCP': stats.tcp_stats['counter'],
+                                    'UDP': stats.udp_stats['counter'],
+                                    'IGMP': stats.igmp_stats['counter'],
+                                    'other': stats.error_count}
+        if 'traffic' in merged:
+            talkers = sorted(merged['traffic'].rows(),
+                             key=lambda row: row[3], reverse=True)[:self.top]
+            summary['top_talkers'] = [
+                {'address': ip_to_str(address), 'sent': sent,
+                 'received': received}
+                for address, sent, received, total in talkers]
+        if 'flow' in merged:
+            flow = merged['flow']
+            summary['flow_bins'] = flow.get_dict()[flow.chart_width]
+        if 'emails' in latest:
+            summary['new_emails'] = self.new_emails(latest['emails'])
+        if 'images' in latest:
+            summary['image_uris'] = list(latest['images'].URIs)
+        return summary
+
+    def new_emails(self, emails):
+        '''Returns the addresses not seen in earlier panes'''
+        new = []
+        for key in emails.my_emails:
+            if key in self.seen_emails:
+                self.seen_emails.move_to_end(key)
+            else:
+                new.append(key)
+                self.seen_emails[key] = None
+                if len(self.seen_emails) > self.max_seen:
+                    self.seen_emails.popitem(last=False)
+        return new
+
+    def finish(self):
+        '''Delivers the open streams and emits the last window'''
+        if self.pane is not None:
+            self.reassembler.flush()
+            if self.pane_packets:
+                self.close_pane()
+
+
+def print_window(summary):
+    '''Prints a one line summary of a window'''
+    start = datetime.datetime.utcfromtimestamp(summary['start'])
+    end = datetime.datetime.utcfromtimestamp(summary['end'])
+    line = f'[!] {start:%H:%M:%S} - {end:%H:%M:%S}: ' \
+           f'{summary["packets"]} packets'
+    if summary.get('top_talkers'):
+        line += f', top talker {summary["top_talkers"][0]["address"]}'
+    if summary.get('new_emails'):
+        line += f', {len(summary["new_emails"])} new emails'
+    if summary.get('image_uris'):
+        line += f', {len(summary["image_uris"])} images'
+    print(line)
+
+
+def run_live(source, file_path, names=LIVE_ANALYSERS, window=60, slide=None,
+             options=None, idle_timeout=None, packet_filter=None):
+    '''Analyses a pcap stream from a pipe, stdin ('-') or a growing file
+    in rolling windows. Each window summary is printed and appended to
+    'Live Windows.jsonl' as soon as the window closes. Stops at the end
+    of a pipe, after idle_timeout seconds without data on a file, or on
+    Ctrl-C. Only records matching packet_filter are analysed. Returns
+    the number of undecodable packets'''
+    with open(f'{file_path}/Live Windows.jsonl', 'w') as json_file:
+        def emit(summary):
+            print_window(summary)
+            json_file.write(json.dumps(summary) + '\n')
+            json_file.flush()
+        with PcapStream(source, idle_timeout=idle_timeout) as stream:
+            windows = RollingWindows(emit, names, window, slide, options,
+                                     linktype=stream.linktype)
+            try:
+                records = iter(stream)
+                if packet_filter:
+                    records = packet_filter.apply(records, stream.linktype)
+                for ts, buf in records:
+                    windows.add(ts, buf)
+            except KeyboardInterrupt:
+                print("\n[!] Stopping...")
+        windows.finish()
+    return windows.error_count
+
+
+# Boiler Plate
+if __name__ == '__main__':
+    print("[!]Nothing to run here.")
@@ -0,0 +1,285 @@
+# Script:   metrics_modules.py
+# Desc:     Timing, progress, error and profiling instrumentation
+# Author:   Jacob Connell Nov 2019
+# Note: Run setup.py before use!
+
+import json
+import sys
+import threading
+import time
+from collections import Counter
+from packet_modules import Dispatcher
+
+
+def escape_label(value):
+    '''Escapes a Prometheus label value'''
+    return str(value).replace('\\', '\\\\').replace('"', '\\"') \
+        .replace('\n', '\\n')
+
+
+class Metrics:
+    '''Collects the counters of a run: packets and bytes analysed,
+    undecodable packets, failures by layer and reason, and with timing
+    set the time and calls spent in decoding and in each analyser.
+    Metrics from shards are combined with merge'''
+    def __init__(self, timing=False, progress=False):
+        self.timing = timing
+        self.progress = progress
+        self.packets = 0
+        self.bytes = 0
+        self.error_count = 0
+        self.errors = {}
+        # name -> [seconds, calls]
+        self.stages = {}
+        self.seconds = 0.0
+
+    def timed(self, name, handler):
+        '''Returns handler wrapped to add up its time and calls'''
+        stats = self.stages.setdefault(name, [0.0, 0])
+        clock = time.perf_counter
+
+        def timed_handler(*args):
+            start = clock()
+            try:
+                return handler(*args)
+            finally:
+                stats[0] += clock() - start
+                stats[1] += 1
+        return timed_handler
+
+    def dispatcher(self):
+        '''Returns a Dispatcher, instrumented when timing is set'''
+        return TimedDispatcher(self) if self.timing else Dispatcher()
+
+    def collect(self, dispatcher, seconds):
+        '''Adds the counters of a finished dispatcher'''
+        self.packets += dispatcher.packets
+        self.bytes += dispatcher.bytes
+        self.error_count += dispatcher.error_count
+        for key, count in dispatcher.errors.items():
+            self.errors[key] = self.errors.get(key, 0) + count
+        self.seconds += seconds
+
+    def merge(self, other, counters=True):
+        '''Adds the metrics of another shard. Shards run at the same
+        time so the slowest one gives the run time. Without counters
+        only the stage times are added, for a job that read packets
+        already counted'''
+        if counters:
+            self.packets += other.packets
+            self.bytes += other.bytes
+            self.error_count += other.error_count
+            for key, count in other.errors.items():
+                self.errors[key] = self.errors.get(key, 0) + count
+        for name, (seconds, calls) in other.stages.items():
+            stats = self.stages.setdefault(name, [0.0, 0])
+            stats[0] += seconds
+            stats[1] += calls
+        self.seconds = max(self.seconds, other.seconds)
+
+    def get_dict(self):
+        '''Returns the metrics as a json ready dict'''
+        errors = {}
+        for (layer, reason), count in sorted(self.errors.items()):
+            errors.setdefault(layer, {})[reason] = count
+        seconds = self.seconds or float('nan')
+        return {'packets': self.packets, 'bytes': self.bytes,
+                'seconds': round(self.seconds, 4),
+                'packets_per_sec': round(self.packets / seconds)
+                if self.seconds else None,
+                'bytes_per_sec': round(self.bytes / seconds)
+                if self.seconds else None,
+                'undecoded_packets': self.error_count, 'errors': errors,
+                'stages': {name: {'seconds': round(total, 4), 'calls': calls,
+                                  'mean_us': round(total / calls * 1E6, 3)
+                                  if calls else 0}
+                           for name, (total, calls) in sorted(
+                               self.stages.items(),
+                               key=lambda item: item[1][0], reverse=True)}}
+
+    def prometheus(self):
+        '''Returns the metrics in the Prometheus text format'''
+        lines = []
+
+        def metric(name, kind, help_text, samples):
+            lines.append(f'# HELP pcap_analyser_{name} {help_text}')
+            lines.append(f'# TYPE pcap_analyser_{name} {kind}')
+            for labels, value in samples:
+                label_text = ','.join(
+                    f'{key}="{escape_label(val)}"'
+                    for key, val in labels.items())
+                lines.append(f'pcap_analyser_{name}'
+                             f'{{{label_text}}} {value}' if labels else
+                             f'pcap_analyser_{name} {value}')
+        metric('packets_total', 'counter', "Packets analysed",
+               [({}, self.packets)])
+        metric('bytes_total', 'counter', "Bytes analysed", [({}, self.bytes)])
+        metric('run_seconds', 'gauge', "Time spent analysing",
+               [({}, round(self.seconds, 6))])
+        metric('undecoded_packets_total', 'counter',
+               "Packets that could not be decoded", [({}, self.error_count)])
+        metric('errors_total', 'counter', "Failures by layer and reason",
+               [({'layer': layer, 'reason': reason}, count)
+                for (layer, reason), count in sorted(self.errors.items())])
+        metric('stage_seconds_total', 'counter',
+               "Time spent in each stage",
+               [({'stage': name}, round(total, 6))
+                for name, (total, calls) in sorted(self.stages.items())])
+        metric('stage_calls_total', 'counter', "Calls to each stage",
+               [({'stage': name}, calls)
+                for name, (total, calls) in sorted(self.stages.items())])
+        return '\n'.join(lines) + '\n'
+
+    def output(self, file_path, prometheus=False):
+        '''Prints the slowest stages and failures and saves the metrics'''
+        metrics = self.get_dict()
+        if metrics['packets_per_sec'] is not None:
+            print(f'[!] Analysed {self.packets} packets in '
+                  f'{self.seconds:.2f}s ({metrics["packets_per_sec"]:,} '
+                  f'packets/s, {metrics["bytes_per_sec"] / 1E6:.1f} MB/s)')
+        for name, stats in metrics['stages'].items():
+            print(f'    {name}: {stats["seconds"]:.3f}s over '
+                  f'{stats["calls"]} calls')
+        for layer, reasons in metrics['errors'].items():
+            for reason, count in reasons.items():
+                print(f'    {count} failed at {layer}: {reason}')
+        with open(f'{file_path}/Metrics.json', 'w') as json_file:
+            json.dump(metrics, json_file)
+        if prometheus:
+            with open(f'{file_path}/metrics.prom', 'w') as prom_file:
+                prom_file.write(self.prometheus())
+
+
+class TimedDispatcher(Dispatcher):
+    '''Dispatcher that times decoding and every analyser'''
+    def __init__(self, metrics):
+        super().__init__()
+        self.metrics = metrics
+        self.decode = metrics.timed('decode', self.decode)
+
+    def wrap(self, name, handler):
+        return self.metrics.timed(name, handler)
+
+
+class TimedConsumer:
+    '''Stands in for a stream analyser in the reassembler and times the
+    messages passed to it'''
+    def __init__(self, consumer, metrics, name):
+        self.consumer = consumer
+        self.wants_stream = consumer.wants_stream
+        self.split_messages = consumer.split_messages
+        self.add_message = metrics.timed(name, consumer.add_message)
+
+
+class Progress:
+    '''Yields the (ts, buf) records of a capture byte range, or
+    (ts, buf, linktype) with linktypes set, and prints the progress,
+    rate and ETA from the file offset every interval seconds'''
+    def __init__(self, capture, start=None, end=None, interval=1.0,
+                 stream=sys.stderr, linktypes=False):
+        self.capture = capture
+        self.linktypes = linktypes
+        self.start = capture.first_record if start is None else start
+        self.end = capture.size if end is None else min(end, capture.size)
+        self.interval = interval
+        self.stream = stream
+
+    def __iter__(self):
+        clock = time.perf_counter
+        begin = last = clock()
+        count = 0
+        offset = self.start
+        linktypes = self.linktypes
+        for offset, ts, linktype, buf in self.capture.packets(self.start,
+                                                               self.end):
+            yield (ts, buf, linktype) if linktypes else (ts, buf)
+            count += 1
+            if not count & 4095:
+                now = clock()
+                if now - last >= self.interval:
+                    last = now
+                    self.report(count, offset, now - begin)
+        self.report(count, self.end, clock() - begin)
+        self.stream.write('\n')
+
+    def report(self, count, offset, elapsed):
+        '''Prints one progress line'''
+        done = offset - self.start
+        total = max(self.end - self.start, 1)
+        rate = done / elapsed if elapsed else 0
+        eta = (total - done) / rate if rate else 0
+        self.stream.write(f'\r[!] {done / total:6.1%} {count:,} packets '
+                          f'{count / max(elapsed, 1E-9):,.0f} packets/s '
+                          f'{rate / 1E6:.1f} MB/s '
+                          f'ETA {time.strftime("%H:%M:%S", time.gmtime(eta))}')
+        self.stream.flush()
+
+
+class SamplingProfiler:
+    '''Samples the stack of the calling thread every interval seconds
+    from a background thread and counts the innermost frames. Cheaper
+    than cProfile on long runs'''
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.samples = Counter()
+        self.thread_id = threading.get_ident()
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is not None:
+                code = frame.f_code
+                self.samples[f'{code.co_filename}:{frame.f_lineno} '
+                             f'{code.co_name}'] += 1
+
+    def __enter__(self):
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.stopped.set()
+        self.thread.join()
+
+    def save(self, path, top=50):
+        '''Saves the most sampled lines as json'''
+        total = sum(self.samples.values()) or 1
+        with open(path, 'w') as json_file:
+            json.dump([{'line': line, 'samples': count,
+                        'share': round(count / total, 4)}
+                       for line, count in self.samples.most_common(top)],
+                      json_file, indent=1)
+
+
+class Profiler:
+    '''Profiles a block with cProfile, or the sampling profiler when
+    mode is 'sample', and saves the result to path'''
+    def __init__(self, path, mode='cprofile'):
+        self.path = path
+        self.mode = mode
+
+    def __enter__(self):
+        if self.mode == 'sample':
+            self.profiler = SamplingProfiler().__enter__()
+        else:
+            import cProfile
+            self.profiler = cProfile.Profile()
+            self.profiler.enable()
+        return self
+
+    def __exit__(self, *exc):
+        if self.mode == 'sample':
+            self.profiler.__exit__(*exc)
+            self.profiler.save(self.path)
+        else:
+            self.profiler.disable()
+            self.profiler.dump_stats(self.path)
+            import pstats
+            pstats.Stats(self.profiler).sort_stats('cumulative').print_stats(15)
+        print(f'[!] Saved profile to {self.path}')
+
+
+# Boiler Plate
+if __name__ == '__main__':
+    print("[!]Nothing to run here.")
@@ -1,6 +1,7 @@
 py -m pip install prettytable
 py -m pip install matplotlib
 py -m pip install networkx
-py -m pip install simplekml
+py -m pip install numpy
+py -m pip install pyarrow
 py -m pip install dpkt
 py -m pip install geoip2
\ No newline at end of file
@@ -0,0 +1,309 @@
+# Script:   packet_modules.py
+# Desc:     Decodes each packet once and dispatches it to the analysers
+# Author:   Jacob Connell Nov 2019
+# Note: Run setup.py before use!
+
+import socket
+import struct
+
+# Bumped when decoding changes what the analysers see, so cached
+# results from an older decoder are not reused
+DECODER_VERSION = 2
+
+LINKTYPE_NULL = 0
+LINKTYPE_ETHERNET = 1
+LINKTYPE_RAW = 101
+LINKTYPE_LOOP = 108
+LINKTYPE_LINUX_SLL = 113
+LINKTYPE_IPV4 = 228
+LINKTYPE_IPV6 = 229
+LINKTYPE_LINUX_SLL2 = 276
+# Raw IP captures have no link header, OpenBSD and others number them
+# 12 or 14
+LINKTYPES_RAW = (LINKTYPE_RAW, LINKTYPE_IPV4, LINKTYPE_IPV6, 12, 14)
+LINKTYPES = (LINKTYPE_NULL, LINKTYPE_ETHERNET, LINKTYPE_LOOP,
+             LINKTYPE_LINUX_SLL, LINKTYPE_LINUX_SLL2) + LINKTYPES_RAW
+
+ETH_TYPE_IP = 0x0800
+ETH_TYPE_IP6 = 0x86dd
+# 802.1Q, 802.1ad and the older QinQ tag
+ETH_TYPES_VLAN = (0x8100, 0x88a8, 0x9100)
+# AF_INET6 in BSD loopback headers on Linux, NetBSD/OpenBSD, FreeBSD
+# and macOS
+AF_INET6_FAMILIES = (10, 24, 28, 30)
+
+TH_FIN = 0x01
+TH_SYN = 0x02
+TH_RST = 0x04
+IP_PROTO_ICMP = 1
+IP_PROTO_IGMP = 2
+IP_PROTO_TCP = 6
+IP_PROTO_UDP = 17
+IP_PROTO_FRAGMENT = 44
+IP_PROTO_AH = 51
+IP_PROTO_ICMP6 = 58
+# IPv6 extension headers skipped to reach the transport header
+IP6_EXTENSIONS = (0, 43, IP_PROTO_FRAGMENT, IP_PROTO_AH, 60, 135)
+
+
+def ip_to_str(address):
+    '''Returns the text form of a raw 4 or 16 byte address'''
+    if len(address) == 4:
+        return socket.inet_ntoa(address)
+    return socket.inet_ntop(socket.AF_INET6, address)
+
+
+def endpoint_str(address, port):
+    '''Returns address:port, with IPv6 addresses in brackets'''
+    if len(address) == 4:
+        return f'{socket.inet_ntoa(address)}:{port}'
+    return f'[{ip_to_str(address)}]:{port}'
+
+
+class Packet:
+    '''Lightweight record of the fields the analysers use, decoded once
+    per packet. Addresses are kept as raw 4 byte (IPv4) or 16 byte
+    (IPv6) strings and the payload is a view into the captured frame.
+    seq and flags are only set for TCP'''
+    __slots__ = ('ts', 'length', 'src', 'dst', 'p', 'sport', 'dport',
+                 'payload', 'seq', 'flags')
+
+    def __init__(self, ts, length, src, dst, p, sport=0, dport=0,
+                 payload=b'', seq=0, flags=0):
+        self.ts = ts
+        self.length = length
+        self.src = src
+        self.dst = dst
+        self.p = p
+        self.sport = sport
+        self.dport = dport
+        self.payload = payload
+        self.seq = seq
+        self.flags = flags
+
+
+def network_layer(buf, linktype=LINKTYPE_ETHERNET):
+    '''Reads the link header of a frame and any VLAN tags after it.
+    Returns (ethertype, offset) of the network header, or None for
+    unknown link types and truncated frames. Loopback address families
+    and raw IP versions are returned as the matching ethertype'''
+    if linktype == LINKTYPE_ETHERNET:
+        if len(buf) < 14:
+            return None
+        eth_type, offset = buf[12] << 8 | buf[13], 14
+    elif linktype == LINKTYPE_LINUX_SLL:
+        if len(buf) < 16:
+            return None
+        eth_type, offset = buf[14] << 8 | buf[15], 16
+    elif linktype == LINKTYPE_LINUX_SLL2:
+        if len(buf) < 20:
+            return None
+        eth_type, offset = buf[0] << 8 | buf[1], 20
+    elif linktype in LINKTYPES_RAW:
+        if not len(buf):
+            return None
+        version = buf[0] >> 4
+        eth_type = ETH_TYPE_IP if version == 4 else \
+            ETH_TYPE_IP6 if version == 6 else 0
+        return eth_type, 0
+    elif linktype == LINKTYPE_NULL or linktype == LINKTYPE_LOOP:
+        family = loopback_family(buf, linktype)
+        if family is None:
+            return None
+        eth_type = ETH_TYPE_IP if family == 2 else \
+            ETH_TYPE_IP6 if family in AF_INET6_FAMILIES else 0
+        return eth_type, 4
+    else:
+        return None
+    while eth_type in ETH_TYPES_VLAN and len(buf) >= offset + 4:
+        eth_type = buf[offset + 2] << 8 | buf[offset + 3]
+        offset += 4
+    return eth_type, offset
+
+
+def loopback_family(buf, linktype):
+    '''Returns the address family of a BSD loopback frame. NULL headers
+    are in the byte order of the capturing host'''
+    if len(buf) < 4:
+        return None
+    family = int.from_bytes(buf[:4], 'big' if linktype == LINKTYPE_LOOP
+                            else 'little')
+    if family > 0xffff:
+        family = int.from_bytes(buf[:4], 'little' if linktype == LINKTYPE_LOOP
+                                else 'big')
+    return family
+
+
+def locate_ip(buf, linktype=LINKTYPE_ETHERNET):
+    '''Finds the IP and transport headers of a frame. Returns
+    (addresses, size, p, l4, end, later_fragment) where the source and
+    destination addresses of size bytes start at offset addresses, p
+    is the transport protocol starting at l4 and end is where the IP
+    packet ends. IPv6 extension headers are skipped. Returns None for
+    frames that do not carry IPv4 or IPv6'''
+    if linktype == LINKTYPE_ETHERNET and len(buf) >= 14 and buf[12] == 8 \
+            and buf[13] == 0:
+        # Untagged Ethernet/IPv4 skips the link header walk
+        eth_type, n = ETH_TYPE_IP, 14
+    else:
+        found = network_layer(buf, linktype)
+        if found is None:
+            return None
+        eth_type, n = found
+    if eth_type == ETH_TYPE_IP:
+        if len(buf) < n + 20 or buf[n] >> 4 != 4:
+            return None
+        ip_len, frag = struct.unpack_from('!H2xH', buf, n + 2)
+        # Ethernet pads short frames so the IP length marks the real end
+        return (n + 12, 4, buf[n + 9], n + (buf[n] & 15) * 4,
+                min(n + ip_len, len(buf)), frag & 0x1fff != 0)
+    if eth_type == ETH_TYPE_IP6:
+        if len(buf) < n + 40 or buf[n] >> 4 != 6:
+            return None
+        payload_len = buf[n + 4] << 8 | buf[n + 5]
+        # A zero length is a jumbogram, which runs to the end
+        end = min(n + 40 + payload_len, len(buf)) if payload_len \
+            else len(buf)
+        p, l4, later_fragment = buf[n + 6], n + 40, False
+        while p in IP6_EXTENSIONS and l4 + 8 <= end:
+            if p == IP_PROTO_FRAGMENT:
+                later_fragment = later_fragment or \
+                    (buf[l4 + 2] << 8 | buf[l4 + 3]) & 0xfff8 != 0
+                size = 8
+            elif p == IP_PROTO_AH:
+                size = (buf[l4 + 1] + 2) * 4
+            else:
+                size = (buf[l4 + 1] + 1) * 8
+            p = buf[l4]
+            l4 += size
+        return n + 8, 16, p, l4, end, later_fragment
+    return None
+
+
+def decode_packet(ts, buf, linktype=LINKTYPE_ETHERNET):
+    '''Decodes an IPv4 or IPv6 packet from a frame of the given pcap
+    link type into a Packet. Returns None for frames that do not carry
+    IP'''
+    found = locate_ip(buf, linktype)
+    if found is None:
+        return None
+    addresses, size, p, l4, end, later_fragment = found
+    dst = addresses + size
+    pkt = Packet(ts, len(buf), bytes(buf[addresses:dst]),
+                 bytes(buf[dst:dst + size]), p)
+    if later_fragment:
+        # Later fragments carry no transport header
+        pkt.payload = memoryview(buf)[l4:end]
+    elif p == IP_PROTO_TCP and l4 + 20 <= end:
+        pkt.sport, pkt.dport, pkt.seq = struct.unpack_from('!HHI', buf, l4)
+        pkt.flags = buf[l4 + 13]
+        pkt.payload = memoryview(buf)[l4 + (buf[l4 + 12] >> 4) * 4:end]
+    elif p == IP_PROTO_UDP and l4 + 8 <= end:
+        pkt.sport, pkt.dport = struct.unpack_from('!HH', buf, l4)
+        pkt.payload = memoryview(buf)[l4 + 8:end]
+    else:
+        pkt.payload = memoryview(buf)[l4:end]
+    return pkt
+
+
+def unsupported_reason(buf, linktype=LINKTYPE_ETHERNET):
+    '''Names the reason decode_packet could not decode a frame'''
+    if linktype not in LINKTYPES:
+        return f'link type {linktype}'
+    found = network_layer(buf, linktype)
+    if found is None:
+        return 'truncated frame'
+    eth_type, n = found
+    if linktype == LINKTYPE_NULL or linktype == LINKTYPE_LOOP:
+        if not eth_type:
+            return f'address family {loopback_family(buf, linktype)}'
+    elif linktype in LINKTYPES_RAW:
+        if not eth_type:
+            return f'IP version {buf[0] >> 4}'
+    elif eth_type != ETH_TYPE_IP and eth_type != ETH_TYPE_IP6:
+        return f'ethertype 0x{eth_type:04x}'
+    if len(buf) < n + (20 if eth_type == ETH_TYPE_IP else 40):
+        return 'truncated IP header'
+    return f'IP version {buf[n] >> 4}'
+
+
+class Dispatcher:
+    '''Decodes each packet once and passes the record to every analyser
+    registered for its protocol. Analysers declare the IP protocols they
+    need in a protocols attribute (None for every packet) and receive
+    records through their add_packet method. Frames are decoded for
+    the pcap link type in linktype. Frames that cannot be
+    decoded are counted in error_count, and every failure is counted
+    in errors by (layer, reason). An analyser that raises is counted
+    under its name and the other analysers still get the packet'''
+    def __init__(self, linktype=LINKTYPE_ETHERNET):
+        self.linktype = linktype
+        self.handlers = {}
+        self.any_handlers = []
+        self.names = {}
+        self.decode = decode_packet
+        self.error_count = 0
+        self.errors = {}
+        self.packets = 0
+        self.bytes = 0
+
+    def wrap(self, name, handler):
+        '''Returns the handler to register, subclasses may instrument it'''
+        return handler
+
+    def register(self, analyser, name=None):
+        '''Registers an analyser for the protocols it asks for'''
+        name = name or type(analyser).__name__
+        handler = self.wrap(name, analyser.add_packet)
+        self.names[handler] = name
+        if analyser.protocols is None:
+            self.any_handlers.append(handler)
+        else:
+            for p in analyser.protocols:
+                self.handlers.setdefault(p, []).append(handler)
+
+    def count_error(self, layer, reason):
+        '''Counts a failure by layer and reason'''
+        key = (layer, reason)
+        self.errors[key] = self.errors.get(key, 0) + 1
+
+    def dispatch(self, ts, buf):
+        '''Decodes a single packet and hands it to the analysers'''
+        self.packets += 1
+        self.bytes += len(buf)
+        try:
+            pkt = self.decode(ts, buf, self.linktype)
+        except Exception as error:
+            self.error_count += 1
+            self.count_error('decode', type(error).__name__)
+            return
+        if pkt is None:
+            self.error_count += 1
+            self.count_error('link', unsupported_reason(buf, self.linktype))
+            return
+        for handler in self.any_handlers:
+            try:
+                handler(pkt)
+            except Exception as error:
+                self.count_error(self.names[handler], type(error).__name__)
+        for handler in self.handlers.get(pkt.p, ()):
+            try:
+                handler(pkt)
+            except Exception as error:
+                self.count_error(self.names[handler], type(error).__name__)
+
+    def run(self, records, linktypes=False):
+        '''Dispatches every (ts, buf) record from a capture reader, or
+        (ts, buf, linktype) records with linktypes set'''
+        if linktypes:
+            for ts, buf, linktype in records:
+                self.linktype = linktype
+                self.dispatch(ts, buf)
+        else:
+            for ts, buf in records:
+                self.dispatch(ts, buf)
+
+
+# Boiler Plate
+if __name__ == '__main__':
+    print("[!]Nothing to run here.")
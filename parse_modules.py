@@ -4,143 +4,295 @@
 # Note: Run setup.py before use!
 
 import datetime
+import heapq
+import math
 import os
 import re
-import socket
 import time
-import dpkt
-import statistics as stats
-import networkx as nx
-import numpy as np
-import simplekml
-import geoip2.database
-import matplotlib.pyplot as plt
+from collections import Counter, OrderedDict, deque
+from itertools import islice
 from prettytable import PrettyTable
-from core_modules import *
+from core_modules import MissingDatabase, open_file, save
+from packet_modules import IP_PROTO_IGMP, IP_PROTO_TCP, IP_PROTO_UDP, \
+    endpoint_str, ip_to_str
+from flow_modules import FlowTable
+from export_modules import FLOAT, INT, STRING
+from geo_modules import DEFAULT_GEO_DB, LOOKUP_BATCH, GeoLookup, is_public, \
+    write_map
+from graph_modules import DEFAULT_ASN_DB, GRAPH_WRITERS, edge_weights, \
+    k_core, labeler, subnet_label, top_edges
+from sketch_modules import HyperLogLog, SpaceSaving
+from stream_modules import split_http_headers, split_lines
+
+
+SMTP_PORTS = (25, 465, 587, 2525)
+# RegEx adapted from https://www.tutorialspoint.com/
+# Extracting-email-addresses-using-regular-expressions-in-Python
+SMTP_ADDRESS = re.compile(
+    rb"(MAIL FROM|RCPT TO):\s*<([a-zA-Z0-9_.+-]+@[a-zA-Z0-9-]+\.[a-zA-Z0-9.-]+)>",
+    re.IGNORECASE)
+HTTP_METHODS = (b'GET ', b'POST ', b'HEAD ', b'PUT ', b'DELETE ', b'OPTIONS ',
+                b'PATCH ', b'TRACE ', b'CONNECT ')
+HTTP_STARTS = HTTP_METHODS + (b'HTTP/',)
+REQUEST_LINE = re.compile(rb'([A-Z]+) +(\S+) +HTTP/\d')
+RESPONSE_LINE = re.compile(rb'HTTP/\d(?:\.\d)? +(\d{3})')
+HOST_HEADER = re.compile(rb'\r\nhost:[ \t]*([^\r\n]*)', re.IGNORECASE)
+IMAGE_CONTENT_TYPE = re.compile(rb'\r\ncontent-type:[ \t]*image/([a-z0-9.+-]+)',
+                                re.IGNORECASE)
+# Image types by file extension and by Content-Type subtype, add an
+# entry here to count another type
+IMAGE_EXTENSIONS = {'gif': 'gif', 'jpg': 'jpg', 'jpeg': 'jpg', 'png': 'png',
+                    'webp': 'webp', 'svg': 'svg', 'ico': 'ico', 'bmp': 'bmp'}
+IMAGE_CONTENT_TYPES = {'gif': 'gif', 'jpeg': 'jpg', 'pjpeg': 'jpg', 'jpg': 'jpg',
+                       'png': 'png', 'webp': 'webp', 'svg+xml': 'svg',
+                       'x-icon': 'ico', 'vnd.microsoft.icon': 'ico',
+                       'bmp': 'bmp', 'x-ms-bmp': 'bmp'}
+IMAGE_ORDER = ('jpg', 'gif', 'png', 'webp', 'svg', 'ico', 'bmp')
+# The file name and extension at the end of a lower case URI path
+IMAGE_NAME = re.compile(r'([a-z0-9_.+-]+\.(%s))$' % '|'.join(
+    sorted(IMAGE_EXTENSIONS, key=len, reverse=True)))
+
+
+def new_figure():
+    '''Returns a figure for the report threads to draw on. It is not
+    managed by pyplot, so it never opens a window, and matplotlib is
+    only imported once a chart is drawn'''
+    from matplotlib.figure import Figure
+    return Figure()
 
 
 class ImageTable:
-    '''Creates an object resposiable for analysis and display of image data'''
-    def __init__(self):
-        self.image_table = PrettyTable(['From', 'To', 'Type', 'Name', 'URI'])
-        self.image_summary = PrettyTable(['Image Type', 'Total'])
-        self.gif_count = 0
-        self.jpg_count = 0
-        self.png_count = 0
+    '''Creates an object resposiable for analysis and display of image
+    data. Receives the header blocks of HTTP requests and responses
+    from the stream reassembler. Requests are classified by the
+    extension of their path, and responses by Content-Type when the
+    request they answer had no image extension'''
+    protocols = ()
+    streams = True
+    version = 4
+
+    def __init__(self, max_requests=10000):
+        self.image_rows = []
+        self.type_counts = Counter()
         self.URIs = []
+        self.max_requests = max_requests
+        # Request flow -> URIs awaiting a response, oldest flow first
+        self.requests = OrderedDict()
 
-    def check_packet(self, ip):
-        '''Analyses current packet for image URIs'''
-        if ip.p == dpkt.ip.IP_PROTO_TCP:
-            self.tcp = ip.data
-            self.src = socket.inet_ntoa(ip.src)
-            self.dst = socket.inet_ntoa(ip.dst)
-            try:
-                self.http = dpkt.http.Request(self.tcp.data)
-                if self.http.method == 'GET':
-                    self.uri = (self.http.headers['host'] + self.http.uri\
-                                ).lower()
-                    if '.gif' in self.uri:
-                        self.image_table.add_row(
-                            [self.src, self.dst, 'gif', re.findall(\
-                                '[a-zA-Z0-9_.+-]+.gif', self.uri)[0],
-                             "http://" + self.uri[:100]])
-                        self.URIs.append(self.uri)
-                        self.gif_count += 1
-                    if '.jpg' in self.uri:
-                        self.image_table.add_row(
-                            [self.src, self.dst, 'jpg', re.findall(\
-                                '[a-zA-Z0-9_.+-]+.jpg', self.uri)[0],
-                             "http://" + self.uri[:100]])
-                        self.URIs.append(self.uri)
-                        self.jpg_count += 1
-                    if '.jpeg' in self.uri:
-                        self.image_table.add_row(
-                            [self.src, self.dst, 'jpg', re.findall(\
-                                '[a-zA-Z0-9_.+-]+.jpeg', self.uri)[0],
-                             "http://" + self.uri[:100]])
-                        self.URIs.append(self.uri)
-                        self.jpg_count += 1
-                    if '.png' in self.uri:
-                        self.image_table.add_row(
-                            [self.src, self.dst, 'png', re.findall(\
-                                '[a-zA-Z0-9_.+-]+.png', self.uri)[0],
-                             "http://" + self.uri[:100]])
-                        self.URIs.append(self.uri)
-                        self.png_count += 1
-            except (dpkt.dpkt.NeedData, dpkt.dpkt.UnpackError):
-                pass
+    def wants_stream(self, pkt):
+        '''Claims TCP streams that start with an HTTP request or
+        response'''
+        return bytes(pkt.payload[:8]).startswith(HTTP_STARTS)
+
+    split_messages = staticmethod(split_http_headers)
+
+    def add_row(self, flow, image_type, name, uri):
+        '''Records an image request and counts its type'''
+        self.image_rows.append([flow[0], flow[2], image_type, name,
+                                "http://" + uri[:100]])
+        self.URIs.append(uri)
+        self.type_counts[image_type] += 1
+
+    def add_message(self, flow, ts, message):
+        '''Analyses a reassembled HTTP header block for images'''
+        if message.startswith(b'HTTP/'):
+            self.add_response(flow, message)
+            return
+        request = REQUEST_LINE.match(message)
+        if request is None:
+            return
+        host = HOST_HEADER.search(message)
+        uri = name = None
+        if request.group(1) == b'GET' and host is not None:
+            uri = (host.group(1).strip() + request.group(2)).decode(
+                'latin-1').lower()
+            path = uri.split('?', 1)[0].split('#', 1)[0]
+            name = path[path.rfind('/') + 1:]
+            found = IMAGE_NAME.search(name)
+            if found:
+                self.add_row(flow, IMAGE_EXTENSIONS[found.group(2)],
+                             found.group(1), uri)
+                uri = None
+        self.expect_response(flow, uri, name)
+
+    def expect_response(self, flow, uri, name):
+        '''Queues a request so its response can be matched to it. uri
+        is None when the response does not need classifying'''
+        queue = self.requests.get(flow)
+        if queue is None:
+            if len(self.requests) >= self.max_requests:
+                self.requests.popitem(last=False)
+            queue = self.requests[flow] = deque()
+        queue.append(None if uri is None else (uri, name))
+
+    def add_response(self, flow, message):
+        '''Classifies a response by its Content-Type when the request
+        it answers is waiting to be classified'''
+        status = RESPONSE_LINE.match(message)
+        if status is None or status.group(1).startswith(b'1'):
+            # Interim responses come before the real one
+            return
+        request_flow = (flow[2], flow[3], flow[0], flow[1])
+        queue = self.requests.get(request_flow)
+        if not queue:
+            return
+        request = queue.popleft()
+        if not queue:
+            del self.requests[request_flow]
+        if request is None or not status.group(1).startswith(b'2'):
+            return
+        found = IMAGE_CONTENT_TYPE.search(message)
+        if found:
+            subtype = found.group(1).decode('ascii').lower()
+            uri, name = request
+            self.add_row(request_flow, IMAGE_CONTENT_TYPES.get(subtype, subtype),
+                         name, uri)
+
+    def merge(self, other):
+        '''Appends the image requests found by another ImageTable'''
+        self.image_rows.extend(other.image_rows)
+        self.URIs.extend(other.URIs)
+        self.type_counts.update(other.type_counts)
+
+    def tables(self):
+        '''Yields the image requests as an export table'''
+        yield ('images', [('src', STRING), ('dst', STRING), ('type', STRING),
+                          ('name', STRING), ('uri', STRING)],
+               ((ip_to_str(src), ip_to_str(dst), image_type,
+                 name, uri)
+                for src, dst, image_type, name, uri in self.image_rows))
 
     def output_summary(self):
         '''Create a summart table using the total counter and outputs'''
-        self.image_summary.add_row(['JPG', self.jpg_count])
-        self.image_summary.add_row(['GIF', self.gif_count])
-        self.image_summary.add_row(['PNG', self.png_count])
+        self.image_summary = PrettyTable(['Image Type', 'Total'])
+        others = sorted(set(self.type_counts).difference(IMAGE_ORDER))
+        for image_type in IMAGE_ORDER + tuple(others):
+            self.image_summary.add_row([image_type.upper(),
+                                        self.type_counts[image_type]])
         print(self.image_summary)
 
-    def output(self, file_path):
-        '''Outputs the image tables and saves full URIs to a json file'''
+    def print_table(self, top=20):
+        '''Prints the first top image requests and the type totals'''
+        self.image_table = PrettyTable(['From', 'To', 'Type', 'Name', 'URI'])
+        for src, dst, image_type, name, uri in self.image_rows[:top]:
+            self.image_table.add_row([ip_to_str(src),
+                                      ip_to_str(dst),
+                                      image_type, name, uri])
         print(self.image_table)
+        if len(self.image_rows) > top:
+            print(f'[!] Showing the first {top} of {len(self.image_rows)} '
+                  'image requests')
         self.output_summary()
+
+    def report_files(self, file_path):
+        '''Returns the (name, job) pairs that save the report files'''
+        return [('Full URIs', lambda: save(self.URIs, 'Full URIs', file_path))]
+
+    def output(self, file_path, top=20):
+        '''Outputs the image tables and saves full URIs to a json file'''
+        self.print_table(top)
         print("Full URIs Exported to file in directory.")
         save(self.URIs, 'Full URIs', file_path)
 
 
 class FindEmails:
-    '''Parses PCAP file for Emails in the From and To fields'''
-    def __init__(self):
-        self.my_emails = []
+    '''Parses SMTP traffic for Emails in the MAIL FROM and RCPT TO
+    commands. Each address is counted with the time and flow it was
+    first seen in'''
+    protocols = ()
+    streams = True
+    version = 4
 
-    def check_emails(self, ip):
-        '''Analyses current packet for emails matching syntax
-        and then appends found emails to an instance array'''
-        try:
-            if ip.p == dpkt.ip.IP_PROTO_TCP:
-                self.mail = ""
-                try:
-                    self.mail = ip.data.data.decode('UTF-8')
-                except:
-                    pass
-            '''RegEx adapted from https://www.tutorialspoint.com/
-                Extracting-email-addresses-using-regular-
-                expressions-in-Python'''
-            self.mail_to = (re.findall(\
-                r"((TO: <)[a-zA-Z0-9_.+-]+@[a-zA-Z0-9-]+\.[a-zA-Z0-9-.]+>)", \
-                self.mail))
-            self.mail_from = (re.findall(\
-                r"(FROM: <[a-zA-Z0-9_.+-]+@[a-zA-Z0-9-]+\.[a-zA-Z0-9-.]+>)", \
-                self.mail))
-            if len(self.mail_to) != 0:
-                for self.emails in self.mail_to:
-                    for self.email in self.emails:
-                        self.stripped = re.findall(\
-                            r"([a-zA-Z0-9_.+-]+@[a-zA-Z0-9-]+\.[a-zA-Z0-9-.]+)"\
-                            , self.email)
-                        if len(self.stripped) != 0:
-                            if f'To:{self.stripped[0]}' not in self.my_emails:
-                                self.my_emails.append(f'To:{str(self.stripped[0])}')
-            if len(self.mail_from) != 0:
-                for self.email in self.mail_from:
-                    self.stripped = re.findall(\
-                        r"([a-zA-Z0-9_.+-]+@[a-zA-Z0-9-]+\.[a-zA-Z0-9-.]+)", \
-                        self.email)
-                    if len(self.stripped) != 0:
-                        if f'From:{self.stripped[0]}' not in self.my_emails:
-                            self.my_emails.append(f'From:{str(self.stripped[0])}')
-        except ValueError:
-            pass
-
-    def output(self):
-        '''Outputs emails in instance array to console'''
-        self.email_table = PrettyTable(["Unique Emails"])
-        for self.address in self.my_emails:
-            self.email_table.add_row([self.address])
+    def __init__(self, ports=SMTP_PORTS):
+        self.ports = frozenset(ports)
+        # 'To:addr' / 'From:addr' -> [count, first ts, (src, sport, dst, dport)]
+        self.my_emails = {}
+
+    def wants_stream(self, pkt):
+        '''Claims TCP streams to or from an SMTP port'''
+        return pkt.dport in self.ports or pkt.sport in self.ports
+
+    split_messages = staticmethod(split_lines)
+
+    def add_message(self, flow, ts, message):
+        '''Matches SMTP commands in reassembled lines'''
+        for command, address in SMTP_ADDRESS.findall(message):
+            key = ('To:' if command[0] in b'Rr' else 'From:') + \
+                address.decode('ascii')
+            self.add_email(key, 1, ts, flow)
+
+    def add_email(self, key, count, ts, flow):
+        '''Counts an address, keeping the earliest sighting'''
+        seen = self.my_emails.get(key)
+        if seen is None:
+            self.my_emails[key] = [count, ts, flow]
+        else:
+            seen[0] += count
+            if ts < seen[1]:
+                seen[1], seen[2] = ts, flow
+
+    def merge(self, other):
+        '''Adds the emails found by another FindEmails'''
+        for key, (count, ts, flow) in other.my_emails.items():
+            self.add_email(key, count, ts, flow)
+
+    def get_dict(self):
+        '''Returns the sightings of each address'''
+        return {key: {'count': count, 'first_seen': ts,
+                      'flow': f'{endpoint_str(src, sport)} -> '
+                              f'{endpoint_str(dst, dport)}'}
+                for key, (count, ts, (src, sport, dst, dport))
+                in self.my_emails.items()}
+
+    def tables(self):
+        '''Yields the address sightings as an export table'''
+        yield ('emails', [('direction', STRING), ('address', STRING),
+                          ('count', INT), ('first_seen', FLOAT),
+                          ('src', STRING), ('sport', INT), ('dst', STRING),
+                          ('dport', INT)],
+               ((key.split(':', 1)[0], key.split(':', 1)[1], count, ts,
+                 ip_to_str(src), sport, ip_to_str(dst), dport)
+                for key, (count, ts, (src, sport, dst, dport))
+                in self.my_emails.items()))
+
+    def print_table(self, top=20):
+        '''Prints the top most seen addresses'''
+        self.email_table = PrettyTable(["Unique Emails", "Count", "First Seen",
+                                        "Flow"])
+        largest = heapq.nlargest(top, self.my_emails.items(),
+                                 key=lambda item: item[1][0])
+        for self.address, (count, ts, (src, sport, dst, dport)) in largest:
+            self.email_table.add_row([self.address, count,
+                                      datetime.datetime.utcfromtimestamp(ts),
+                                      f'{endpoint_str(src, sport)} -> '
+                                      f'{endpoint_str(dst, dport)}'])
         print(self.email_table)
+        if len(self.my_emails) > top:
+            print(f'[!] Showing the {top} most seen of {len(self.my_emails)} '
+                  'addresses')
+
+    def save_files(self, file_path):
+        '''Saves the addresses and their sightings to json files'''
+        details = self.get_dict()
+        save(list(details), 'Emails', file_path)
+        save(details, 'Email Details', file_path)
+
+    def report_files(self, file_path):
+        '''Returns the (name, job) pairs that save the report files'''
+        return [('Emails', lambda: self.save_files(file_path))]
+
+    def output(self, file_path, top=20):
+        '''Outputs emails to console and saves them to json files'''
+        self.print_table(top)
+        self.save_files(file_path)
 
 
 class Packet_Summary:
     '''Parses file for specific packet types
         and calculates statistics based on them'''
+    protocols = None
+    version = 1
+
     def __init__(self):
         self.tcp_stats = {'counter': 0, 'total_length': 0, 'mean_length': 0,\
                           'min_ts': 0, 'max_ts': 0}
@@ -151,291 +303,817 @@ class Packet_Summary:
         self.error_count = 0
         self.counter = 0
 
-    def sort_packet(self, ip, buf, ts):
+    def add_packet(self, pkt):
         '''Sorts current packet by checking the packet type'''
         self.counter += 1
-        if ip.p == dpkt.ip.IP_PROTO_TCP:
-            self.tcp = ip.data
-            self.tcp_stats['total_length'] += len(buf)
-            self.tcp_stats['counter'] += 1
-            if ts > self.tcp_stats['max_ts']:
-                self.tcp_stats['max_ts'] = ts
-            if ts < self.tcp_stats['min_ts'] or self.tcp_stats['min_ts'] == 0:
-                self.tcp_stats['min_ts'] = ts
-
-        elif ip.p == dpkt.ip.IP_PROTO_UDP:
-            self.udp = ip.data
-            self.udp_stats['total_length'] += len(buf)
-            self.udp_stats['counter'] += 1
-            if ts > self.udp_stats['max_ts']:
-                self.udp_stats['max_ts'] = ts
-            if ts < self.udp_stats['min_ts'] or self.udp_stats['min_ts'] == 0:
-                self.udp_stats['min_ts'] = ts
-
-        elif ip.p == dpkt.ip.IP_PROTO_IGMP:
-            self.igmp = ip.data
-            self.igmp_stats['total_length'] += len(buf)
-            self.igmp_stats['counter'] += 1
-            if ts > self.igmp_stats['max_ts']:
-                self.igmp_stats['max_ts'] = ts
-            if ts < self.igmp_stats['min_ts'] or self.igmp_stats['min_ts'] == 0:
-                self.igmp_stats['min_ts'] = ts
+        if pkt.p == IP_PROTO_TCP:
+            proto_stats = self.tcp_stats
+        elif pkt.p == IP_PROTO_UDP:
+            proto_stats = self.udp_stats
+        elif pkt.p == IP_PROTO_IGMP:
+            proto_stats = self.igmp_stats
         else:
             self.error_count += 1
+            return
+        proto_stats['total_length'] += pkt.length
+        proto_stats['counter'] += 1
+        if pkt.ts > proto_stats['max_ts']:
+            proto_stats['max_ts'] = pkt.ts
+        if pkt.ts < proto_stats['min_ts'] or proto_stats['min_ts'] == 0:
+            proto_stats['min_ts'] = pkt.ts
+
+    def merge(self, other):
+        '''Adds the counters of another Packet_Summary to this one'''
+        for proto_stats, other_stats in ((self.tcp_stats, other.tcp_stats),
+                                         (self.udp_stats, other.udp_stats),
+                                         (self.igmp_stats, other.igmp_stats)):
+            proto_stats['counter'] += other_stats['counter']
+            proto_stats['total_length'] += other_stats['total_length']
+            if other_stats['max_ts'] > proto_stats['max_ts']:
+                proto_stats['max_ts'] = other_stats['max_ts']
+            if other_stats['min_ts'] != 0 and (
+                    other_stats['min_ts'] < proto_stats['min_ts']
+                    or proto_stats['min_ts'] == 0):
+                proto_stats['min_ts'] = other_stats['min_ts']
+        self.error_count += other.error_count
+        self.counter += other.counter
+
+    def load_table(self, columns):
+        '''Adds the statistics of a columnar packet table'''
+        from columnar_modules import protocol_summary
+        other = Packet_Summary()
+        for proto, proto_stats in ((IP_PROTO_TCP, other.tcp_stats),
+                                   (IP_PROTO_UDP, other.udp_stats),
+                                   (IP_PROTO_IGMP, other.igmp_stats)):
+            proto_stats['counter'], proto_stats['total_length'], \
+                proto_stats['min_ts'], proto_stats['max_ts'] = \
+                protocol_summary(columns, proto)
+        other.counter = len(columns)
+        other.error_count = other.counter - other.tcp_stats['counter'] - \
+            other.udp_stats['counter'] - other.igmp_stats['counter']
+        self.merge(other)
+
+    def tables(self):
+        '''Yields the per protocol statistics as an export table'''
+        yield ('protocol_summary', [('protocol', STRING), ('packets', INT),
+                                    ('total_length', INT), ('min_ts', FLOAT),
+                                    ('max_ts', FLOAT)],
+               ((name, stats['counter'], stats['total_length'],
+                 stats['min_ts'], stats['max_ts'])
+                for name, stats in (('TCP', self.tcp_stats),
+                                    ('UDP', self.udp_stats),
+                                    ('IGMP', self.igmp_stats))))
+
+    def get_dict(self):
+        '''Returns the statistics of each protocol with its mean length'''
+        for proto_stats in (self.tcp_stats, self.udp_stats, self.igmp_stats):
+            try:
+                proto_stats['mean_length'] = round(
+                    proto_stats['total_length'] / proto_stats['counter'])
+            except ZeroDivisionError:
+                proto_stats['mean_length'] = 0
+        return {'TCP': self.tcp_stats, 'UDP': self.udp_stats,
+                'IGMP': self.igmp_stats, 'unrecognised': self.error_count,
+                'total': self.counter}
+
+    def print_table(self, top=None):
+        '''Prints the statistics of each protocol'''
+        summary = self.get_dict()
+        for name in ('TCP', 'UDP', 'IGMP'):
+            proto_stats = summary[name]
+            print(f'\nPacket Type: {name}\n\tPacket Count: '
+                  f'{proto_stats["counter"]}\n\tMean Length: '
+                  f'{proto_stats["mean_length"]}')
+            print("\tMinimum Timestamp: " + str(
+                datetime.datetime.utcfromtimestamp(proto_stats["min_ts"]))
+                  + "\n\tMaximum Timestamp: " + str(
+                datetime.datetime.utcfromtimestamp(proto_stats["max_ts"])))
+        print(f'\n{self.error_count} unrecognised packets')
+        print(self.counter)
 
-    def output(self):
-        '''Summarises Calculations and Outputs'''
+    def report_files(self, file_path):
+        '''Returns the (name, job) pairs that save the report files'''
+        return [('Packet Summary', lambda: save(self.get_dict(),
+                                                'Packet Summary', file_path))]
+
+    def output(self, file_path):
+        '''Summarises Calculations, Outputs and saves to a json file'''
         print("\n[!] Loading Packet Summary Table...")
         time.sleep(1)
         print("[!] Displaying Packet Summary Table...\n")
-        try:
-            self.tcp_stats['mean_length'] = round(self.tcp_stats['total_length']\
-                                                  / self.tcp_stats['counter'])
-        except ZeroDivisionError:
-            self.tcp_stats['mean_length'] = 0
-        print(
-            f'\nPacket Type: TCP\n\tPacket Count: {self.tcp_stats["counter"]}\n\tMean Length: {self.tcp_stats["mean_length"]}')
-        print("\tMinimum Timestamp: " + str(
-            datetime.datetime.utcfromtimestamp(self.tcp_stats["min_ts"])) \
-              + "\n\tMaximum Timestamp: " + str(
-            datetime.datetime.utcfromtimestamp(self.tcp_stats["max_ts"])))
-        try:
-            self.udp_stats['mean_length'] = round(self.udp_stats['total_length']\
-                                                  / self.udp_stats['counter'])
-        except ZeroDivisionError:
-            self.udp_stats['mean_length'] = 0
-        print(
-            f'\nPacket Type: UDP\n\tPacket Count: {self.udp_stats["counter"]}\n\tMean Length: {self.udp_stats["mean_length"]}')
-        print("\tMinimum Timestamp: " + str(
-            datetime.datetime.utcfromtimestamp(self.udp_stats["min_ts"]))\
-              + "\n\tMaximum Timestamp: " + str(
-            datetime.datetime.utcfromtimestamp(self.udp_stats["max_ts"])))
-        try:
-            self.igmp_stats['mean_length'] = round(self.igmp_stats['total_length']\
-                                                   / self.igmp_stats['counter'])
-        except ZeroDivisionError:
-            self.igmp_stats['mean_length'] = 0
-        print(
-            f'\nPacket Type: IGMP\n\tPacket Count: {self.igmp_stats["counter"]}\n\tMean Length: {self.igmp_stats["mean_length"]}')
-        print("\tMinimum Timestamp: " + str(
-            datetime.datetime.utcfromtimestamp(self.igmp_stats["min_ts"]))\
-              + "\n\tMaximum Timestamp: " + str(
-            datetime.datetime.utcfromtimestamp(self.igmp_stats["max_ts"])))
-        print(f'\n{self.error_count} unrecognised packets')
-        print(self.counter)
+        self.print_table()
+        save(self.get_dict(), 'Packet Summary', file_path)
 
 
 class Flow_Chart:
-    '''A class responsable for generating
-    the flow chart from a list of timestamps'''
-    def __init__(self):
-        self.timestamps = []
+    '''A class responsable for generating the flow chart. Packets are
+    counted into fixed width time bins as they arrive, at several
+    resolutions at once, so no timestamps are stored'''
+    protocols = None
+    version = 1
 
-    def add_timestamp(self, ts):
-        '''Appends a timestamp to to instance array'''
-        self.timestamps.append(ts)
+    def __init__(self, bin_widths=(1, 20, 300), chart_width=20):
+        self.chart_width = chart_width
+        self.bin_widths = tuple(sorted(set(bin_widths) | {chart_width}))
+        self.bins = {width: {} for width in self.bin_widths}
+        # Running sum of squared bin counts for the threshold
+        self.squares = {width: 0 for width in self.bin_widths}
+        self.counter = 0
 
-    def output(self, file_path):
-        '''Calculates line chart, displays and saves to file'''
-        print("\n[!] Creating Data Flow Line Chart...")
-        self.timestamps = sorted(self.timestamps)
-        self.relative_times = []
-        self.first_time = datetime.datetime.fromtimestamp(self.timestamps[0])
-        for self.i in self.timestamps:
-            self.temp_time = datetime.datetime.fromtimestamp(self.i) - \
-                             datetime.datetime.fromtimestamp(
-                self.timestamps[0])
-            self.temp_time = float(str(self.temp_time.seconds) + '.' + \
-                                   str(self.temp_time.microseconds))
-            self.relative_times.append(self.temp_time)
-        self.relative_times = sorted(self.relative_times)
-        self.interval_period = 20
-        self.interval = self.interval_period
-        self.mydict = {}
-        self.intervals = []
-        self.timestamp = self.first_time.strftime("%H:%M:%S")
-        for self.i in self.relative_times:
-            if self.i < self.interval:
-                if self.mydict.get(self.timestamp) is None:
-                    self.mydict[self.timestamp] = [self.i]
-                else:
-                    self.mydict[self.timestamp].append(self.i)
-            else:
-                self.timestamp = (self.first_time +
-                    datetime.timedelta(seconds=round(
-                        self.interval, 3))).strftime(
-                    "%H:%M:%S")
-                self.interval = self.interval + self.interval_period
-                if self.mydict.get(self.timestamp) is None:
-                    self.mydict[self.timestamp] = [self.i]
-                else:
-                    self.mydict[self.timestamp].append(self.i)
-        self.x_values = []
-        self.y_values = []
-        for self.k in self.mydict:
-            self.mydict[self.k] = len(self.mydict[self.k])
-            self.x_values.append(self.k)
-            self.y_values.append(self.mydict[self.k])
-        self.threshold = stats.mean(self.y_values) + \
-                         (stats.stdev(self.y_values) * 2)
-        self.objects = self.x_values
-        self.y_pos = np.arange(len(self.objects))
-        ax = plt.subplot(111)
-        ax.plot(self.x_values, self.y_values, label='Traffic')
-        plt.xticks(self.y_pos, self.objects, rotation=90)
-        plt.ylabel('Packets')
-        plt.xlabel('TimeStamp')
-        plt.title('Packet Flow')
-        ax.axhline(y=self.threshold, linewidth=1, color='k', label='Threshold')
+    def add_packet(self, pkt):
+        '''Counts the packet into its time bin at every resolution.
+        Bins are aligned to the epoch so arrival order does not matter'''
+        self.counter += 1
+        for width in self.bin_widths:
+            bins = self.bins[width]
+            key = int(pkt.ts // width)
+            count = bins.get(key, 0)
+            bins[key] = count + 1
+            self.squares[width] += 2 * count + 1
+
+    def merge(self, other):
+        '''Adds the bin counts of another Flow_Chart'''
+        self.counter += other.counter
+        for width in self.bin_widths:
+            bins = self.bins[width]
+            for key, count in other.bins[width].items():
+                current = bins.get(key, 0)
+                bins[key] = current + count
+                self.squares[width] += 2 * current * count + count * count
+
+    def load_table(self, columns):
+        '''Adds the time bins of a columnar packet table'''
+        import numpy as np
+        from columnar_modules import time_histogram
+        other = Flow_Chart(self.bin_widths, self.chart_width)
+        other.counter = len(columns)
+        for width in self.bin_widths:
+            keys, counts = time_histogram(columns, width)
+            other.bins[width] = dict(zip(keys.tolist(), counts.tolist()))
+            other.squares[width] = int((counts.astype(np.int64) ** 2).sum())
+        self.merge(other)
+
+    def threshold(self, width):
+        '''Returns the mean plus two standard deviations of the
+        bin counts, taken from the running sums'''
+        n = len(self.bins[width])
+        if n == 0:
+            return 0
+        mean = self.counter / n
+        if n < 2:
+            return mean
+        variance = (self.squares[width] - self.counter * mean) / (n - 1)
+        return mean + 2 * math.sqrt(max(variance, 0))
+
+    def get_dict(self):
+        '''Returns the bin counts for every resolution keyed by the
+        bin start time'''
+        return {width: {key * width: self.bins[width][key]
+                        for key in sorted(self.bins[width])}
+                for width in self.bin_widths}
+
+    def tables(self):
+        '''Yields the bin counts of every resolution as an export table'''
+        yield ('flow_bins', [('width', INT), ('start', FLOAT),
+                             ('packets', INT)],
+               ((width, key * width, self.bins[width][key])
+                for width in self.bin_widths
+                for key in sorted(self.bins[width])))
+
+    def draw(self, file_path, fig):
+        '''Plots the bins at the chart resolution on fig and saves the
+        chart and bins. Returns the report messages'''
+        bins = self.bins[self.chart_width]
+        keys = sorted(bins)
+        x_values = [datetime.datetime.utcfromtimestamp(
+            key * self.chart_width).strftime("%H:%M:%S") for key in keys]
+        y_values = [bins[key] for key in keys]
+        ax = fig.add_subplot(111)
+        ax.plot(x_values, y_values, label='Traffic')
+        ax.set_xticks(range(len(x_values)))
+        ax.set_xticklabels(x_values, rotation=90)
+        ax.set_ylabel('Packets')
+        ax.set_xlabel(f'TimeStamp UTC ({self.chart_width}s bins)')
+        ax.set_title('Packet Flow')
+        ax.axhline(y=self.threshold(self.chart_width), linewidth=1,
+                   color='k', label='Threshold')
         ax.legend()
-        plt.tight_layout()
+        fig.tight_layout()
+        fig.savefig(f'{file_path}/Packet Flow Chart.png', pad_inches=0.5)
+        save(self.get_dict(), 'Packet Flow Bins', file_path)
+        return [f'[!] Charted {len(keys)} bins of {self.chart_width}s']
+
+    def print_table(self, top=20):
+        '''Prints the top bins at the chart resolution'''
+        bins = self.bins[self.chart_width]
+        table = PrettyTable(['Bin Start (UTC)', 'Packets'])
+        for key, count in heapq.nlargest(top, bins.items(),
+                                         key=lambda item: item[1]):
+            table.add_row([datetime.datetime.utcfromtimestamp(
+                key * self.chart_width), count])
+        print(table)
+        print(f'[!] {len(bins)} bins of {self.chart_width}s, threshold '
+              f'{self.threshold(self.chart_width):.1f} packets')
+
+    def report_files(self, file_path):
+        '''Returns the (name, job) pairs that save the report files'''
+        return [('Packet Flow Chart',
+                 lambda: self.draw(file_path, new_figure()))]
+
+    def output(self, file_path, show=True):
+        '''Plots the bins at the chart resolution, displays and saves to file'''
+        print("\n[!] Creating Data Flow Line Chart...")
+        import matplotlib.pyplot as plt
+        fig = plt.figure()
         print("[!] Saving Data Flow Line Chart...")
         try:
-            plt.savefig(f'{file_path}/Packet Flow Chart.png', pad_inches=0.5)
+            self.draw(file_path, fig)
         except:
             print("[!]Error - Folder not found. File not saved.")
-        print("[!] Displaying Data Flow Line Chart...")
-        plt.show()
+        if show:
+            print("[!] Displaying Data Flow Line Chart...")
+            plt.show()
+        plt.close(fig)
 
 
 class Traffic_Table:
-    '''Hosts a set of tables displaying IP traffics'''
-    def __init__(self):
+    '''Hosts a set of tables displaying IP traffics. With top_k set only
+    the top_k busiest addresses are tracked, in fixed memory, with a
+    Space-Saving summary. Totals are then over by at most the printed
+    error, and sent and received only count the packets seen while an
+    address was tracked'''
+    protocols = None
+    version = 2
+
+    def __init__(self, top_k=0):
         self.addresses = {}
-        self.traffic_table = PrettyTable(['Sent', 'Received', 'Address', 'Total'])
-        self.connection_table = PrettyTable(['Source', 'Destination', 'Connections'])
-
-    def add_address(self, ip):
-        '''Adds the addresses from the current packet to the dictionary'''
-        self.src = socket.inet_ntoa(ip.src)
-        self.dst = socket.inet_ntoa(ip.dst)
-        if self.addresses.get(self.src) is None:
-            self.addresses[self.src] = [1, 0]
+        # [total, error, sent, received, bytes sent, bytes received]
+        self.talkers = SpaceSaving(top_k, fields=4) if top_k else None
+
+    def add_packet(self, pkt):
+        '''Adds the raw addresses from the current packet to the dictionary'''
+        if self.talkers is not None:
+            self.talkers.add(pkt.src, 1, 0, pkt.length, 0)
+            self.talkers.add(pkt.dst, 0, 1, 0, pkt.length)
+            return
+        counts = self.addresses.get(pkt.src)
+        if counts is None:
+            self.addresses[pkt.src] = [1, 0]
         else:
-            self.addresses[self.src][0] = self.addresses[self.src][0] + 1
+            counts[0] += 1
+
+        counts = self.addresses.get(pkt.dst)
+        if counts is None:
+            self.addresses[pkt.dst] = [0, 1]
+        else:
+            counts[1] += 1
+
+    def merge(self, other):
+        '''Adds the counters of another Traffic_Table to this one'''
+        if self.talkers is not None:
+            self.talkers.merge(other.talkers)
+            return
+        for address, other_counts in other.addresses.items():
+            counts = self.addresses.get(address)
+            if counts is None:
+                self.addresses[address] = list(other_counts)
+            else:
+                counts[0] += other_counts[0]
+                counts[1] += other_counts[1]
+
+    def load_table(self, columns):
+        '''Adds the per address counts of a columnar packet table'''
+        if self.talkers is not None:
+            self.load_talkers(columns)
+            return
+        from columnar_modules import address_bytes, address_counts
+        other = Traffic_Table()
+        addresses, sent, received = address_counts(columns)
+        for address, sent_count, received_count in zip(
+                address_bytes(addresses), sent.tolist(), received.tolist()):
+            other.addresses[address] = [sent_count, received_count]
+        self.merge(other)
+
+    def load_talkers(self, columns):
+        '''Adds the busiest addresses of a columnar packet table to the
+        top-k summary'''
+        from columnar_modules import address_bytes, top_talkers
+        other = SpaceSaving(self.talkers.capacity, fields=4)
+        # Every row has a source and a destination address
+        other.total = 2 * len(columns)
+        # One more than is kept so the floor is known
+        addresses, *counts = top_talkers(columns, other.capacity + 1)
+        other.load({address: [total, 0, sent_count, received_count,
+                              sent_volume, received_volume]
+                    for address, total, sent_count, received_count,
+                    sent_volume, received_volume in zip(
+                        address_bytes(addresses),
+                        *(column.tolist() for column in counts))})
+        self.talkers.merge(other)
 
-        if self.addresses.get(self.dst) is None:
-            self.addresses[self.dst] = [0, 1]
+    def rows(self):
+        '''Yields (address, sent, received, total) for each address'''
+        if self.talkers is None:
+            for address, (sent, received) in self.addresses.items():
+                yield address, sent, received, sent + received
         else:
-            self.addresses[self.dst][1] = self.addresses[self.dst][1] + 1
+            for address, entry in self.talkers.items.items():
+                yield address, entry[2], entry[3], entry[0]
+
+    def get_dict(self):
+        '''Returns the traffic counters keyed by address'''
+        return {ip_to_str(address): [sent, received]
+                for address, sent, received, total in self.rows()}
+
+    def get_bounds(self):
+        '''Returns the top-k totals with their error bounds and bytes'''
+        return self.talkers.get_dict(ip_to_str, ('sent', 'received',
+                                                 'bytes_sent',
+                                                 'bytes_received'))
+
+    def tables(self):
+        '''Yields the per address counters as an export table'''
+        yield ('ip_traffic', [('address', STRING), ('sent', INT),
+                              ('received', INT)],
+               ((ip_to_str(address), sent, received)
+                for address, sent, received, total in self.rows()))
+
+    def print_table(self, top=20):
+        '''Prints the top addresses by packets sent and received. In
+        top-k mode the columns are marked as estimates, with the error
+        bound of each total'''
+        if self.talkers is None:
+            self.traffic_table = PrettyTable(['Sent', 'Received', 'Address',
+                                              'Total'])
+        else:
+            self.traffic_table = PrettyTable(['Sent (at least)',
+                                              'Received (at least)', 'Address',
+                                              'Total (estimate)', 'Error Bound'])
+        largest = heapq.nlargest(top, self.rows(), key=lambda row: row[3])
+        for address, sent, received, total in largest:
+            row = [sent, received, ip_to_str(address), total]
+            if self.talkers is not None:
+                row.append(self.talkers.items[address][1])
+            self.traffic_table.add_row(row)
+        print(self.traffic_table)
+        known = len(self.addresses if self.talkers is None
+                    else self.talkers.items)
+        if known > top:
+            print(f'[!] Showing the {top} busiest of {known} addresses')
+        if self.talkers is not None:
+            print(f'[!] Top-{self.talkers.capacity} mode, each total is over '
+                  'by at most its error bound (at most '
+                  f'{self.talkers.floor} of {self.talkers.total} packets '
+                  'sent and received); sent and received only count packets '
+                  'seen while the address was tracked, so they can add up '
+                  'to less than the total')
+
+    def print_connections(self, graph, top=20):
+        '''Prints the top connections of a Node_Graph by packets. In
+        top-k mode the counts are marked as estimates, with the error
+        bound of each'''
+        if graph.pairs is None:
+            self.connection_table = PrettyTable(['Source', 'Destination',
+                                                 'Connections'])
+        else:
+            self.connection_table = PrettyTable(['Source', 'Destination',
+                                                 'Connections (estimate)',
+                                                 'Error Bound'])
+        network_map = graph.connections()
+        connections = ((src, dst, count)
+                       for src, dsts in network_map.items()
+                       for dst, count in dsts.items())
+        for src, dst, count in heapq.nlargest(top, connections,
+                                              key=lambda edge: edge[2]):
+            row = [ip_to_str(src), ip_to_str(dst), count]
+            if graph.pairs is not None:
+                row.append(graph.pairs.items[(src, dst)][1])
+            self.connection_table.add_row(row)
+        print(self.connection_table)
+        total = sum(len(dsts) for dsts in network_map.values())
+        if total > top:
+            print(f'[!] Showing the {top} busiest of {total} connections')
+
+    def report_files(self, file_path, graph):
+        '''Returns the (name, job) pairs that save the report files'''
+        jobs = [('IP Traffic', lambda: save(self.get_dict(), 'IP Traffic',
+                                            file_path)),
+                ('IP Flow', lambda: save(graph.get_dict(), 'IP Flow',
+                                         file_path))]
+        if self.talkers is not None:
+            jobs.append(('IP Traffic Bounds', lambda: save(
+                self.get_bounds(), 'IP Traffic Bounds', file_path)))
+        if graph.pairs is not None:
+            jobs.append(('IP Flow Bounds', lambda: save(
+                graph.get_bounds(), 'IP Flow Bounds', file_path)))
+        return jobs
 
-    def output_summary(self, file_path):
+    def output_summary(self, file_path, top=20):
         '''Outputs the table from the dictionary data'''
         print("\n[!] Creating Data Traffic Table...")
-        for key, self.value in sorted(self.addresses.items(), \
-                            key=lambda item: item[1][0] + item[1][1], reverse=True):
-            self.traffic_table.add_row([self.value[0], self.value[1], \
-                                        key, self.value[0] + self.value[1]])
         print("[!] Displaying Data Traffic Table...\n")
-        print(self.traffic_table)
+        self.print_table(top)
         print("\n[!] Saving Data Traffic Table...")
-        save(self.addresses, 'IP Traffic', file_path)
+        save(self.get_dict(), 'IP Traffic', file_path)
+        if self.talkers is not None:
+            save(self.get_bounds(), 'IP Traffic Bounds', file_path)
 
-    def output_connections(self, connections, file_path):
-        '''Outputs the connections from the passed dictionary'''
+    def output_connections(self, graph, file_path, top=20):
+        '''Outputs the connections of the passed Node_Graph'''
         print("\n[!] Creating Data Flow Table...")
-        for k in connections:
-            for v in connections[k]:
-                self.connection_table.add_row([k, v, connections[k][v]])
         print("[!] Displaying Data Flow Table...\n")
-        print(self.connection_table)
+        self.print_connections(graph, top)
         print("\n[!] Saving Data Flow Table...")
-        save(connections, 'IP Flow', file_path)
+        save(graph.get_dict(), 'IP Flow', file_path)
+        if graph.pairs is not None:
+            save(graph.get_bounds(), 'IP Flow Bounds', file_path)
 
 
 class Node_Graph:
-    '''Hosts the data and contruction methods for the node graph'''
-    def __init__(self):
+    '''Hosts the data and contruction methods for the node graph. Hosts
+    can be aggregated into /24 networks or autonomous systems, and
+    only the top_edges heaviest edges (0 for all) of the k_core are
+    drawn so the drawing time does not grow with the capture. Edge
+    labels are only drawn on small graphs. export lists the formats
+    (graphml, gexf) the whole aggregated graph is streamed to. With
+    top_k set only the top_k busiest connections are tracked, in fixed
+    memory, and their counts are over by at most the printed error'''
+    protocols = None
+    version = 2
+    # Options only used when the graph is drawn
+    report_options = ('top_edges', 'k_core', 'aggregate', 'asn_db', 'export',
+                      'label_edges')
+
+    def __init__(self, top_edges=100, k_core=0, aggregate='none',
+                 asn_db=DEFAULT_ASN_DB, export=(), label_edges=50, top_k=0):
         self.network_map = {}
+        # (src, dst) -> [packets, error, bytes]
+        self.pairs = SpaceSaving(top_k, fields=1) if top_k else None
+        self.top_edges = top_edges
+        self.k_core = k_core
+        self.aggregate = aggregate
+        self.asn_db = asn_db
+        self.export = tuple(export)
+        self.label_edges = label_edges
 
-    def add_connection(self, ip):
-        '''Sorts IP from given packet'''
-        self.src = socket.inet_ntoa(ip.src)
-        self.dst = socket.inet_ntoa(ip.dst)
-        if self.network_map.get(self.src) is None:
-            self.network_map[self.src] = {}
-        if self.network_map[self.src].get(self.dst) is None:
-            self.network_map[self.src][self.dst] = 1
-        else:
-            self.network_map[self.src][self.dst] = self.network_map[self.src][self.dst] + 1
+    def add_packet(self, pkt):
+        '''Sorts raw IPs from given packet'''
+        if self.pairs is not None:
+            self.pairs.add((pkt.src, pkt.dst), pkt.length)
+            return
+        destinations = self.network_map.get(pkt.src)
+        if destinations is None:
+            destinations = self.network_map[pkt.src] = {}
+        destinations[pkt.dst] = destinations.get(pkt.dst, 0) + 1
 
-    def output(self, file_path):
-        '''Creates, displays and saves graph'''  
-        print("\n[!] Creating Network Node Graph...")
-        self.g = nx.MultiDiGraph(
-            (k, v, {'weight': weight}) for k, vs in self.network_map.items()\
-            for v, weight in vs.items())
+    def merge(self, other):
+        '''Adds the connection counts of another Node_Graph'''
+        if self.pairs is not None:
+            self.pairs.merge(other.pairs)
+            return
+        for src, other_destinations in other.network_map.items():
+            destinations = self.network_map.get(src)
+            if destinations is None:
+                destinations = self.network_map[src] = {}
+            for dst, count in other_destinations.items():
+                destinations[dst] = destinations.get(dst, 0) + count
+
+    def load_table(self, columns):
+        '''Adds the connection counts of a columnar packet table'''
+        if self.pairs is not None:
+            self.load_pairs(columns)
+            return
+        from columnar_modules import address_bytes, connection_counts
+        other = Node_Graph()
+        srcs, dsts, counts = connection_counts(columns)
+        for src, dst, count in zip(address_bytes(srcs), address_bytes(dsts),
+                                   counts.tolist()):
+            other.network_map.setdefault(src, {})[dst] = count
+        self.merge(other)
+
+    def load_pairs(self, columns):
+        '''Adds the busiest connections of a columnar packet table to
+        the top-k summary'''
+        import numpy as np
+        from columnar_modules import address_bytes, connection_counts
+        other = SpaceSaving(self.pairs.capacity, fields=1)
+        srcs, dsts, counts, volumes = connection_counts(columns, volumes=True)
+        other.total = int(counts.sum())
+        # One more than is kept so the floor is known
+        busiest = np.argsort(-counts, kind='stable')[:other.capacity + 1]
+        other.load({(src, dst): [count, 0, volume]
+                    for src, dst, count, volume in zip(
+                        address_bytes(srcs[busiest]),
+                        address_bytes(dsts[busiest]),
+                        counts[busiest].tolist(), volumes[busiest].tolist())})
+        self.pairs.merge(other)
+
+    def connections(self):
+        '''Returns the packet counts keyed by source then destination'''
+        if self.pairs is None:
+            return self.network_map
+        network_map = {}
+        for (src, dst), entry in self.pairs.items.items():
+            network_map.setdefault(src, {})[dst] = entry[0]
+        return network_map
+
+    def get_bounds(self):
+        '''Returns the top-k counts with their error bounds and bytes'''
+        return self.pairs.get_dict(
+            lambda pair: f'{ip_to_str(pair[0])} -> {ip_to_str(pair[1])}',
+            ('bytes',))
+
+    def edges(self, label=ip_to_str):
+        '''Returns a function yielding the labelled, weighted edges'''
+        return lambda: edge_weights(self.connections(), label)
+
+    def pruned_edges(self, edges):
+        '''Returns the edges to draw'''
+        if self.k_core:
+            edges = k_core(edges, self.k_core)
+        if self.top_edges:
+            edges = top_edges(edges, self.top_edges)
+        return list(edges)
+
+    def export_graph(self, edges, file_path):
+        '''Streams the graph to the requested file formats. Returns the
+        report messages'''
+        messages = []
+        for graph_format in self.export:
+            messages.append(f'[!] Saving Network Graph as '
+                            f'{graph_format.upper()}...')
+            try:
+                GRAPH_WRITERS[graph_format](
+                    edges, f'{file_path}/IP Network Map.{graph_format}')
+            except OSError:
+                messages.append("[!]Error - Folder not found. File not saved.")
+        return messages
+
+    def draw(self, file_path, fig):
+        '''Exports the graph, draws the pruned edges on fig and saves
+        the drawing. Returns the report messages'''
+        messages = []
+        try:
+            label = labeler(self.aggregate, self.asn_db)
+        except (OSError, ValueError):
+            messages.append(f'[!] Database Error - {self.asn_db} not found, '
+                            'aggregating by /24 instead')
+            label = subnet_label
+        edges = self.edges(label)
+        messages += self.export_graph(edges, file_path)
+        drawn = self.pruned_edges(edges())
+        if hasattr(label, 'close'):
+            label.close()
+        messages.append(f'[!] Drew {len(drawn)} edges')
+        import networkx as nx
+        self.g = nx.DiGraph()
+        self.g.add_weighted_edges_from(drawn)
         self.pos = nx.shell_layout(self.g)
-        nx.draw(self.g, self.pos, with_labels=True, linewidths=4)
-        nx.draw_networkx_edge_labels(self.g, self.pos, \
-                                     with_labels=True, alpha=0.5)
-        print("[!] Saving Network Node Graph...")
+        ax = fig.add_axes((0, 0, 1, 1))
+        nx.draw(self.g, self.pos, ax=ax, with_labels=True, linewidths=4)
+        if len(drawn) <= self.label_edges:
+            nx.draw_networkx_edge_labels(
+                self.g, self.pos, ax=ax, alpha=0.5,
+                edge_labels=nx.get_edge_attributes(self.g, 'weight'))
+        fig.savefig(f'{file_path}/IP Network Map.png', pad_inches=0.5)
+        return messages
+
+    def print_table(self, top=None):
+        '''Prints the size of the graph, the busiest connections are
+        in the traffic report'''
+        network_map = self.connections()
+        print(f'[!] {len(network_map)} sources, '
+              f'{sum(len(dsts) for dsts in network_map.values())} '
+              'connections')
+        if self.pairs is not None:
+            print(f'[!] Top-{self.pairs.capacity} mode, counts are over by at '
+                  f'most {self.pairs.floor} of {self.pairs.total} packets')
+
+    def report_files(self, file_path):
+        '''Returns the (name, job) pairs that save the report files'''
+        return [('IP Network Map',
+                 lambda: self.draw(file_path, new_figure()))]
+
+    def output(self, file_path, show=True):
+        '''Creates, displays and saves graph'''
+        print("\n[!] Creating Network Node Graph...")
+        import matplotlib.pyplot as plt
+        fig = plt.figure()
         try:
-            plt.savefig(f'{file_path}/IP Network Map.png', pad_inches=0.5)
+            for message in self.draw(file_path, fig):
+                print(message)
         except:
             print("[!]Error - Folder not found. File not saved.")
-        print("[!] Displaying Network Node Graph...")
-        plt.show()
+        if show:
+            print("[!] Displaying Network Node Graph...")
+            plt.show()
+        plt.close(fig)
+
+    def tables(self):
+        '''Yields the connection counts as an export table of edges'''
+        yield ('ip_flow', [('src', STRING), ('dst', STRING), ('packets', INT)],
+               ((ip_to_str(src), ip_to_str(dst), count)
+                for src, dsts in self.connections().items()
+                for dst, count in dsts.items()))
 
     def get_dict(self):
-        '''Returns network map data dictionary'''
-        return self.network_map
+        '''Returns network map data dictionary keyed by address'''
+        return {ip_to_str(src): {ip_to_str(dst): count
+                                        for dst, count in dsts.items()}
+                for src, dsts in self.connections().items()}
 
 
 class KML_File:
-    '''KML generator'''
-    def __init__(self):
-        self.Distinct_IP_List = []
-        self.location_data = {}
-
-    def add_addresses(self, ip):
-        '''Rips IPs from passed packet'''
-        self.src = socket.inet_ntoa(ip.src)
-        self.dst = socket.inet_ntoa(ip.dst)
-        if self.src not in self.Distinct_IP_List:
-            self.Distinct_IP_List.append(self.src)
-        if self.dst not in self.Distinct_IP_List:
-            self.Distinct_IP_List.append(self.dst)
+    '''Map generator. Counts the packets and bytes of each address and
+    streams the located public addresses to the map files in formats
+    (kml, geojson). With cluster set, hosts sharing coordinates are
+    one point weighted by their traffic. With approximate set it only
+    estimates the number of distinct hosts with a HyperLogLog sketch,
+    in fixed memory, and no map is made'''
+    protocols = None
+    version = 3
+    # Options only used when the map is made
+    report_options = ('geo_db', 'formats', 'cluster')
 
-    def output(self, file_path):
-        '''Outputs KML file to directory and opens in Google Earth'''
-        download_geo_db()
-        print("\n[!] Downloading GEO DB...")
-        self.kml = simplekml.Kml()
+    def __init__(self, geo_db=DEFAULT_GEO_DB, approximate=False,
+                 formats=('kml',), cluster=False):
+        self.geo_db = geo_db
+        self.formats = tuple(formats)
+        self.cluster = cluster
+        # Raw address -> [packets, bytes], in first seen order
+        self.distinct_ips = {}
+        self.sketch = HyperLogLog() if approximate else None
+
+    def add_packet(self, pkt):
+        '''Rips raw IPs from passed packet'''
+        if self.sketch is None:
+            for address in (pkt.src, pkt.dst):
+                counts = self.distinct_ips.get(address)
+                if counts is None:
+                    self.distinct_ips[address] = [1, pkt.length]
+                else:
+                    counts[0] += 1
+                    counts[1] += pkt.length
+        else:
+            self.sketch.add(pkt.src)
+            self.sketch.add(pkt.dst)
+
+    def merge(self, other):
+        '''Adds the addresses seen by another KML_File'''
+        if self.sketch is None:
+            for address, (packets, volume) in other.distinct_ips.items():
+                counts = self.distinct_ips.get(address)
+                if counts is None:
+                    self.distinct_ips[address] = [packets, volume]
+                else:
+                    counts[0] += packets
+                    counts[1] += volume
+        else:
+            self.sketch.merge(other.sketch)
+
+    def tables(self):
+        '''Yields the distinct addresses as an export table. Only the
+        estimate is exported in approximate mode'''
+        if self.sketch is None:
+            yield ('hosts', [('address', STRING), ('packets', INT),
+                             ('bytes', INT)],
+                   ((ip_to_str(address), packets, volume)
+                    for address, (packets, volume)
+                    in self.distinct_ips.items()))
+        else:
+            yield ('distinct_hosts', [('estimate', INT),
+                                      ('standard_error', FLOAT)],
+                   [(self.sketch.count(), self.sketch.standard_error())])
+
+    def output_estimate(self, file_path):
+        '''Outputs the estimated distinct host count'''
+        estimate = self.sketch.count()
+        error = self.sketch.standard_error()
+        print(f'\n[!] Approximately {estimate} distinct hosts '
+              f'(standard error {error:.1%})')
+        save({'distinct_hosts': estimate, 'standard_error': error},
+             'Distinct Hosts', file_path)
+
+    def print_table(self, top=None):
+        '''Prints the number of distinct hosts, estimated in
+        approximate mode'''
+        if self.sketch is not None:
+            print(f'[!] Approximately {self.sketch.count()} distinct hosts '
+                  f'(standard error {self.sketch.standard_error():.1%})')
+        else:
+            print(f'[!] {len(self.distinct_ips)} distinct hosts to locate')
+
+    def report_files(self, file_path):
+        '''Returns the (name, job) pairs that save the report files'''
+        if self.sketch is not None:
+            return [('Distinct Hosts', lambda: save(
+                {'distinct_hosts': self.sketch.count(),
+                 'standard_error': self.sketch.standard_error()},
+                'Distinct Hosts', file_path))]
+        return [('GeoIPs', lambda: self.save_map(file_path))]
+
+    def located(self, reader):
+        '''Yields (address, location, packets, bytes) for each public
+        address with a known location. Addresses are looked up in
+        batches of LOOKUP_BATCH'''
+        items = iter(self.distinct_ips.items())
+        while True:
+            chunk = list(islice(items, LOOKUP_BATCH))
+            if not chunk:
+                return
+            batch = []
+            for address, counts in chunk:
+                ip = ip_to_str(address)
+                if is_public(ip):
+                    batch.append((ip, counts))
+                else:
+                    self.skipped += 1
+            locations = reader.lookup_many(ip for ip, counts in batch)
+            for ip, (packets, volume) in batch:
+                location = locations[ip]
+                if location is None:
+                    self.error_count += 1
+                else:
+                    yield ip, location, packets, volume
+
+    def save_map(self, file_path):
+        '''Looks up the public addresses and streams them to the map
+        files. Returns the report messages. Raises MissingDatabase when
+        the database cannot be opened'''
         self.error_count = 0
-        try: #Opens DB with a dynamic file path
-            self.directory = ("./GeoLite2-City.tar/" + os.listdir("./GeoLite2-City.tar/")[0] + "/")
-            print("[!] Unpacking GEO DB...")
-            self.reader = geoip2.database.Reader(f'{self.directory}/GeoLite2-City.mmdb')
-        except:
-            print("[!] Database Error")
+        self.skipped = 0
+        try:
+            reader = GeoLookup(self.geo_db)
+        except (OSError, ValueError):
+            raise MissingDatabase(f'Database Error - {self.geo_db} not '
+                                  'found, run setup.py with a MaxMind '
+                                  'license key to download it') from None
+        with reader:
+            written = write_map(self.located(reader), f'{file_path}/GeoIPs',
+                                self.formats, self.cluster)
+        return [f'[!] Skipped {self.skipped} private or reserved IPs',
+                f'[!] Location data not available for {self.error_count} IPs',
+                f'[!] Wrote {written} points to ' + ', '.join(
+                    os.path.basename(path)
+                    for path in self.map_files(file_path))]
+
+    def map_files(self, file_path):
+        '''Returns the paths of the map files'''
+        return [f'{file_path}/GeoIPs.{geo_format}'
+                for geo_format in self.formats]
+
+    def open_map(self, file_path):
+        '''Opens the first map file in the default desktop app'''
+        paths = self.map_files(file_path)
+        if self.sketch is not None or not paths or \
+                not os.path.exists(paths[0]):
+            return
+        print(f'[!] Opening {os.path.basename(paths[0])} in the default app')
+        try:
+            open_file(paths[0])
+        except OSError:
+            print("[!] Error - No application found to open the map")
+
+    def output(self, file_path, open_file=True):
+        '''Outputs the map files to directory and opens the first in
+        the default app (Google Earth for KML)'''
+        if self.sketch is not None:
+            self.output_estimate(file_path)
+            return
+        print("\n[!] Opening GEO DB...")
         print("[!] Looking-up IPs...")
-        for self.ip in self.Distinct_IP_List:
-            try:
-                self.rec = self.reader.city(self.ip)
-                if self.rec.city.name is None:
-                    self.city = ""
-                else:
-                    self.city = self.rec.city.name
-                self.location_data[self.ip] = {"country": self.rec.country.name, "city": self.city,
-                                               "longitude": self.rec.location.longitude,
-                                               "latitude": self.rec.location.latitude}
-            except:
-                self.error_count += 1
-
-        for self.key in self.location_data:
-            self.pnt = self.kml.newpoint(name=self.key, coords=[
-                (self.location_data[self.key]["longitude"], \
-                 self.location_data[self.key]["latitude"])], description=( 
-                    self.location_data[self.key]["country"] \
-                    + self.location_data[self.key]["city"]))
         try:
-            self.kml.save(f'{file_path}/GeoIPs.kml')
-            print(f'[!] Location data not available for {self.error_count} IPs')
-            print('[!] Opening file in default app (Google Earth)')
-            os.startfile(f'{file_path}/GeoIPs.kml')
-        except:
-            print("[!] Error - Folder Not Found")
+            messages = self.save_map(file_path)
+        except OSError as error:
+            print(f'[!] {error}')
+            return
+        for message in messages:
+            print(message)
+        if open_file:
+            self.open_map(file_path)
+
+
+ANALYSERS = {'images': ImageTable, 'emails': FindEmails,
+             'summary': Packet_Summary, 'traffic': Traffic_Table,
+             'graph': Node_Graph, 'flow': Flow_Chart, 'map': KML_File,
+             'flows': FlowTable}
+
+
+def analyser_names(names):
+    '''Returns the analysers needed for the named reports. The traffic
+    report lists connections so it also needs the node graph'''
+    names = list(names)
+    if 'traffic' in names and 'graph' not in names:
+        names.append('graph')
+    return names
+
+
+def create_analysers(names, options=None):
+    '''Creates the named analysers, passing each the keyword arguments
+    given for it in options'''
+    options = options or {}
+    return {name: ANALYSERS[name](**options.get(name, {}))
+            for name in analyser_names(names)}
 
 
 # Boiler Plate
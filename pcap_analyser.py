@@ -3,129 +3,385 @@
 # Author:   Jacob Connell Nov 2019
 # Note: Run setup.py before use!
 
+import argparse
+import contextlib
 import os
-from tkinter import *
-from tkinter import messagebox
-from tkinter.filedialog import askopenfilename
-import dpkt
-from parse_modules import *
+import sys
+from parse_modules import ANALYSERS
+from core_modules import create_directory
+from cache_modules import AnalysisCache, DEFAULT_CACHE_DIR
+from geo_modules import DEFAULT_GEO_DB, GEO_WRITERS
+from graph_modules import AGGREGATES, DEFAULT_ASN_DB, GRAPH_WRITERS
+from shard_modules import analyse, analyse_cached
+from export_modules import WRITERS, export_analysers, write_manifest
+from live_modules import LIVE_ANALYSERS, run_live
+from batch_modules import DEFAULT_BATCH_JOBS, run_batch
+from filter_modules import PacketFilter, parse_time
+from metrics_modules import Metrics, Profiler
+from report_modules import DEFAULT_REPORT_WORKERS, DEFAULT_TOP, render_reports
 
 
-class Window(object):
-    '''Creates and displays GUI'''
-    def __init__(self, window):
+def hold(interactive=True):
+    '''Holds the program to wait for user input'''
+    if interactive:
+        wait = input("Press Enter to Continue")
 
-        self.window = window
 
-        self.window.wm_title("PCAP Analyser")
+def output_reports(analysers, names, file_path, interactive=True,
+                   top=DEFAULT_TOP):
+    '''Outputs the reports for the named analysers in turn, showing the
+    top rows of each console table'''
+    if 'images' in names:
+        analysers['images'].output(file_path, top)
+        hold(interactive)
+    if 'emails' in names:
+        analysers['emails'].output(file_path, top)
+        hold(interactive)
+    if 'summary' in names:
+        analysers['summary'].output(file_path)
+        hold(interactive)
+    if 'traffic' in names:
+        analysers['traffic'].output_summary(file_path, top)
+        hold(interactive)
+        analysers['traffic'].output_connections(analysers['graph'], file_path,
+                                                top)
+        hold(interactive)
+    if 'graph' in names:
+        analysers['graph'].output(file_path, show=interactive)
+        hold(interactive)
+    if 'flow' in names:
+        analysers['flow'].output(file_path, show=interactive)
+        hold(interactive)
+    if 'flows' in names:
+        analysers['flows'].output(file_path, top)
+        hold(interactive)
+    if 'map' in names:
+        analysers['map'].output(file_path, open_file=interactive)
 
-        l1 = Label(window, text="PCAP File")
-        l1.grid(row=0, column=0)
 
-        self.file_text = StringVar()
-        self.file1 = Entry(window, textvariable=self.file_text, width=60)
-        self.file1.grid(row=0, column=1)
+def run_program(pcapfile, folder_name, names=tuple(ANALYSERS),
+                interactive=True, workers=1, options=None, columnar=False,
+                cache=None, content_hash=False, export=(), packet_filter=None,
+                metrics=None, profile=None, profile_mode='cprofile',
+                prometheus=False, top=DEFAULT_TOP,
+                report_workers=DEFAULT_REPORT_WORKERS, open_map=False):
+    '''Takes the PCAP path as an input and decodes each packet once,
+    sending the record to the relivant objects. With more than one
+    worker the file is split across processes and the results merged.
+    options maps analyser names to keyword arguments for them and
+    columnar fills the statistics analysers from a numpy packet table.
+    With an AnalysisCache, results from earlier runs on the same capture
+    are reused. export lists the table formats to also write the results
+    in, and a manifest of the report directory is always saved. Only
+    packets matching packet_filter are analysed. The run is counted in
+    metrics and saved to Metrics.json (and metrics.prom with prometheus
+    set), and profile names a file to save a profile of the analysis
+    to. Console tables show the top rows and, when not interactive, the
+    report files are saved by report_workers threads and the map is
+    only opened with open_map set. Returns 0 on success and 1 when the
+    capture could not be read or a report could not be saved, so it
+    can be used as an exit status'''
+    try:
+        print("[!] Creating Directory...")
+        create_directory(folder_name)
+        cwd = os.getcwd()
+        file_path = os.path.join(cwd, f'{folder_name}')
+        print(f'[!] Opening PCAP File: {pcapfile}...')
+        if workers > 1:
+            print(f'[!] Analysing File with {workers} workers...')
+        else:
+            print("[!] Analysing File...")
+        if packet_filter:
+            print(f'[!] Filtering packets: {packet_filter.expression or "all"}')
+        metrics = metrics or Metrics()
+        profiler = Profiler(profile, profile_mode) if profile \
+            else contextlib.nullcontext()
+        with profiler:
+            if cache is not None:
+                analysers, error_count, metrics = analyse_cached(
+                    pcapfile, names, cache, workers, options, columnar,
+                    content_hash, packet_filter, metrics)
+            else:
+                analysers, error_count, columns, metrics = analyse(
+                    pcapfile, names, workers, options, columnar,
+                    packet_filter=packet_filter, metrics=metrics)
+        print(f'[!] {error_count} packets could not be decoded')
+        metrics.output(file_path, prometheus)
 
-        b1 = Button(window, text="Browse", width=12, command=self.find_file)
-        b1.grid(row=0, column=2)
+        failed = 0
+        if interactive:
+            output_reports(analysers, names, file_path, interactive, top)
+        else:
+            failed = render_reports(analysers, names, file_path,
+                                    report_workers, top)
+            if open_map and 'map' in names:
+                analysers['map'].open_map(file_path)
+        tables = []
+        if export:
+            print(f'\n[!] Exporting tables as {", ".join(export)}...')
+            tables = export_analysers(analysers, list(analysers), file_path,
+                                      export)
+        write_manifest(file_path, pcapfile, names, error_count, tables)
+        if failed:
+            print(f'[!] {failed} report(s) could not be saved')
+            return 1
+        return 0
 
-        l2 = Label(window, text="New Directory Name")
-        l2.grid(row=1, column=0, padx=30)
+    except (OSError, ValueError) as error:
+        print(f"Error Opening File: {error}")
+        return 1
 
-        self.folder_text = StringVar()
-        self.folder1 = Entry(window, textvariable=self.folder_text, width=20)
-        self.folder1.grid(row=2, column=0)
 
-        b3 = Button(window, text="Analyses File", width=12,
-                    command=self.go_command)
-        b3.grid(row=2, column=2)
+def run_live_program(source, folder_name, names=LIVE_ANALYSERS, window=60,
+                     slide=None, options=None, idle_timeout=None,
+                     packet_filter=None):
+    '''Analyses a pcap stream in rolling windows, writing a summary of
+    each window as it closes. Returns 0 on success and 1 on failure'''
+    try:
+        print("[!] Creating Directory...")
+        create_directory(folder_name)
+        file_path = os.path.join(os.getcwd(), f'{folder_name}')
+        names = [name for name in names if name in LIVE_ANALYSERS]
+        print(f'[!] Reading PCAP Stream: {source}...')
+        error_count = run_live(source, file_path, names, window, slide,
+                               options, idle_timeout, packet_filter)
+        print(f'[!] {error_count} packets could not be decoded')
+        return 0
 
-    def find_file(self):
-        '''Opens file browser for PCAP'''
-        name = askopenfilename(initialdir="C:",
-                               filetypes=(("PCAP", "*.pcap"),
-                            ("All Files", "*.*")), title="Choose a file.")
-        self.file_text.set(name)
+    except (OSError, ValueError) as error:
+        print(f"Error Opening Stream: {error}")
+        return 1
 
-    def go_command(self):
-        '''Runs the main program'''
-        if (len(self.file_text.get())) > 0:
-            if (len(self.folder_text.get())) > 0:
 
-                run_program(self.file_text.get(), self.folder_text.get())
-            else:
-                messagebox.showwarning("Error", "Error - Invalid Folder Name")
-        else:
-            messagebox.showwarning("Error", "Error - Invalid File Path!")
+def run_batch_program(source, folder_name, names=tuple(ANALYSERS),
+                      jobs=DEFAULT_BATCH_JOBS, options=None, columnar=False,
+                      packet_filter=None, cache_size=1 << 30, top=DEFAULT_TOP,
+                      report_workers=DEFAULT_REPORT_WORKERS, export=()):
+    '''Analyses a directory or glob of captures into folder_name, with
+    a report directory per capture and a merged Aggregate report.
+    Returns 0 when every capture was analysed and 1 otherwise'''
+    try:
+        print(f'[!] Reading Captures: {source}...')
+        if packet_filter:
+            print(f'[!] Filtering packets: {packet_filter.expression or "all"}')
+        failed = run_batch(source, folder_name, names, jobs, options,
+                           columnar, packet_filter, cache_size, top,
+                           report_workers, export)
+        return 1 if failed else 0
 
+    except (OSError, ValueError) as error:
+        print(f"Error Opening Captures: {error}")
+        return 1
 
-def hold():
-    '''Holds the program to wait for user input'''
-    wait = input("Press Enter to Continue")
 
-    
-def run_program(pcapfile, folder_name):
-    '''Takes the PCAP path as an input and loops through each
-    packet - sending data to the relivant objects'''
-    try:
-        window.destroy()
-        print("[!] Creating Directory...")
-        create_directory(folder_name)
-        cwd = os.getcwd()
-        file_path = os.path.join(cwd, f'{folder_name}')
-        print(f'[!] Opening PCAP File: {pcapfile}...')
-        f = open(pcapfile, 'rb')
-        pcap = dpkt.pcap.Reader(f)
-
-        my_images = ImageTable()
-        email_addresses = FindEmails()
-        my_summary = Packet_Summary()
-        my_line_chart = Flow_Chart()
-        my_traffic = Traffic_Table()
-        my_network_graph = Node_Graph()
-        my_map = KML_File()
-
-        error_count = 0
-
-        print("[!] Analysing File...")
-        for ts, buf in pcap:
-            try:
-                eth = dpkt.ethernet.Ethernet(buf)
-                ip = eth.data
-                my_line_chart.add_timestamp(ts)
-                my_traffic.add_address(ip)
-                my_network_graph.add_connection(ip)
-                my_map.add_addresses(ip)
-                email_addresses.check_emails(ip)
-                my_images.check_packet(ip)
-                my_summary.sort_packet(ip, buf, ts)
-
-            except:
-                error_count += 1
-                pass
-
-        my_images.output(file_path)
-        hold()
-        email_addresses.output()
-        hold()
-        my_summary.output()
-        hold()
-        my_traffic.output_summary(file_path)
-        hold()
-        my_traffic.output_connections(my_network_graph.get_dict(), file_path)
-        hold()
-        my_network_graph.output(file_path)
-        hold()
-        my_line_chart.output(file_path)
-        hold()
-        my_map.output(file_path)
-
-    except:
-        print("Error Opening File")
+def parse_args(argv):
+    '''Parses the command line for a headless run'''
+    parser = argparse.ArgumentParser(
+        description="Analyses a PCAP file. Starts the GUI if no file is given.")
+    parser.add_argument('pcapfile',
+                        help="PCAP file to analyse, a directory or glob of "
+                             "captures with --batch, or - for stdin with "
+                             "--live")
+    parser.add_argument('-o', '--output', required=True,
+                        help="Directory to write the reports to")
+    parser.add_argument('-a', '--analysers', nargs='+', choices=list(ANALYSERS),
+                        default=list(ANALYSERS), metavar='ANALYSER',
+                        help=f'Analysers to run (default: all of {", ".join(ANALYSERS)})')
+    parser.add_argument('-f', '--filter', default='', metavar='EXPRESSION',
+                        help="Only analyse packets matching a BPF style "
+                             "filter, e.g. 'tcp port 80 and net 10.0.0.0/8'")
+    parser.add_argument('--start', type=parse_time, metavar='TIME',
+                        help="Skip packets before TIME, in epoch seconds or "
+                             "ISO 8601 (UTC unless an offset is given)")
+    parser.add_argument('--end', type=parse_time, metavar='TIME',
+                        help="Skip packets from TIME on")
+    parser.add_argument('-w', '--workers', type=int, default=1,
+                        help="Number of processes to split the file across")
+    parser.add_argument('--columnar', action='store_true',
+                        help="Compute the summary, traffic, graph and flow "
+                             "statistics from a numpy packet table")
+    parser.add_argument('--cache', nargs='?', const=DEFAULT_CACHE_DIR,
+                        metavar='DIR',
+                        help="Reuse results from earlier runs, stored in DIR "
+                             f"(default: {DEFAULT_CACHE_DIR})")
+    parser.add_argument('--cache-size', type=int, default=1024, metavar='MB',
+                        help="Size cap of the cache (default: 1024)")
+    parser.add_argument('--cache-hash', action='store_true',
+                        help="Key the cache on the capture contents instead "
+                             "of its path, size and mtime")
+    parser.add_argument('--geoip-db', default=DEFAULT_GEO_DB, metavar='PATH',
+                        help="GeoLite2 City database for the map "
+                             f"(default: {DEFAULT_GEO_DB}, or $GEOIP_DB)")
+    parser.add_argument('--map-approximate', action='store_true',
+                        help="Only estimate the distinct host count for the "
+                             "map analyser, in fixed memory")
+    parser.add_argument('--top-k', type=int, default=0, metavar='K',
+                        help="Track only the K busiest addresses and "
+                             "connections for the traffic and graph "
+                             "analysers, in fixed memory. Counts are over by "
+                             "at most packets / K (default: 0, exact)")
+    parser.add_argument('--map-format', nargs='+', choices=list(GEO_WRITERS),
+                        default=['kml'], metavar='FORMAT',
+                        help="Map files to write, kml and/or geojson "
+                             "(default: kml)")
+    parser.add_argument('--map-cluster', action='store_true',
+                        help="Merge hosts that share coordinates into one "
+                             "map point weighted by their traffic")
+    parser.add_argument('--open-map', action='store_true',
+                        help="Open the map in the default desktop app once "
+                             "it is saved")
+    parser.add_argument('--stream-memory', type=int, default=64, metavar='MB',
+                        help="Memory cap for TCP stream reassembly (default: 64)")
+    parser.add_argument('--flow-bins', type=int, nargs='+', default=[1, 20, 300],
+                        metavar='SECONDS',
+                        help="Flow chart bin widths to count (default: 1 20 300)")
+    parser.add_argument('--flow-width', type=int, default=20, metavar='SECONDS',
+                        help="Flow chart bin width to plot (default: 20)")
+    parser.add_argument('--graph-top', type=int, default=100, metavar='N',
+                        help="Draw only the N heaviest edges, 0 for all "
+                             "(default: 100)")
+    parser.add_argument('--graph-k-core', type=int, default=0, metavar='K',
+                        help="Draw only hosts in the K-core of the graph")
+    parser.add_argument('--graph-aggregate', choices=AGGREGATES,
+                        default='none',
+                        help="Group hosts by /24 network (/64 for IPv6) or "
+                             "autonomous system (default: none)")
+    parser.add_argument('--asn-db', default=DEFAULT_ASN_DB, metavar='PATH',
+                        help="GeoLite2 ASN database for --graph-aggregate asn "
+                             f"(default: {DEFAULT_ASN_DB}, or $GEOIP_ASN_DB)")
+    parser.add_argument('--graph-export', nargs='+', choices=list(GRAPH_WRITERS),
+                        default=[], metavar='FORMAT',
+                        help="Also save the whole graph as graphml or gexf")
+    parser.add_argument('--flow-idle-timeout', type=float, default=60,
+                        metavar='SECONDS',
+                        help="End a flow after this long without packets "
+                             "(default: 60)")
+    parser.add_argument('--flow-active-timeout', type=float, default=1800,
+                        metavar='SECONDS',
+                        help="Split flows that last longer than this "
+                             "(default: 1800)")
+    parser.add_argument('--max-flows', type=int, default=200000,
+                        help="Most flows tracked at once (default: 200000)")
+    parser.add_argument('--max-flow-records', type=int, default=1000000,
+                        metavar='N',
+                        help="Most ended flows kept for the flow table, "
+                             "later ones are only counted (default: 1000000)")
+    parser.add_argument('--batch', action='store_true',
+                        help="Analyse every capture of a directory or glob, "
+                             "skipping captures done by earlier runs, into a "
+                             "report directory each and a merged Aggregate "
+                             "report (implied for a directory)")
+    parser.add_argument('--jobs', type=int, default=DEFAULT_BATCH_JOBS,
+                        metavar='N',
+                        help="Captures analysed at once in batch mode "
+                             f'(default: {DEFAULT_BATCH_JOBS})')
+    parser.add_argument('--live', action='store_true',
+                        help="Read a growing pcap file, FIFO or stdin and "
+                             f'summarise rolling windows with the '
+                             f'{", ".join(LIVE_ANALYSERS)} analysers')
+    parser.add_argument('--window', type=float, default=60, metavar='SECONDS',
+                        help="Live window length (default: 60)")
+    parser.add_argument('--slide', type=float, metavar='SECONDS',
+                        help="Live window step, a divisor of the window "
+                             "(default: the window, for tumbling windows)")
+    parser.add_argument('--live-idle', type=float, metavar='SECONDS',
+                        help="Stop following a live file after this long "
+                             "without new data (default: never)")
+    parser.add_argument('--progress', action='store_true',
+                        help="Show progress, rate and ETA while analysing")
+    parser.add_argument('--timing', action='store_true',
+                        help="Time decoding and every analyser")
+    parser.add_argument('--profile', metavar='FILE',
+                        help="Save a profile of the analysis to FILE")
+    parser.add_argument('--profile-mode', choices=('cprofile', 'sample'),
+                        default='cprofile',
+                        help="cProfile stats, or json of the most sampled "
+                             "lines (default: cprofile)")
+    parser.add_argument('--prometheus', action='store_true',
+                        help="Also save the metrics as metrics.prom in the "
+                             "Prometheus text format")
+    parser.add_argument('--top', type=int, default=DEFAULT_TOP, metavar='N',
+                        help="Rows shown in each console table "
+                             f'(default: {DEFAULT_TOP})')
+    parser.add_argument('--report-workers', type=int,
+                        default=DEFAULT_REPORT_WORKERS, metavar='N',
+                        help="Threads saving the report files "
+                             f'(default: {DEFAULT_REPORT_WORKERS})')
+    parser.add_argument('--export', nargs='+', choices=list(WRITERS),
+                        default=[], metavar='FORMAT',
+                        help="Also write every result table in these formats "
+                             f'({", ".join(WRITERS)}); parquet and arrow '
+                             "need pyarrow")
+    return parser.parse_args(argv)
+
+
+def analyser_options(args):
+    '''Collects the analyser keyword arguments from the command line'''
+    return {'flow': {'bin_widths': args.flow_bins,
+                     'chart_width': args.flow_width},
+            'graph': {'top_edges': args.graph_top,
+                      'k_core': args.graph_k_core,
+                      'aggregate': args.graph_aggregate,
+                      'asn_db': args.asn_db,
+                      'export': args.graph_export,
+                      'top_k': args.top_k},
+            'traffic': {'top_k': args.top_k},
+            'flows': {'idle_timeout': args.flow_idle_timeout,
+                      'active_timeout': args.flow_active_timeout,
+                      'max_flows': args.max_flows,
+                      'max_records': args.max_flow_records},
+            'streams': {'max_bytes': args.stream_memory << 20},
+            'map': {'geo_db': args.geoip_db,
+                    'approximate': args.map_approximate,
+                    'formats': args.map_format,
+                    'cluster': args.map_cluster}}
+
+
+def main(argv=None):
+    '''Runs headless when given arguments, otherwise starts the GUI'''
+    if argv is None:
+        argv = sys.argv[1:]
+    if argv:
+        # Headless runs only save charts, so no GUI backend is loaded
+        os.environ['MPLBACKEND'] = 'Agg'
+        args = parse_args(argv)
+        try:
+            packet_filter = PacketFilter(args.filter, args.start, args.end)
+        except ValueError as error:
+            print(f'[!] {error}')
+            return 2
+        if args.live:
+            return run_live_program(args.pcapfile, args.output,
+                                    args.analysers, args.window, args.slide,
+                                    analyser_options(args), args.live_idle,
+                                    packet_filter)
+        if args.batch or os.path.isdir(args.pcapfile):
+            return run_batch_program(args.pcapfile, args.output,
+                                     args.analysers, args.jobs,
+                                     analyser_options(args), args.columnar,
+                                     packet_filter, args.cache_size << 20,
+                                     args.top, args.report_workers,
+                                     args.export)
+        cache = None
+        if args.cache:
+            cache = AnalysisCache(args.cache, args.cache_size << 20)
+        return run_program(args.pcapfile, args.output,
+                           names=args.analysers, interactive=False,
+                           workers=args.workers, options=analyser_options(args),
+                           columnar=args.columnar, cache=cache,
+                           content_hash=args.cache_hash, export=args.export,
+                           packet_filter=packet_filter,
+                           metrics=Metrics(args.timing, args.progress),
+                           profile=args.profile,
+                           profile_mode=args.profile_mode,
+                           prometheus=args.prometheus, top=args.top,
+                           report_workers=args.report_workers,
+                           open_map=args.open_map)
+    from gui_modules import start_gui
+    start_gui(run_program)
+    return 0
 
 
 # Boiler Plate
 if __name__ == '__main__':
-    window = Tk()
-    Window(window)
-    window.mainloop()
+    sys.exit(main())
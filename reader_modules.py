@@ -0,0 +1,404 @@
+# Script:   reader_modules.py
+# Desc:     Memory mapped pcap/pcapng readers. Records are yielded as
+#           memoryviews into the mapped file so nothing is copied, and
+#           byte offsets are exposed so a capture can be split or seeked
+# Author:   Jacob Connell Nov 2019
+# Note: Run setup.py before use!
+
+import mmap
+import os
+import stat
+import struct
+import sys
+import time
+
+# Magic number -> (byte order, timestamp fraction divisor)
+PCAP_MAGIC = {b'\xd4\xc3\xb2\xa1': ('<', 1E6), b'\xa1\xb2\xc3\xd4': ('>', 1E6),
+              b'\x4d\x3c\xb2\xa1': ('<', 1E9), b'\xa1\xb2\x3c\x4d': ('>', 1E9)}
+PCAPNG_MAGIC = b'\x0a\x0d\x0d\x0a'
+GLOBAL_HEADER_LEN = 24
+RECORD_HEADER_LEN = 16
+MAX_CAPLEN = 262144
+# Seconds the timestamps of a chain found by sync may go back from the
+# first record or from the record before, or jump forward, so a chain
+# read from the middle of a record is rejected
+MAX_STEP_BACK = 60
+MAX_STEP_FORWARD = 86400
+
+# pcapng block types
+SHB = 0x0A0D0D0A
+IDB = 0x00000001
+OPB = 0x00000002
+SPB = 0x00000003
+EPB = 0x00000006
+PACKET_BLOCKS = (EPB, SPB, OPB)
+KNOWN_BLOCKS = (SHB, IDB, OPB, SPB, 0x00000004, 0x00000005, EPB,
+                0x0000000A, 0x00000BAD, 0x40000BAD)
+
+
+class CaptureFile:
+    '''Maps a capture file into memory. Subclasses yield records as
+    (offset, ts, linktype, buf) from packets() where buf is a
+    memoryview into the mapping'''
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, 'rb')
+        self.size = os.fstat(self.file.fileno()).st_size
+        if self.size:
+            self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        else:
+            self.map = b''
+        self.view = memoryview(self.map)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __iter__(self):
+        return self.records()
+
+    def close(self):
+        '''Unmaps the file. The mapping stays alive while records
+        from it are still referenced elsewhere'''
+        try:
+            self.view.release()
+            if self.size:
+                self.map.close()
+        except BufferError:
+            pass
+        self.file.close()
+
+    def records(self, start=None, end=None, linktypes=False):
+        '''Yields (ts, buf) for every record starting in [start, end),
+        or (ts, buf, linktype) with linktypes set'''
+        if linktypes:
+            for offset, ts, linktype, buf in self.packets(start, end):
+                yield ts, buf, linktype
+        else:
+            for offset, ts, linktype, buf in self.packets(start, end):
+                yield ts, buf
+
+    def sync(self, offset):
+        '''Returns the offset of the first record at or after offset'''
+        if offset <= self.first_record:
+            return self.first_record
+        for i in range(offset, self.size):
+            if self.is_record(i):
+                return i
+        return self.size
+
+    def split(self, shards):
+        '''Splits the file into record aligned (start, end) byte ranges'''
+        step = (self.size - self.first_record) / shards
+        bounds = [self.first_record]
+        for i in range(1, shards):
+            bounds.append(max(self.sync(self.first_record + int(step * i)),
+                              bounds[-1]))
+        bounds.append(self.size)
+        return [(start, end) for start, end in zip(bounds, bounds[1:])
+                if start < end]
+
+
+class PcapFile(CaptureFile):
+    '''Reads the records of a classic pcap file'''
+    def __init__(self, path):
+        super().__init__(path)
+        header = self.map[:GLOBAL_HEADER_LEN]
+        if len(header) < GLOBAL_HEADER_LEN or header[:4] not in PCAP_MAGIC:
+            self.close()
+            raise ValueError(f'{path} is not a pcap file')
+        self.endian, self.divisor = PCAP_MAGIC[header[:4]]
+        self.snaplen, self.linktype = struct.unpack_from(
+            self.endian + 'II', header, 16)
+        self.record_header = struct.Struct(self.endian + 'IIII')
+        self.first_record = GLOBAL_HEADER_LEN
+        self.mixed_linktypes = False
+        self.first_sec = 0
+        if self.size >= GLOBAL_HEADER_LEN + RECORD_HEADER_LEN:
+            self.first_sec = self.record_header.unpack_from(
+                self.map, GLOBAL_HEADER_LEN)[0]
+
+    def packets(self, start=None, end=None):
+        '''Yields (offset, ts, linktype, buf) for every record
+        starting in [start, end)'''
+        offset = self.first_record if start is None else start
+        end = self.size if end is None else min(end, self.size)
+        data, view, size = self.map, self.view, self.size
+        unpack_from = self.record_header.unpack_from
+        divisor, linktype = self.divisor, self.linktype
+        while offset < end and offset + RECORD_HEADER_LEN <= size:
+            sec, frac, caplen, length = unpack_from(data, offset)
+            data_start = offset + RECORD_HEADER_LEN
+            data_end = data_start + caplen
+            if data_end > size:
+                break
+            yield offset, sec + frac / divisor, linktype, view[data_start:data_end]
+            offset = data_end
+
+    def is_record(self, offset, chain=16):
+        '''Checks that a chain of plausible record headers starts at
+        offset. A chain that runs off the end must end exactly on it'''
+        last_sec = None
+        for i in range(chain):
+            if offset >= self.size:
+                return offset == self.size
+            if offset + RECORD_HEADER_LEN > self.size:
+                return False
+            sec, frac, caplen, length = self.record_header.unpack_from(
+                self.map, offset)
+            if frac >= self.divisor or caplen > length or \
+                    caplen > max(self.snaplen, MAX_CAPLEN):
+                return False
+            if sec < self.first_sec - MAX_STEP_BACK:
+                return False
+            if last_sec is not None and \
+                    not -MAX_STEP_BACK <= sec - last_sec <= MAX_STEP_FORWARD:
+                return False
+            last_sec = sec
+            offset += RECORD_HEADER_LEN + caplen
+        return True
+
+
+class Interface:
+    '''Link type and timestamp settings from a pcapng interface block'''
+    __slots__ = ('linktype', 'snaplen', 'divisor', 'ts_offset')
+
+    def __init__(self, linktype, snaplen, divisor=1E6, ts_offset=0):
+        self.linktype = linktype
+        self.snaplen = snaplen
+        self.divisor = divisor
+        self.ts_offset = ts_offset
+
+
+class PcapngFile(CaptureFile):
+    '''Reads the packet blocks of a pcapng file. Handles several
+    sections and per interface timestamp resolutions'''
+    def __init__(self, path):
+        super().__init__(path)
+        if self.map[:4] != PCAPNG_MAGIC or self.size < 28:
+            self.close()
+            raise ValueError(f'{path} is not a pcapng file')
+        self.first_record = self.read_sections(self.size, stop=True)
+
+    @property
+    def linktype(self):
+        '''Link type of the first interface'''
+        return self.interfaces[0].linktype if self.interfaces else 1
+
+    @property
+    def mixed_linktypes(self):
+        '''Interfaces, also those of later sections, can have their own
+        link type, so records must be read with theirs'''
+        return True
+
+    def read_section_header(self, offset):
+        '''Sets the byte order from the section header at offset'''
+        magic = self.map[offset + 8:offset + 12]
+        if magic == b'\x4d\x3c\x2b\x1a':
+            self.endian = '<'
+        elif magic == b'\x1a\x2b\x3c\x4d':
+            self.endian = '>'
+        else:
+            raise ValueError(f'{self.path} has a bad section header')
+        self.block_header = struct.Struct(self.endian + 'II')
+        self.block_trailer = struct.Struct(self.endian + 'I')
+        self.epb_header = struct.Struct(self.endian + 'IIIII')
+
+    def read_sections(self, end, stop=False):
+        '''Walks the block headers from the start of the file to the
+        first block at or after end, or the first packet block with stop
+        set, and returns its offset. The byte order and interfaces are
+        left as the section holding that block declares them, so a
+        shard starting in a later section reads its records with the
+        settings of that section'''
+        self.read_section_header(0)
+        self.interfaces = []
+        offset = 0
+        while offset < end and offset + 12 <= self.size:
+            block_type, block_len = self.block_header.unpack_from(self.map, offset)
+            if stop and block_type in PACKET_BLOCKS:
+                break
+            if block_type == SHB:
+                # The block length is in the byte order of the new section
+                self.read_section_header(offset)
+                self.interfaces = []
+                block_len = self.block_header.unpack_from(self.map, offset)[1]
+            elif block_type == IDB:
+                self.interfaces.append(self.read_interface(offset, block_len))
+            if block_len < 12:
+                break
+            offset += block_len
+        return offset
+
+    def read_interface(self, offset, block_len):
+        '''Reads an interface description block and its options'''
+        linktype, snaplen = struct.unpack_from(self.endian + 'H2xI',
+                                               self.map, offset + 8)
+        interface = Interface(linktype, snaplen)
+        option = offset + 16
+        end = offset + block_len - 4
+        while option + 4 <= end:
+            code, length = struct.unpack_from(self.endian + 'HH', self.map, option)
+            if code == 0:
+                break
+            if code == 9 and length >= 1:
+                tsresol = self.map[option + 4]
+                if tsresol & 0x80:
+                    interface.divisor = float(2 ** (tsresol & 0x7f))
+                else:
+                    interface.divisor = float(10 ** tsresol)
+            elif code == 14 and length >= 8:
+                interface.ts_offset = struct.unpack_from(
+                    self.endian + 'q', self.map, option + 4)[0]
+            option += 4 + (length + 3) // 4 * 4
+        return interface
+
+    def packets(self, start=None, end=None):
+        '''Yields (offset, ts, linktype, buf) for every packet block
+        starting in [start, end). The section state is rebuilt first
+        since a range can start after later section headers'''
+        offset = self.read_sections(
+            self.first_record if start is None else start)
+        end = self.size if end is None else min(end, self.size)
+        data, view, size = self.map, self.view, self.size
+        while offset < end and offset + 12 <= size:
+            block_type, block_len = self.block_header.unpack_from(data, offset)
+            if block_type == SHB:
+                self.read_section_header(offset)
+                self.interfaces = []
+                block_len = self.block_header.unpack_from(data, offset)[1]
+            if block_len < 12 or offset + block_len > size:
+                break
+            if block_type == EPB:
+                iface_id, ts_high, ts_low, caplen, length = \
+                    self.epb_header.unpack_from(data, offset + 8)
+                # The data ends before the block trailer
+                caplen = min(caplen, block_len - 32)
+                if iface_id < len(self.interfaces):
+                    interface = self.interfaces[iface_id]
+                    ts = ((ts_high << 32) | ts_low) / interface.divisor + \
+                        interface.ts_offset
+                    yield offset, ts, interface.linktype, \
+                        view[offset + 28:offset + 28 + caplen]
+            elif block_type == SPB and self.interfaces:
+                interface = self.interfaces[0]
+                length = self.block_trailer.unpack_from(data, offset + 8)[0]
+                caplen = min(length, interface.snaplen or length,
+                             block_len - 16)
+                yield offset, 0.0, interface.linktype, \
+                    view[offset + 12:offset + 12 + caplen]
+            elif block_type == OPB:
+                iface_id, drops, ts_high, ts_low, caplen, length = \
+                    struct.unpack_from(self.endian + 'HHIIII', data, offset + 8)
+                caplen = min(caplen, block_len - 32)
+                if iface_id < len(self.interfaces):
+                    interface = self.interfaces[iface_id]
+                    ts = ((ts_high << 32) | ts_low) / interface.divisor + \
+                        interface.ts_offset
+                    yield offset, ts, interface.linktype, \
+                        view[offset + 28:offset + 28 + caplen]
+            elif block_type == IDB:
+                self.interfaces.append(self.read_interface(offset, block_len))
+            offset += block_len
+
+    def is_record(self, offset, chain=16):
+        '''Checks that a chain of well formed blocks starts at offset
+        with a packet block. Each block repeats its length at the end'''
+        for i in range(chain):
+            if offset >= self.size:
+                return offset == self.size
+            if offset + 12 > self.size:
+                return False
+            block_type, block_len = self.block_header.unpack_from(self.map, offset)
+            if (i == 0 and block_type not in PACKET_BLOCKS) or \
+                    block_type not in KNOWN_BLOCKS or block_len < 12 or \
+                    block_len % 4 or offset + block_len > self.size or \
+                    self.block_trailer.unpack_from(
+                        self.map, offset + block_len - 4)[0] != block_len:
+                return False
+            offset += block_len
+        return True
+
+
+class PcapStream:
+    '''Reads classic pcap records from a pipe, stdin ('-') or a file
+    that is still being written, such as tcpdump -w output. Pipes end
+    at EOF. At the end of a regular file it polls for more data every
+    poll seconds and stops after idle_timeout seconds without any (None
+    to follow forever)'''
+    def __init__(self, path, poll=0.5, idle_timeout=None):
+        self.path = path
+        self.file = sys.stdin.buffer if path == '-' else open(path, 'rb')
+        self.follow = stat.S_ISREG(os.fstat(self.file.fileno()).st_mode)
+        self.poll = poll
+        self.idle_timeout = idle_timeout
+        header = self.read(GLOBAL_HEADER_LEN)
+        if header is None or header[:4] not in PCAP_MAGIC:
+            self.close()
+            raise ValueError(f'{path} is not a pcap stream')
+        self.endian, self.divisor = PCAP_MAGIC[header[:4]]
+        self.snaplen, self.linktype = struct.unpack_from(
+            self.endian + 'II', header, 16)
+        self.record_header = struct.Struct(self.endian + 'IIII')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __iter__(self):
+        return self.records()
+
+    def close(self):
+        if self.file is not sys.stdin.buffer:
+            self.file.close()
+
+    def read(self, size):
+        '''Reads exactly size bytes, waiting for a growing file.
+        Returns None when the stream ends first'''
+        data = self.file.read(size) or b''
+        idle = 0
+        while len(data) < size:
+            if not self.follow or (self.idle_timeout is not None and
+                                   idle >= self.idle_timeout):
+                return None
+            time.sleep(self.poll)
+            idle += self.poll
+            more = self.file.read(size - len(data))
+            if more:
+                data += more
+                idle = 0
+        return data
+
+    def records(self):
+        '''Yields (ts, buf) for every record as it arrives'''
+        read, unpack = self.read, self.record_header.unpack
+        divisor = self.divisor
+        while True:
+            header = read(RECORD_HEADER_LEN)
+            if header is None:
+                return
+            sec, frac, caplen, length = unpack(header)
+            if caplen > max(self.snaplen, MAX_CAPLEN):
+                raise ValueError(f'{self.path} has a corrupt record header')
+            buf = read(caplen)
+            if buf is None:
+                return
+            yield sec + frac / divisor, buf
+
+
+def open_capture(path):
+    '''Opens a pcap or pcapng file with the matching reader'''
+    with open(path, 'rb') as f:
+        magic = f.read(4)
+    if magic == PCAPNG_MAGIC:
+        return PcapngFile(path)
+    return PcapFile(path)
+
+
+# Boiler Plate
+if __name__ == '__main__':
+    print("[!]Nothing to run here.")
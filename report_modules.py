@@ -0,0 +1,77 @@
+# Script:   report_modules.py
+# Desc:     Report stage that prints short console tables and renders
+#           the report files in a thread pool
+# Author:   Jacob Connell Nov 2019
+# Note: Run setup.py before use!
+
+from concurrent.futures import ThreadPoolExecutor
+from core_modules import MissingDatabase
+
+DEFAULT_TOP = 20
+DEFAULT_REPORT_WORKERS = 4
+# Order the reports are printed in
+REPORT_ORDER = ('images', 'emails', 'summary', 'traffic', 'graph', 'flow',
+                'flows', 'map')
+
+
+def print_tables(analysers, names, top=DEFAULT_TOP):
+    '''Prints the console table of each requested report, limited to
+    the top rows so printing does not grow with the capture'''
+    for name in REPORT_ORDER:
+        if name not in names:
+            continue
+        print(f'\n[!] {name.title()} Report\n')
+        analysers[name].print_table(top)
+        if name == 'traffic':
+            analysers['traffic'].print_connections(analysers['graph'], top)
+
+
+def report_jobs(analysers, names, file_path):
+    '''Returns the (name, job) pairs saving the files of each requested
+    report. Nothing is rendered until a job is called, so only the
+    requested reports are finalised'''
+    jobs = []
+    for name in REPORT_ORDER:
+        if name not in names:
+            continue
+        if name == 'traffic':
+            jobs += analysers['traffic'].report_files(file_path,
+                                                      analysers['graph'])
+        else:
+            jobs += analysers[name].report_files(file_path)
+    return jobs
+
+
+def render_reports(analysers, names, file_path, workers=DEFAULT_REPORT_WORKERS,
+                   top=DEFAULT_TOP):
+    '''Prints the console tables then saves the report files (json,
+    charts drawn on Agg figures, KML and graph exports) concurrently
+    in a pool of worker threads. The messages of each job are printed
+    in report order as the jobs finish. Reports whose optional
+    database is missing are skipped with a warning. Returns the number
+    of files that could not be saved'''
+    print_tables(analysers, names, top)
+    jobs = report_jobs(analysers, names, file_path)
+    print(f'\n[!] Saving {len(jobs)} reports with {workers} threads...')
+    failed = 0
+    with ThreadPoolExecutor(max_workers=max(workers, 1)) as pool:
+        futures = [(name, pool.submit(job)) for name, job in jobs]
+        for name, future in futures:
+            try:
+                messages = future.result()
+            except MissingDatabase as error:
+                print(f'[!] Warning - {name} skipped: {error}')
+                continue
+            except Exception as error:
+                failed += 1
+                print(f'[!] Error - {name} not saved: {error}')
+                continue
+            for message in messages or ():
+                print(message)
+            print(f'[!] Saved {name}')
+    return failed
+
+
+# Boiler Plate
+if __name__ == '__main__':
+    print("[!]Nothing to run here.")
@@ -1,17 +1,32 @@
 # Script:   setup.py
-# Desc:     installs required modules for PCAP Analysis
+# Desc:     installs required modules for PCAP Analysis and downloads
+#           the GeoLite2 database when given a MaxMind license key:
+#           setup.py [LICENSE_KEY [DB_PATH]]
 #           Admin rights required.
 # Author:   Jacob Connell Nov 2019
 
 # Note: Run setup.py before use!
 
 
+import sys
+
+
 def main():
     import subprocess
     run = subprocess.Popen(['moduleinstall.cmd'])
+    run.wait()
+
+
+def download(license_key, db_path='GeoLite2-City.mmdb'):
+    '''Downloads the GEO DB used by the KML map'''
+    from core_modules import download_geo_db
+    download_geo_db(license_key, db_path)
 
 
 # Boiler Plate
 if __name__ == '__main__':
     print("[!]Commanding Module Installs with Pip. Please Wait...")
     main()
+    if len(sys.argv) > 1:
+        print("[!]Downloading GEO DB...")
+        download(*sys.argv[1:3])
@@ -0,0 +1,200 @@
+# Script:   shard_modules.py
+# Desc:     Runs the analysers over a PCAP file, optionally in parallel by
+#           splitting it into record aligned byte ranges and merging
+#           the analyser results
+# Author:   Jacob Connell Nov 2019
+# Note: Run setup.py before use!
+
+import time
+from cache_modules import capture_key
+from metrics_modules import Metrics, Progress, TimedConsumer
+from parse_modules import ANALYSERS, analyser_names, create_analysers
+from reader_modules import open_capture
+from stream_modules import StreamReassembler
+
+
+def analyse_capture(pcapfile, names, options=None, columnar=False,
+                    start=None, end=None, keep_table=False, packet_filter=None,
+                    metrics=None):
+    '''Runs the named analysers over the capture, or one byte range of
+    it. Analysers that take TCP streams share one StreamReassembler,
+    configured by options['streams']. In columnar mode the packet
+    metadata is collected into a PacketTable and the analysers that
+    support it are filled from the table in one vectorised pass.
+    Records not matching packet_filter are skipped before they are
+    decoded. The run is counted in metrics, a new Metrics when not
+    given. Returns the analysers, the number of undecodable packets,
+    the table columns when keep_table is set (otherwise None) and the
+    metrics'''
+    metrics = metrics or Metrics()
+    started = time.perf_counter()
+    analysers = create_analysers(names, options)
+    dispatcher = metrics.dispatcher()
+    table = None
+    columnar_names = ()
+    if columnar or keep_table:
+        from columnar_modules import COLUMNAR_ANALYSERS, PacketTable
+        table = PacketTable()
+        dispatcher.register(table, 'table')
+        if columnar:
+            columnar_names = COLUMNAR_ANALYSERS
+    reassembler = None
+    for name, analyser in analysers.items():
+        if getattr(analyser, 'streams', False):
+            if reassembler is None:
+                reassembler = StreamReassembler(
+                    **(options or {}).get('streams', {}))
+                dispatcher.register(reassembler, 'streams')
+            if metrics.timing:
+                analyser = TimedConsumer(analyser, metrics, name)
+            reassembler.subscribe(analyser)
+        elif name not in columnar_names:
+            dispatcher.register(analyser, name)
+    with open_capture(pcapfile) as capture:
+        dispatcher.linktype = capture.linktype
+        # pcapng interfaces each have their own link type
+        mixed = capture.mixed_linktypes
+        if metrics.progress:
+            records = iter(Progress(capture, start, end, linktypes=mixed))
+        else:
+            records = capture.records(start, end, linktypes=mixed)
+        if packet_filter:
+            records = packet_filter.apply(records, capture.linktype, mixed)
+        dispatcher.run(records, mixed)
+    if reassembler is not None:
+        reassembler.flush()
+    columns = None
+    if table is not None:
+        columns = table.finalize()
+    if columnar:
+        for name, analyser in analysers.items():
+            if name in columnar_names:
+                load_table = analyser.load_table
+                if metrics.timing:
+                    load_table = metrics.timed(name, load_table)
+                load_table(columns)
+    metrics.collect(dispatcher, time.perf_counter() - started)
+    return analysers, dispatcher.error_count, \
+        columns if keep_table else None, metrics
+
+
+def merge_analysers(results):
+    '''Merges shard results in file order so first-seen ordering
+    matches a single process run'''
+    analysers, error_count, columns, metrics = results[0]
+    tables = [columns]
+    for other, other_errors, other_columns, other_metrics in results[1:]:
+        for name, analyser in analysers.items():
+            analyser.merge(other[name])
+        error_count += other_errors
+        tables.append(other_columns)
+        metrics.merge(other_metrics)
+    if columns is not None:
+        from columnar_modules import PacketTable
+        columns = PacketTable.concatenate(tables)
+    return analysers, error_count, columns, metrics
+
+
+def run_sharded(pcapfile, names, workers, options=None, columnar=False,
+                keep_table=False, packet_filter=None, metrics=None):
+    '''Analyses the capture across a pool of worker processes. A
+    message split across a shard boundary would be lost, so the stream
+    analysers run over the whole capture in one job of their own while
+    the other analysers are split across the rest of the workers. The
+    results match a single process run. Workers collect their own
+    metrics without progress output'''
+    needed = analyser_names(names)
+    stream_names = [name for name in needed
+                    if getattr(ANALYSERS[name], 'streams', False)]
+    shard_names = [name for name in needed if name not in stream_names]
+    with open_capture(pcapfile) as capture:
+        ranges = capture.split(max(workers - 1, 1) if stream_names
+                               else workers)
+    if not ranges or not shard_names:
+        return analyse_capture(pcapfile, names, options, columnar,
+                               keep_table=keep_table,
+                               packet_filter=packet_filter, metrics=metrics)
+    timing = metrics is not None and metrics.timing
+    started = time.perf_counter()
+    from concurrent.futures import ProcessPoolExecutor
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        stream_future = None
+        if stream_names:
+            stream_future = pool.submit(
+                analyse_capture, pcapfile, stream_names, options,
+                packet_filter=packet_filter, metrics=Metrics(timing))
+        futures = [pool.submit(analyse_capture, pcapfile, shard_names,
+                               options, columnar, start, end, keep_table,
+                               packet_filter, Metrics(timing))
+                   for start, end in ranges]
+        results = [future.result() for future in futures]
+        stream_results = stream_future.result() if stream_future else None
+    if metrics is not None:
+        metrics.merge(results[0][3])
+        results[0] = results[0][:3] + (metrics,)
+    analysers, error_count, columns, metrics = merge_analysers(results)
+    if stream_results is not None:
+        analysers.update(stream_results[0])
+        # The stream job read the packets the shards already counted
+        metrics.merge(stream_results[3], counters=False)
+    # Wall time of the whole pool rather than of the slowest shard
+    metrics.seconds = time.perf_counter() - started
+    return {name: analysers[name] for name in needed}, error_count, \
+        columns, metrics
+
+
+def analyse(pcapfile, names, workers=1, options=None, columnar=False,
+            keep_table=False, packet_filter=None, metrics=None):
+    '''Analyses the capture in this process or across workers'''
+    if workers > 1:
+        return run_sharded(pcapfile, names, workers, options, columnar,
+                           keep_table, packet_filter, metrics)
+    return analyse_capture(pcapfile, names, options, columnar,
+                           keep_table=keep_table, packet_filter=packet_filter,
+                           metrics=metrics)
+
+
+def columnar_only(names):
+    '''Returns True when every named analyser can be filled from a
+    packet table'''
+    from columnar_modules import COLUMNAR_ANALYSERS
+    return all(name in COLUMNAR_ANALYSERS for name in names)
+
+
+def analyse_cached(pcapfile, names, cache, workers=1, options=None,
+                   columnar=False, content_hash=False, packet_filter=None,
+                   metrics=None):
+    '''Reuses cached analyser states for the capture and only does the
+    work for analysers that are missing or whose version or options
+    changed. Those are filled from the cached packet table when they
+    support it, otherwise the capture is parsed again. Each filter
+    has its own cache entry. Returns the analysers, the number of
+    undecodable packets and the metrics of any analysis done'''
+    metrics = metrics or Metrics()
+    key = capture_key(pcapfile, content_hash, packet_filter)
+    needed = analyser_names(names)
+    analysers, columns, error_count = cache.load(
+        key, {name: ANALYSERS[name] for name in needed}, options)
+    missing = [name for name in needed if name not in analysers]
+    if missing and columns is not None and columnar_only(missing):
+        print("[!] Loading packet table from cache...")
+        fresh = create_analysers(missing, options)
+        for analyser in fresh.values():
+            analyser.load_table(columns)
+        cache.store(key, pcapfile, fresh, error_count=error_count,
+                    options=options)
+        analysers.update(fresh)
+    elif missing:
+        fresh, error_count, columns, metrics = analyse(
+            pcapfile, missing, workers, options, columnar, keep_table=True,
+            packet_filter=packet_filter, metrics=metrics)
+        cache.store(key, pcapfile, fresh, columns, error_count, options)
+        analysers.update(fresh)
+    else:
+        print("[!] Loaded all analysers from cache")
+    return {name: analysers[name] for name in needed}, error_count, metrics
+
+
+# Boiler Plate
+if __name__ == '__main__':
+    print("[!]Nothing to run here.")
@@ -0,0 +1,178 @@
+# Script:   sketch_modules.py
+# Desc:     Fixed memory approximate counters for PCAP_Analyser
+# Author:   Jacob Connell Nov 2019
+# Note: Run setup.py before use!
+
+import heapq
+import math
+
+MASK64 = (1 << 64) - 1
+
+
+def mix64(value):
+    '''Hashes an integer to 64 bits with the splitmix64 finaliser.
+    Unlike hash() this is the same in every process so sketches from
+    different workers can be merged'''
+    while value >> 64:
+        value = (value & MASK64) ^ mix64(value >> 64)
+    value = (value ^ (value >> 30)) * 0xbf58476d1ce4e5b9 & MASK64
+    value = (value ^ (value >> 27)) * 0x94d049bb133111eb & MASK64
+    return value ^ (value >> 31)
+
+
+class HyperLogLog:
+    '''Estimates the number of distinct items in 2**precision bytes.
+    The standard error of the estimate is 1.04 / sqrt(2**precision),
+    about 0.8% at the default precision of 14 (16KB)'''
+    def __init__(self, precision=14):
+        self.precision = precision
+        self.registers = bytearray(1 << precision)
+
+    def add(self, item):
+        '''Adds raw bytes, such as a packed address'''
+        self.add_int(int.from_bytes(item, 'big'))
+
+    def add_int(self, value):
+        '''Adds an integer item'''
+        h = mix64(value)
+        index = h >> (64 - self.precision)
+        rest = h & ((1 << (64 - self.precision)) - 1)
+        rank = 64 - self.precision - rest.bit_length() + 1
+        if rank > self.registers[index]:
+            self.registers[index] = rank
+
+    def merge(self, other):
+        '''Combines another sketch of the same precision into this one'''
+        self.registers = bytearray(map(max, self.registers, other.registers))
+
+    def standard_error(self):
+        '''Returns the relative standard error of count()'''
+        return 1.04 / math.sqrt(len(self.registers))
+
+    def count(self):
+        '''Returns the estimated number of distinct items'''
+        m = len(self.registers)
+        alpha = 0.7213 / (1 + 1.079 / m)
+        estimate = alpha * m * m / sum(2.0 ** -r for r in self.registers)
+        zeros = self.registers.count(0)
+        if estimate <= 2.5 * m and zeros:
+            # Linear counting is more accurate for small sets
+            estimate = m * math.log(m / zeros)
+        return round(estimate)
+
+
+class SpaceSaving:
+    '''Keeps the capacity most counted items of a stream with the
+    Space-Saving algorithm. A new item replaces the least counted one
+    and starts from its count, so the count of a kept item is never
+    below the true count and is over it by at most its error. An item
+    that is not kept was seen at most floor times, and every item seen
+    more often is kept. For one stream floor <= total / capacity,
+    merging adds the floors of the two summaries. Each item also has
+    fields, such as byte counts, that are summed while it is kept'''
+    def __init__(self, capacity=1000, fields=0):
+        self.capacity = max(capacity, 1)
+        self.fields = fields
+        self.total = 0
+        self.floor = 0
+        # item -> [count, error, field...]
+        self.items = {}
+        # count -> insertion ordered set of the items with that count
+        self.buckets = {}
+        self.min_count = 0
+
+    def add(self, item, *values):
+        '''Counts one occurrence of item and adds values to its fields'''
+        self.total += 1
+        entry = self.items.get(item)
+        if entry is None:
+            if len(self.items) >= self.capacity:
+                self.evict()
+            entry = self.items[item] = [self.floor, self.floor] + \
+                [0] * self.fields
+            if not self.buckets or self.floor + 1 < self.min_count:
+                self.min_count = self.floor + 1
+        else:
+            count = entry[0]
+            bucket = self.buckets[count]
+            del bucket[item]
+            if not bucket:
+                del self.buckets[count]
+                if count == self.min_count:
+                    self.min_count = count + 1
+        entry[0] += 1
+        bucket = self.buckets.get(entry[0])
+        if bucket is None:
+            bucket = self.buckets[entry[0]] = {}
+        bucket[item] = None
+        for index, value in enumerate(values, 2):
+            entry[index] += value
+
+    def evict(self):
+        '''Drops the oldest of the least counted items'''
+        bucket = self.buckets[self.min_count]
+        victim = next(iter(bucket))
+        del bucket[victim]
+        count = self.items.pop(victim)[0]
+        if count > self.floor:
+            self.floor = count
+        if not bucket:
+            del self.buckets[count]
+            if self.buckets:
+                self.min_count = count + 1 if count + 1 in self.buckets \
+                    else min(self.buckets)
+
+    def load(self, entries):
+        '''Keeps the capacity most counted of the item -> [count, error,
+        field...] entries in place of the current items'''
+        ranked = sorted(entries.items(), key=lambda item: item[1][0],
+                        reverse=True)
+        for item, entry in ranked[self.capacity:self.capacity + 1]:
+            self.floor = max(self.floor, entry[0])
+        self.items = dict(ranked[:self.capacity])
+        self.buckets = {}
+        for item, entry in self.items.items():
+            self.buckets.setdefault(entry[0], {})[item] = None
+        self.min_count = min(self.buckets) if self.buckets else 0
+
+    def merge(self, other):
+        '''Combines another summary into this one. An item missing from
+        one summary may have been seen up to its floor times there'''
+        entries = {item: [entry[0] + other.floor, entry[1] + other.floor]
+                   + entry[2:] for item, entry in self.items.items()}
+        for item, entry in other.items.items():
+            known = entries.get(item)
+            if known is None:
+                entries[item] = [entry[0] + self.floor,
+                                 entry[1] + self.floor] + entry[2:]
+            else:
+                known[0] += entry[0] - other.floor
+                known[1] += entry[1] - other.floor
+                for index in range(2, len(entry)):
+                    known[index] += entry[index]
+        self.total += other.total
+        self.floor += other.floor
+        self.load(entries)
+
+    def top(self, n=None):
+        '''Returns the (item, [count, error, field...]) pairs of the n
+        most counted items, or of every kept item'''
+        if n is None:
+            return sorted(self.items.items(), key=lambda item: item[1][0],
+                          reverse=True)
+        return heapq.nlargest(n, self.items.items(),
+                              key=lambda item: item[1][0])
+
+    def get_dict(self, label=str, names=()):
+        '''Returns the kept items, most counted first, with their errors
+        and fields named by names'''
+        return {'capacity': self.capacity, 'total': self.total,
+                'max_error': self.floor,
+                'items': {label(item): dict(count=entry[0], error=entry[1],
+                                            **dict(zip(names, entry[2:])))
+                          for item, entry in self.top()}}
+
+
+# Boiler Plate
+if __name__ == '__main__':
+    print("[!]Nothing to run here.")
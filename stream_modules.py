@@ -0,0 +1,387 @@
+# Script:   stream_modules.py
+# Desc:     TCP stream reassembly for the HTTP and SMTP analysers
+# Author:   Jacob Connell Nov 2019
+# Note: Run setup.py before use!
+
+import re
+from collections import OrderedDict
+from packet_modules import IP_PROTO_TCP, TH_FIN, TH_RST, TH_SYN, Packet
+
+CONTENT_LENGTH = re.compile(rb'\r\ncontent-length:[ \t]*(\d+)', re.IGNORECASE)
+IGNORED = None
+SEQ_MASK = 0xffffffff
+# Bytes from the start of a stream an analyser is shown to claim it
+CLAIM_BYTES = 16
+
+
+def seq_offset(seq, base):
+    '''Returns how far seq is after base, negative when before it,
+    allowing for sequence number wrap'''
+    diff = (seq - base) & SEQ_MASK
+    return diff - 0x100000000 if diff >= 0x80000000 else diff
+
+
+def leading_bytes(held, base, limit=CLAIM_BYTES):
+    '''Returns up to limit contiguous bytes from base out of the held
+    (seq, payload, ts) segments, which are sorted by seq'''
+    data = bytearray()
+    for seq, payload, ts in held:
+        offset = seq_offset(seq, base)
+        if offset > len(data):
+            break
+        data += payload[len(data) - offset:]
+        if len(data) >= limit:
+            break
+    return bytes(data)
+
+
+class Stream:
+    '''One direction of a TCP connection being reassembled'''
+    __slots__ = ('flow', 'consumer', 'next_seq', 'buffer', 'pending',
+                 'pending_bytes', 'last_ts', 'skip', 'held', 'anchored')
+
+    def __init__(self, flow, consumer, next_seq, ts, anchored=False):
+        self.flow = flow
+        self.consumer = consumer
+        self.next_seq = next_seq
+        self.buffer = bytearray()
+        self.pending = {}
+        self.pending_bytes = 0
+        self.last_ts = ts
+        # In order bytes still to be dropped, see split_messages
+        self.skip = 0
+        # (seq, payload, ts) segments kept until the consumer is chosen
+        self.held = None if consumer else []
+        # next_seq came from the SYN
+        self.anchored = anchored
+
+    def size(self):
+        '''Returns the bytes held for this stream'''
+        return len(self.buffer) + self.pending_bytes
+
+
+def split_lines(buffer, final=False):
+    '''Frames CRLF terminated lines such as SMTP commands. All complete
+    lines are returned as one message so they are scanned in one pass.
+    Returns the messages and the number of bytes they used'''
+    end = len(buffer) if final else buffer.rfind(b'\r\n') + 2
+    if end <= 1:
+        return [], 0
+    return [bytes(buffer[:end])], end
+
+
+def split_http(buffer, final=False):
+    '''Frames HTTP messages: the header block plus any Content-Length
+    body. Returns the complete messages and the bytes they used'''
+    messages = []
+    start = 0
+    while True:
+        head_end = buffer.find(b'\r\n\r\n', start)
+        if head_end < 0:
+            break
+        match = CONTENT_LENGTH.search(buffer, start, head_end + 2)
+        end = head_end + 4 + (int(match.group(1)) if match else 0)
+        if end > len(buffer):
+            break
+        messages.append(bytes(buffer[start:end]))
+        start = end
+    if final and start < len(buffer):
+        messages.append(bytes(buffer[start:]))
+        start = len(buffer)
+    return messages, start
+
+
+def split_http_headers(buffer, final=False):
+    '''Frames HTTP messages like split_http but returns only the header
+    blocks. The bytes used include any Content-Length body, which may
+    run past the end of the buffer so the body is skipped as it arrives
+    instead of being held'''
+    messages = []
+    start = 0
+    while start < len(buffer):
+        head_end = buffer.find(b'\r\n\r\n', start)
+        if head_end < 0:
+            break
+        match = CONTENT_LENGTH.search(buffer, start, head_end + 2)
+        messages.append(bytes(buffer[start:head_end + 4]))
+        start = head_end + 4 + (int(match.group(1)) if match else 0)
+    if final and start < len(buffer):
+        messages.append(bytes(buffer[start:]))
+        start = len(buffer)
+    return messages, start
+
+
+class StreamReassembler:
+    '''Rebuilds each direction of a TCP connection, keyed on the
+    (src, sport, dst, dport) tuple, and hands complete application
+    messages to the analyser that claims the stream. Analysers that
+    want streams set streams = True and provide wants_stream(pkt),
+    split_messages(buffer, final) and add_message(flow, ts, message).
+    split_messages returns the messages and the bytes they used, which
+    may be more than the buffer holds to skip data not yet arrived.
+
+    A stream starts at the sequence number after its SYN. When the
+    SYN was not captured the segments are held until the first one is
+    known: when the other side sends data, reorder_window seconds
+    after the first segment, or when the stream ends. The consumer is
+    then chosen from the first segment and the held segments are
+    replayed in sequence order, so segments arriving out of order at
+    the start of a stream are not lost.
+
+    Out of order segments wait in a per stream buffer. Streams are
+    evicted after idle_timeout seconds, when more than max_streams are
+    open, or when all buffers together pass max_bytes. A stream whose
+    buffer passes max_stream_bytes without a complete message is
+    reset'''
+    protocols = (IP_PROTO_TCP,)
+    version = 3
+
+    def __init__(self, max_stream_bytes=1 << 16, max_bytes=1 << 26,
+                 max_streams=100000, idle_timeout=120, reorder_window=1.0):
+        self.max_stream_bytes = max_stream_bytes
+        self.max_bytes = max_bytes
+        self.max_streams = max_streams
+        self.idle_timeout = idle_timeout
+        self.reorder_window = reorder_window
+        self.consumers = []
+        # Ordered by last activity so the oldest stream is first
+        self.streams = OrderedDict()
+        # Streams waiting for their first segment, oldest first
+        self.undecided = OrderedDict()
+        # flow -> (first data seq, ts) of SYNs whose data has not started
+        self.isns = OrderedDict()
+        self.total_bytes = 0
+        self.last_sweep = 0
+        self.dropped_bytes = 0
+
+    def subscribe(self, consumer):
+        '''Adds an analyser that receives reassembled messages'''
+        self.consumers.append(consumer)
+
+    def add_packet(self, pkt):
+        '''Adds a TCP segment to its stream'''
+        flow = (pkt.src, pkt.sport, pkt.dst, pkt.dport)
+        seq = pkt.seq
+        if pkt.flags & TH_SYN:
+            # A new connection, its data starts after the SYN
+            seq = (seq + 1) & SEQ_MASK
+            if flow in self.streams:
+                self.close_stream(flow)
+            self.isns[flow] = (seq, pkt.ts)
+            self.isns.move_to_end(flow)
+            if len(self.isns) > self.max_streams:
+                self.isns.popitem(last=False)
+        stream = self.streams.get(flow, IGNORED)
+        if stream is IGNORED:
+            if not pkt.payload or flow in self.streams:
+                if pkt.flags & (TH_FIN | TH_RST):
+                    self.isns.pop(flow, None)
+                return
+            stream = self.open_stream(flow, pkt, seq)
+            if stream is IGNORED:
+                return
+        else:
+            self.streams.move_to_end(flow)
+            stream.last_ts = pkt.ts
+        if pkt.payload:
+            if self.undecided:
+                # The other side answering means this side has sent
+                # the start of its data
+                reverse = self.undecided.get(flow[2:] + flow[:2])
+                if reverse is not None and (not reverse.anchored or any(
+                        segment[0] == reverse.next_seq
+                        for segment in reverse.held)):
+                    self.decide(reverse)
+            if stream.held is None:
+                self.add_segment(stream, seq, pkt.payload, pkt.ts)
+            else:
+                self.hold(stream, seq, pkt.payload, pkt.ts)
+        if pkt.flags & (TH_FIN | TH_RST):
+            self.close_stream(flow)
+        if pkt.ts - self.last_sweep >= 1:
+            self.sweep(pkt.ts)
+
+    def claim(self, pkt):
+        '''Returns the first consumer that wants the stream starting
+        with pkt, or None'''
+        for consumer in self.consumers:
+            if consumer.wants_stream(pkt):
+                return consumer
+        return None
+
+    def open_stream(self, flow, pkt, seq):
+        '''Starts tracking a stream. A stream whose first segment is
+        this one is given to the analyser that claims it straight away,
+        otherwise its segments are held until the first is known.
+        Streams nobody wants are remembered so later segments cost a
+        lookup'''
+        anchor = self.isns.pop(flow, None)
+        if anchor is None or anchor[0] != seq or \
+                len(pkt.payload) < CLAIM_BYTES:
+            stream = Stream(flow, None, seq if anchor is None else anchor[0],
+                            pkt.ts, anchor is not None)
+            self.undecided[flow] = stream
+        else:
+            consumer = self.claim(pkt)
+            stream = IGNORED if consumer is None else \
+                Stream(flow, consumer, seq, pkt.ts, True)
+        self.streams[flow] = stream
+        if len(self.streams) > self.max_streams:
+            self.close_stream(next(iter(self.streams)))
+        return stream
+
+    def hold(self, stream, seq, payload, ts):
+        '''Keeps a segment of a stream whose first segment is not yet
+        known'''
+        stream.held.append((seq, bytes(payload), ts))
+        stream.pending_bytes += len(payload)
+        self.total_bytes += len(payload)
+        if stream.pending_bytes > self.max_stream_bytes or \
+                (stream.anchored and len(leading_bytes(sorted(
+                    stream.held, key=lambda segment: seq_offset(
+                        segment[0], stream.next_seq)),
+                    stream.next_seq)) >= CLAIM_BYTES):
+            self.decide(stream)
+        else:
+            self.check_memory()
+
+    def decide(self, stream):
+        '''Chooses the consumer of a held stream from its first segment
+        and replays the held segments in sequence order. Returns False
+        when no analyser wants the stream'''
+        self.undecided.pop(stream.flow, None)
+        held, stream.held = stream.held, None
+        self.total_bytes -= stream.pending_bytes
+        stream.pending_bytes = 0
+        base = stream.next_seq
+        if stream.anchored:
+            # Nothing comes before the SYN
+            held = [segment for segment in held
+                    if seq_offset(segment[0], base) >= 0]
+        if len(held) > 1:
+            held.sort(key=lambda segment: seq_offset(segment[0], base))
+        if held:
+            seq, payload, ts = held[0]
+            if len(payload) < CLAIM_BYTES:
+                payload = leading_bytes(held, seq)
+            src, sport, dst, dport = stream.flow
+            stream.consumer = self.claim(Packet(
+                ts, len(payload), src, dst, IP_PROTO_TCP, sport, dport,
+                payload, seq))
+        if stream.consumer is None:
+            if stream.flow in self.streams:
+                self.streams[stream.flow] = IGNORED
+            return False
+        stream.next_seq = held[0][0]
+        for seq, payload, ts in held:
+            self.add_segment(stream, seq, payload, ts)
+        return True
+
+    def add_segment(self, stream, seq, payload, ts):
+        '''Places a segment in sequence order and frames any messages'''
+        diff = (seq - stream.next_seq) & SEQ_MASK
+        if diff >= 0x80000000:
+            # Retransmission or overlap, keep only the new bytes
+            diff -= 0x100000000
+            if len(payload) <= -diff:
+                return
+            payload = payload[-diff:]
+            diff = 0
+        if diff:
+            if seq in stream.pending:
+                return
+            if stream.size() + len(payload) <= self.max_stream_bytes:
+                stream.pending[seq] = bytes(payload)
+                stream.pending_bytes += len(payload)
+                self.total_bytes += len(payload)
+                self.check_memory()
+            else:
+                # The gap is not being filled, drop what is held and
+                # carry on after this segment
+                self.dropped_bytes += stream.size() + len(payload)
+                self.total_bytes -= stream.size()
+                stream.buffer.clear()
+                stream.pending.clear()
+                stream.pending_bytes = 0
+                stream.skip = 0
+                stream.next_seq = (seq + len(payload)) & SEQ_MASK
+            return
+        before = stream.size()
+        self.append(stream, payload)
+        stream.next_seq = (stream.next_seq + len(payload)) & SEQ_MASK
+        while stream.next_seq in stream.pending:
+            data = stream.pending.pop(stream.next_seq)
+            stream.pending_bytes -= len(data)
+            self.append(stream, data)
+            stream.next_seq = (stream.next_seq + len(data)) & SEQ_MASK
+        self.deliver(stream, ts)
+        if stream.size() > self.max_stream_bytes:
+            # No complete message fits, start again from the next segment
+            self.dropped_bytes += len(stream.buffer)
+            stream.buffer.clear()
+        self.total_bytes += stream.size() - before
+        self.check_memory()
+
+    @staticmethod
+    def append(stream, data):
+        '''Adds in order bytes to the buffer, less any being skipped'''
+        if stream.skip:
+            skipped = min(stream.skip, len(data))
+            stream.skip -= skipped
+            data = data[skipped:]
+        stream.buffer += data
+
+    def deliver(self, stream, ts, final=False):
+        '''Passes complete messages in the buffer to the consumer'''
+        messages, used = stream.consumer.split_messages(stream.buffer, final)
+        if used > len(stream.buffer):
+            stream.skip = used - len(stream.buffer)
+            used = len(stream.buffer)
+        if used:
+            del stream.buffer[:used]
+        for message in messages:
+            stream.consumer.add_message(stream.flow, ts, message)
+
+    def close_stream(self, flow):
+        '''Delivers what is left of a stream and forgets it'''
+        stream = self.streams.pop(flow, IGNORED)
+        if stream is IGNORED or \
+                (stream.held is not None and not self.decide(stream)):
+            return
+        self.total_bytes -= stream.size()
+        self.deliver(stream, stream.last_ts, final=True)
+
+    def check_memory(self):
+        '''Evicts the oldest streams while over the memory cap'''
+        while self.total_bytes > self.max_bytes and self.streams:
+            self.close_stream(next(iter(self.streams)))
+
+    def sweep(self, ts):
+        '''Evicts streams that have been idle for too long'''
+        self.last_sweep = ts
+        while self.undecided:
+            stream = next(iter(self.undecided.values()))
+            if ts - stream.held[0][2] < self.reorder_window:
+                break
+            self.decide(stream)
+        while self.isns:
+            flow, (seq, syn_ts) = next(iter(self.isns.items()))
+            if ts - syn_ts < self.idle_timeout:
+                break
+            del self.isns[flow]
+        while self.streams:
+            flow, stream = next(iter(self.streams.items()))
+            if stream is not IGNORED and \
+                    ts - stream.last_ts < self.idle_timeout:
+                break
+            self.close_stream(flow)
+
+    def flush(self):
+        '''Delivers the remaining data of every stream'''
+        while self.streams:
+            self.close_stream(next(iter(self.streams)))
+
+
+# Boiler Plate
+if __name__ == '__main__':
+    print("[!]Nothing to run here.")
@@ -0,0 +1,9 @@
+# Script:   conftest.py
+# Desc:     Puts the repository modules on the path for the tests
+# Author:   Jacob Connell Nov 2019
+# Note: Run setup.py before use!
+
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
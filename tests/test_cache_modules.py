@@ -0,0 +1,58 @@
+# Script:   test_cache_modules.py
+# Desc:     Tests of the analysis cache when several processes store the
+#           same entry at once
+# Author:   Jacob Connell Nov 2019
+# Note: Run setup.py before use!
+
+import os
+from concurrent.futures import ProcessPoolExecutor
+from cache_modules import AnalysisCache
+from parse_modules import Node_Graph, Packet_Summary, ImageTable
+
+KEY = 'capture'
+
+
+def store(directory, counter):
+    '''Stores a summary counting counter packets in its own process'''
+    summary = Packet_Summary()
+    summary.counter = counter
+    for i in range(20):
+        AnalysisCache(directory).store(KEY, __file__, {'summary': summary},
+                                       error_count=counter)
+    return counter
+
+
+def test_concurrent_store(tmp_path):
+    directory = str(tmp_path)
+    with ProcessPoolExecutor(max_workers=4) as pool:
+        counters = set(pool.map(store, [directory] * 8, range(8)))
+    found, columns, error_count = AnalysisCache(directory).load(
+        KEY, {'summary': Packet_Summary})
+    assert found['summary'].counter in counters
+    assert not [name for name in os.listdir(os.path.join(directory, KEY))
+                if name.endswith('.tmp')]
+
+
+def test_report_options_not_keyed(tmp_path):
+    cache = AnalysisCache(str(tmp_path))
+    graph = Node_Graph(top_edges=10)
+    graph.network_map = {'a': {'b': 1}}
+    cache.store(KEY, __file__, {'graph': graph},
+                options={'graph': {'top_edges': 10}})
+    options = {'graph': {'top_edges': 5, 'export': ['gexf']}}
+    found, columns, error_count = cache.load(KEY, {'graph': Node_Graph},
+                                             options)
+    assert found['graph'].network_map == {'a': {'b': 1}}
+    assert found['graph'].top_edges == 5
+    assert found['graph'].export == ('gexf',)
+    assert not cache.has(KEY, {'graph': Node_Graph},
+                         {'graph': {'top_k': 100}})
+
+
+def test_stream_options_keyed(tmp_path):
+    cache = AnalysisCache(str(tmp_path))
+    options = {'streams': {'max_bytes': 1 << 20}}
+    cache.store(KEY, __file__, {'images': ImageTable()}, options=options)
+    assert cache.has(KEY, {'images': ImageTable}, options)
+    assert not cache.has(KEY, {'images': ImageTable},
+                         {'streams': {'max_bytes': 1 << 10}})
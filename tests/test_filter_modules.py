@@ -0,0 +1,95 @@
+# Script:   test_filter_modules.py
+# Desc:     Tests of the BPF style packet filters and time bounds
+# Author:   Jacob Connell Nov 2019
+# Note: Run setup.py before use!
+
+import socket
+import struct
+import pytest
+from filter_modules import PacketFilter, parse_time
+
+
+def frame(src, dst, p=6, sport=40000, dport=80, fragment=0):
+    '''Returns an Ethernet frame of an IPv4 or IPv6 packet with a TCP
+    or UDP header when p is 6 or 17'''
+    l4 = struct.pack('!HH', sport, dport) + b'\x00' * 16 if p in (6, 17) \
+        else b'\x00' * 8
+    if ':' in src:
+        ip = struct.pack('!IHBB16s16s', 6 << 28, len(l4), p, 64,
+                         socket.inet_pton(socket.AF_INET6, src),
+                         socket.inet_pton(socket.AF_INET6, dst))
+        return b'\x02' * 12 + b'\x86\xdd' + ip + l4
+    ip = struct.pack('!BBHHHBBH4s4s', 0x45, 0, 20 + len(l4), 0, fragment,
+                     64, p, 0, socket.inet_aton(src), socket.inet_aton(dst))
+    return b'\x02' * 12 + b'\x08\x00' + ip + l4
+
+
+HTTP = frame('10.0.0.1', '93.184.216.34')
+HTTPS = frame('10.0.0.1', '93.184.216.34', dport=443)
+DNS = frame('192.168.1.5', '8.8.8.8', p=17, sport=5353, dport=53)
+ICMP = frame('10.0.0.1', '10.0.1.1', p=1)
+IP6 = frame('2001:db8::1', 'fe80::2', dport=8080)
+FRAGMENT = frame('10.0.0.1', '93.184.216.34', fragment=100)
+FRAMES = {'http': HTTP, 'https': HTTPS, 'dns': DNS, 'icmp': ICMP,
+          'ip6': IP6, 'fragment': FRAGMENT}
+
+
+def matching(expression):
+    '''Returns the names of the frames the expression matches'''
+    packet_filter = PacketFilter(expression)
+    return sorted(name for name, buf in FRAMES.items()
+                  if packet_filter.match((0.0, buf)))
+
+
+@pytest.mark.parametrize('expression, names', [
+    ('tcp', ['fragment', 'http', 'https', 'ip6']),
+    ('udp port 53', ['dns']),
+    ('port 80 or 443', ['http', 'https']),
+    ('tcp dst port 80', ['http']),
+    ('src port 40000 and not port 443', ['http', 'ip6']),
+    ('portrange 8000-8100', ['ip6']),
+    ('host 8.8.8.8', ['dns']),
+    ('src net 10.0.0.0/8', ['fragment', 'http', 'https', 'icmp']),
+    ('net 10.0.1', ['icmp']),
+    ('dst net 93.184.216.0 mask 255.255.255.0', ['fragment', 'http',
+                                                 'https']),
+    ('net 2001:db8::/32', ['ip6']),
+    ('ip6', ['ip6']),
+    ('icmp', ['icmp']),
+    ('ip proto 17', ['dns']),
+    ('!(tcp || udp)', ['icmp']),
+])
+def test_expressions(expression, names):
+    assert matching(expression) == names
+
+
+@pytest.mark.parametrize('expression', [
+    'port', 'host 10.0.0', 'net 10.0.0.0/40', 'tcp host 10.0.0.1',
+    'port 99999', '(tcp', 'tcp )', 'bogus', 'port 80 $'])
+def test_bad_expressions(expression):
+    with pytest.raises(ValueError):
+        PacketFilter(expression)
+
+
+def test_time_bounds():
+    packet_filter = PacketFilter('tcp', 10.0, 20.0)
+    assert [ts for ts in (5.0, 10.0, 15.0, 20.0)
+            if packet_filter.match((ts, HTTP))] == [10.0, 15.0]
+
+
+def test_time_bounds_any_float():
+    # Bounds that have no literal form in Python source
+    assert PacketFilter('', float('-inf'), float('inf')).match((1.0, HTTP))
+    assert not PacketFilter('', float('nan')).match((1.0, HTTP))
+
+
+@pytest.mark.parametrize('text', ['inf', '-inf', 'nan', '1e400', 'soon'])
+def test_parse_time_rejects(text):
+    with pytest.raises(ValueError):
+        parse_time(text)
+
+
+def test_parse_time():
+    assert parse_time('1573000000.5') == 1573000000.5
+    assert parse_time('2019-11-06T00:26:40') == 1573000000.0
+    assert parse_time('2019-11-06T01:26:40+01:00') == 1573000000.0
@@ -0,0 +1,136 @@
+# Script:   test_flow_modules.py
+# Desc:     Tests of flow expiry and of merging the flow tables of shards
+# Author:   Jacob Connell Nov 2019
+# Note: Run setup.py before use!
+
+import socket
+from flow_modules import FlowTable
+from packet_modules import IP_PROTO_TCP, IP_PROTO_UDP, TH_FIN, TH_RST, \
+    TH_SYN, Packet
+
+CLIENT = socket.inet_aton('10.0.0.1')
+SERVER = socket.inet_aton('93.184.0.1')
+
+
+def packet(ts, sport=40000, reply=False, flags=0, p=IP_PROTO_TCP):
+    '''Returns a 100 byte packet of the client to server flow from
+    sport, or server to client with reply set'''
+    if reply:
+        return Packet(ts, 100, SERVER, CLIENT, p, 80, sport, flags=flags)
+    return Packet(ts, 100, CLIENT, SERVER, p, sport, 80, flags=flags)
+
+
+def run(packets, **options):
+    '''Feeds packets to a new FlowTable and ends the open flows'''
+    table = FlowTable(**options)
+    for pkt in packets:
+        table.add_packet(pkt)
+    table.flush()
+    return table
+
+
+def sharded(packets, cuts, **options):
+    '''Feeds each part of packets split at cuts to its own FlowTable
+    and merges them in order'''
+    bounds = [0] + list(cuts) + [len(packets)]
+    tables = []
+    for start, end in zip(bounds, bounds[1:]):
+        table = FlowTable(**options)
+        for pkt in packets[start:end]:
+            table.add_packet(pkt)
+        tables.append(table)
+    for table in tables[1:]:
+        tables[0].merge(table)
+    tables[0].flush()
+    return tables[0]
+
+
+def summary(table):
+    '''Returns (packets_fwd, packets_rev, end) of every record'''
+    return [(record[7], record[8], record[12]) for record in table.records]
+
+
+def test_closed_by_fin_from_both_sides():
+    table = run([packet(1.0, flags=TH_SYN), packet(1.1, reply=True),
+                 packet(1.2, flags=TH_FIN), packet(1.3, reply=True,
+                                                   flags=TH_FIN),
+                 packet(1.4)])
+    assert summary(table) == [(2, 2, 'closed'), (1, 0, 'end')]
+
+
+def test_reset():
+    table = run([packet(1.0), packet(1.1, reply=True, flags=TH_RST)])
+    assert summary(table) == [(1, 1, 'closed')]
+
+
+def test_idle_timeout():
+    table = run([packet(1.0), packet(2.0, reply=True),
+                 packet(70.0, sport=40001), packet(71.0)],
+                idle_timeout=60)
+    assert summary(table) == [(1, 1, 'idle'), (1, 0, 'end'), (1, 0, 'end')]
+
+
+def test_active_timeout():
+    packets = [packet(float(ts), p=IP_PROTO_UDP) for ts in range(0, 25, 5)]
+    table = run(packets, idle_timeout=60, active_timeout=12)
+    assert summary(table) == [(3, 0, 'active'), (2, 0, 'end')]
+
+
+def test_embryonic_evicted_first():
+    packets = [packet(1.0), packet(1.1, reply=True),
+               packet(1.2, sport=40001), packet(1.3, sport=40002)]
+    table = run(packets, max_flows=2)
+    assert table.evicted == 1
+    assert [record[1] for record in table.records] == [40001, 40002, 40000]
+
+
+def test_records_capped():
+    packets = [packet(1.0, sport=port, flags=TH_RST)
+               for port in range(40000, 40010)]
+    table = run(packets, max_records=4)
+    assert len(table.records) == 4
+    assert table.dropped == 6
+
+
+def test_merge_joins_flow_across_shards():
+    packets = [packet(1.0, flags=TH_SYN), packet(1.1, reply=True),
+               packet(2.0), packet(2.1, reply=True, flags=TH_FIN),
+               packet(3.0, flags=TH_FIN)]
+    single = run(packets)
+    for cut in range(1, len(packets)):
+        table = sharded(packets, [cut])
+        assert table.records == single.records
+        assert summary(table) == [(3, 2, 'closed')]
+
+
+def test_merge_keeps_direction_of_first_shard():
+    packets = [packet(1.0), packet(2.0, reply=True), packet(3.0, reply=True)]
+    table = sharded(packets, [1])
+    assert table.records == run(packets).records
+    assert summary(table) == [(1, 2, 'end')]
+
+
+def test_merge_joins_open_flow_over_three_shards():
+    packets = [packet(float(ts), reply=ts % 2) for ts in range(1, 10)]
+    table = sharded(packets, [3, 6])
+    assert table.records == run(packets).records
+    assert summary(table) == [(5, 4, 'end')]
+
+
+def test_merge_splits_idle_flow():
+    packets = [packet(1.0), packet(1.1, reply=True),
+               packet(30.0, sport=40001), packet(75.0, sport=40001),
+               packet(80.0)]
+    single = run(packets, idle_timeout=60)
+    table = sharded(packets, [2], idle_timeout=60)
+    assert sorted(table.records) == sorted(single.records)
+    assert sorted(summary(table)) == [(1, 0, 'end'), (1, 1, 'idle'),
+                                      (2, 0, 'end')]
+
+
+def test_merge_caps_records():
+    packets = [packet(1.0, sport=port, flags=TH_RST)
+               for port in range(40000, 40010)]
+    table = sharded(packets, [5], max_records=4)
+    assert len(table.records) == 4
+    assert table.dropped == 6
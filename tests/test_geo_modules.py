@@ -0,0 +1,76 @@
+# Script:   test_geo_modules.py
+# Desc:     Tests of the batched GeoIP lookups of the map
+# Author:   Jacob Connell Nov 2019
+# Note: Run setup.py before use!
+
+import socket
+from collections import OrderedDict
+from types import SimpleNamespace
+from geo_modules import GeoLookup
+from parse_modules import KML_File
+
+
+class NotFound(Exception):
+    pass
+
+
+class CityReader:
+    '''Stands in for a geoip2 Reader, knowing the addresses in places
+    and counting the reads'''
+    def __init__(self, places):
+        self.places = places
+        self.reads = []
+
+    def city(self, address):
+        self.reads.append(address)
+        if address not in self.places:
+            raise NotFound(address)
+        longitude, latitude = self.places[address]
+        return SimpleNamespace(country=SimpleNamespace(name='Testland'),
+                               city=SimpleNamespace(name=None),
+                               location=SimpleNamespace(longitude=longitude,
+                                                        latitude=latitude))
+
+
+def geo_lookup(places):
+    '''Returns a GeoLookup reading from a CityReader without a cache
+    file'''
+    lookup = GeoLookup.__new__(GeoLookup)
+    lookup.reader = CityReader(places)
+    lookup.not_found = NotFound
+    lookup.cache_path = None
+    lookup.max_entries = 100
+    lookup.cache = OrderedDict()
+    return lookup
+
+
+PLACES = {'8.8.8.8': (-122.0, 37.4), '1.1.1.1': (145.0, -37.8),
+          '2001:4860::8888': (-97.8, 37.8)}
+
+
+def test_lookup_many():
+    lookup = geo_lookup(PLACES)
+    addresses = ['8.8.8.8', '2001:4860::8888', '9.9.9.9', '1.1.1.1',
+                 '8.8.8.8', '10.0.0.1']
+    locations = lookup.lookup_many(addresses)
+    # Each public address is read once, in address order
+    assert lookup.reader.reads == ['1.1.1.1', '8.8.8.8', '9.9.9.9',
+                                   '2001:4860::8888']
+    assert locations['8.8.8.8'] == {'country': 'Testland', 'city': '',
+                                    'longitude': -122.0, 'latitude': 37.4}
+    assert locations['9.9.9.9'] is None
+    assert locations['10.0.0.1'] is None
+    assert lookup.lookup_many(addresses) == locations
+    assert len(lookup.reader.reads) == 4
+
+
+def test_located():
+    lookup = geo_lookup(PLACES)
+    kml = KML_File()
+    kml.skipped = kml.error_count = 0
+    for address in ('8.8.8.8', '192.168.0.1', '9.9.9.9', '1.1.1.1'):
+        kml.distinct_ips[socket.inet_aton(address)] = [2, 120]
+    assert [point[0] for point in kml.located(lookup)] == ['8.8.8.8',
+                                                          '1.1.1.1']
+    assert kml.skipped == 1
+    assert kml.error_count == 1
@@ -0,0 +1,135 @@
+# Script:   test_parse_modules.py
+# Desc:     Tests of the HTTP image classification of ImageTable
+# Author:   Jacob Connell Nov 2019
+# Note: Run setup.py before use!
+
+import socket
+import pytest
+from packet_modules import IP_PROTO_TCP, Packet
+from parse_modules import ImageTable
+from stream_modules import StreamReassembler
+
+CLIENT = socket.inet_aton('10.0.0.1')
+SERVER = socket.inet_aton('93.184.0.1')
+# (src, sport, dst, dport) of the request direction
+FLOW = (CLIENT, 40000, SERVER, 80)
+REPLY = (SERVER, 80, CLIENT, 40000)
+
+
+def request(path, method=b'GET', host=b'www.example.com'):
+    '''Returns the header block of an HTTP request'''
+    return (method + b' ' + path + b' HTTP/1.1\r\nHost: ' + host +
+            b'\r\nAccept: */*\r\n\r\n')
+
+
+def response(status=b'200 OK', content_type=b'text/html', length=0):
+    '''Returns the header block of an HTTP response'''
+    return (b'HTTP/1.1 ' + status + b'\r\nContent-Type: ' + content_type +
+            b'\r\nContent-Length: ' + str(length).encode() + b'\r\n\r\n')
+
+
+def classify(*messages):
+    '''Feeds (reply, message) pairs to an ImageTable'''
+    images = ImageTable()
+    for reply, message in messages:
+        images.add_message(REPLY if reply else FLOW, 1.0, message)
+    return images
+
+
+@pytest.mark.parametrize('path, image_type, name', [
+    (b'/img/cat.gif', 'gif', 'cat.gif'),
+    (b'/img/CAT.JPEG', 'jpg', 'cat.jpeg'),
+    (b'/photo.jpg?size=large&fmt=.png', 'jpg', 'photo.jpg'),
+    (b'/icon.svg#top', 'svg', 'icon.svg'),
+    (b'/favicon.ico', 'ico', 'favicon.ico'),
+    (b'/a/b/banner.webp', 'webp', 'banner.webp'),
+    (b'/scan.bmp', 'bmp', 'scan.bmp'),
+    (b'/logo.png.gif', 'gif', 'logo.png.gif'),
+])
+def test_extension(path, image_type, name):
+    images = classify((False, request(path)))
+    assert images.image_rows == [[CLIENT, SERVER, image_type, name,
+                                  'http://www.example.com' +
+                                  path.decode().lower()]]
+    assert images.type_counts == {image_type: 1}
+
+
+@pytest.mark.parametrize('path', [
+    b'/index.html', b'/img.png/page', b'/page?file=cat.gif', b'/gif',
+    b'/cat.gifv'])
+def test_not_image_extension(path):
+    assert classify((False, request(path))).type_counts == {}
+
+
+def test_not_get_or_no_host():
+    images = classify((False, request(b'/cat.gif', method=b'POST')),
+                      (False, b'GET /cat.gif HTTP/1.0\r\n\r\n'))
+    assert images.type_counts == {}
+
+
+def test_content_type():
+    images = classify((False, request(b'/avatar?id=7')),
+                      (True, response(content_type=b'image/jpeg')))
+    assert images.image_rows == [[CLIENT, SERVER, 'jpg', 'avatar',
+                                  'http://www.example.com/avatar?id=7']]
+
+
+def test_content_type_not_counted_twice():
+    images = classify((False, request(b'/cat.png')),
+                      (True, response(content_type=b'image/png')))
+    assert images.type_counts == {'png': 1}
+
+
+def test_content_type_unknown_subtype():
+    images = classify((False, request(b'/pic')),
+                      (True, response(content_type=b'image/avif')))
+    assert images.type_counts == {'avif': 1}
+
+
+def test_content_type_needs_success():
+    images = classify((False, request(b'/missing')),
+                      (True, response(b'404 Not Found', b'image/png')))
+    assert images.type_counts == {}
+
+
+def test_interim_response_skipped():
+    images = classify((False, request(b'/pic')),
+                      (True, b'HTTP/1.1 100 Continue\r\n\r\n'),
+                      (True, response(content_type=b'image/gif')))
+    assert images.type_counts == {'gif': 1}
+
+
+def test_pipelined_responses_in_order():
+    images = classify((False, request(b'/page')),
+                      (False, request(b'/pic')),
+                      (True, response()),
+                      (True, response(content_type=b'image/webp')))
+    assert [row[4] for row in images.image_rows] == \
+        ['http://www.example.com/pic']
+
+
+def test_image_body_skipped():
+    # A keep-alive connection where the image body is split over
+    # segments and never reaches the analyser
+    body = b'\x89PNG' + b'\x00' * 3000
+    client = [request(b'/first'), request(b'/second.gif')]
+    server = [response(content_type=b'image/png', length=len(body)) + body,
+              response(content_type=b'image/gif')]
+    reassembler = StreamReassembler()
+    images = ImageTable()
+    reassembler.subscribe(images)
+    seq = {True: 5000, False: 1000}
+    ts = 1.0
+    for reply, data in ((False, client[0]), (True, server[0]),
+                        (False, client[1]), (True, server[1])):
+        src, sport, dst, dport = REPLY if reply else FLOW
+        for start in range(0, len(data), 1000):
+            payload = data[start:start + 1000]
+            reassembler.add_packet(Packet(
+                ts, 60 + len(payload), src, dst, IP_PROTO_TCP, sport, dport,
+                payload, seq[reply], 0))
+            seq[reply] += len(payload)
+            ts += 0.01
+    reassembler.flush()
+    assert images.URIs == ['www.example.com/first', 'www.example.com/second.gif']
+    assert images.type_counts == {'png': 1, 'gif': 1}
@@ -0,0 +1,125 @@
+# Script:   test_reader_modules.py
+# Desc:     Tests of reading pcapng files with several sections or
+#           interfaces of different link types
+# Author:   Jacob Connell Nov 2019
+# Note: Run setup.py before use!
+
+import socket
+import struct
+from filter_modules import PacketFilter
+from packet_modules import LINKTYPE_ETHERNET, LINKTYPE_RAW
+from reader_modules import open_capture
+from shard_modules import analyse_capture
+
+
+def block(block_type, body):
+    '''Returns a little endian pcapng block'''
+    body += b'\x00' * (-len(body) % 4)
+    length = len(body) + 12
+    return struct.pack('<II', block_type, length) + body + \
+        struct.pack('<I', length)
+
+
+def ip_packet(src, dst):
+    '''Returns an IPv4/UDP packet from src to dst'''
+    udp = struct.pack('!HHHH', 5000, 53, 12, 0) + b'test'
+    return struct.pack('!BBHHHBBH4s4s', 0x45, 0, 20 + len(udp), 0, 0, 64,
+                       17, 0, socket.inet_aton(src),
+                       socket.inet_aton(dst)) + udp
+
+
+def write_mixed(path):
+    '''Writes an Ethernet interface and a raw IP interface with two
+    packets each, alternating between them'''
+    data = block(0x0A0D0D0A, struct.pack('<IHHq', 0x1A2B3C4D, 1, 0, -1))
+    data += block(1, struct.pack('<HHI', LINKTYPE_ETHERNET, 0, 65535))
+    data += block(1, struct.pack('<HHI', LINKTYPE_RAW, 0, 65535))
+    for i in range(4):
+        packet = ip_packet(f'10.0.0.{i + 1}', '10.0.1.1')
+        if i % 2 == 0:
+            packet = b'\x02' * 12 + b'\x08\x00' + packet
+        data += block(6, struct.pack('<IIIII', i % 2, 0, i * 1000000,
+                                     len(packet), len(packet)) + packet)
+    with open(path, 'wb') as f:
+        f.write(data)
+
+
+def test_records_carry_linktype(tmp_path):
+    path = str(tmp_path / 'mixed.pcapng')
+    write_mixed(path)
+    with open_capture(path) as capture:
+        assert [linktype for ts, buf, linktype in
+                capture.records(linktypes=True)] == \
+            [LINKTYPE_ETHERNET, LINKTYPE_RAW] * 2
+
+
+def test_mixed_linktypes_decoded(tmp_path):
+    path = str(tmp_path / 'mixed.pcapng')
+    write_mixed(path)
+    analysers, error_count, columns, metrics = analyse_capture(
+        path, ['summary'])
+    assert error_count == 0
+    assert metrics.packets == 4
+
+
+def test_filter_per_linktype(tmp_path):
+    path = str(tmp_path / 'mixed.pcapng')
+    write_mixed(path)
+    for host in ('10.0.0.1', '10.0.0.2'):
+        analysers, error_count, columns, metrics = analyse_capture(
+            path, ['summary'], packet_filter=PacketFilter(f'src host {host}'))
+        assert error_count == 0
+        assert metrics.packets == 1
+
+
+def write_sections(path, packets=40):
+    '''Writes two sections of packets, the first with nanosecond
+    timestamps and the second with the default microseconds'''
+    data = b''
+    for section, tsresol in enumerate((9, None)):
+        data += block(0x0A0D0D0A, struct.pack('<IHHq', 0x1A2B3C4D, 1, 0, -1))
+        options = b'' if tsresol is None else \
+            struct.pack('<HHB3xHH', 9, 1, tsresol, 0, 0)
+        data += block(1, struct.pack('<HHI', LINKTYPE_ETHERNET, 0, 65535) +
+                      options)
+        for i in range(packets):
+            second = section * packets + i
+            ts = second * (10 ** (tsresol or 6))
+            packet = b'\x02' * 12 + b'\x08\x00' + \
+                ip_packet(f'10.0.{section}.{i + 1}', '10.0.1.1')
+            data += block(6, struct.pack('<IIIII', 0, ts >> 32,
+                                         ts & 0xffffffff, len(packet),
+                                         len(packet)) + packet)
+    with open(path, 'wb') as f:
+        f.write(data)
+
+
+def test_sections_sharded(tmp_path):
+    path = str(tmp_path / 'sections.pcapng')
+    write_sections(path)
+    with open_capture(path) as capture:
+        whole = [(ts, bytes(buf)) for ts, buf in capture.records()]
+        shards = capture.split(4)
+        sharded = [(ts, bytes(buf)) for start, end in shards
+                   for ts, buf in capture.records(start, end)]
+        again = [ts for ts, buf in capture.records()]
+    assert len(shards) == 4
+    assert [ts for ts, buf in whole] == [float(i) for i in range(80)]
+    assert sharded == whole
+    assert again == [ts for ts, buf in whole]
+
+
+def test_caplen_capped_at_block(tmp_path):
+    path = str(tmp_path / 'caplen.pcapng')
+    packet = b'\x02' * 12 + b'\x08\x00' + ip_packet('10.0.0.1', '10.0.1.1')
+    data = block(0x0A0D0D0A, struct.pack('<IHHq', 0x1A2B3C4D, 1, 0, -1))
+    data += block(1, struct.pack('<HHI', LINKTYPE_ETHERNET, 0, 65535))
+    data += block(6, struct.pack('<IIIII', 0, 0, 0, 1000, 1000) + packet)
+    data += block(6, struct.pack('<IIIII', 0, 0, 1, len(packet),
+                                 len(packet)) + packet)
+    with open(path, 'wb') as f:
+        f.write(data)
+    with open_capture(path) as capture:
+        # The first packet only gets its block's padding, not the next block
+        assert [bytes(buf) for ts, buf in capture.records()] == \
+            [packet + b'\x00' * (-len(packet) % 4), packet]
@@ -0,0 +1,19 @@
+# Script:   test_report_modules.py
+# Desc:     Tests of which report errors make a run fail
+# Author:   Jacob Connell Nov 2019
+# Note: Run setup.py before use!
+
+from parse_modules import KML_File, Packet_Summary
+from report_modules import render_reports
+
+
+def test_missing_geo_db_skipped(tmp_path, capsys):
+    analysers = {'map': KML_File(geo_db=str(tmp_path / 'missing.mmdb'))}
+    assert render_reports(analysers, ['map'], str(tmp_path)) == 0
+    assert 'GeoIPs skipped' in capsys.readouterr().out
+
+
+def test_write_error_fails(tmp_path):
+    # The report directory does not exist, so nothing can be written
+    assert render_reports({'summary': Packet_Summary()}, ['summary'],
+                          str(tmp_path / 'missing')) == 1
@@ -0,0 +1,70 @@
+# Script:   test_shard_modules.py
+# Desc:     Tests that sharded runs give the same results as one process
+# Author:   Jacob Connell Nov 2019
+# Note: Run setup.py before use!
+
+import struct
+import pytest
+from parse_modules import ANALYSERS
+from reader_modules import open_capture
+from shard_modules import analyse
+
+WORKERS = (2, 3, 5, 8)
+
+
+@pytest.fixture(scope='module')
+def capture(tmp_path_factory):
+    '''A synthetic capture with out of order packets and streams'''
+    pytest.importorskip('dpkt')
+    from benchmark import CaptureGenerator
+    path = str(tmp_path_factory.mktemp('shards') / 'synthetic.pcap')
+    CaptureGenerator(seed=1).write(path, 4000)
+    return path
+
+
+def results(path, workers):
+    '''Returns the export tables of every analyser. Flow records are
+    listed in the order the flows ended, which differs between shards'''
+    analysers = analyse(path, list(ANALYSERS), workers)[0]
+    tables = {}
+    for name, analyser in analysers.items():
+        for table, schema, rows in analyser.tables():
+            rows = list(rows)
+            tables[name, table] = sorted(rows) if name == 'flows' else rows
+    return tables
+
+
+def record_offsets(path):
+    with open_capture(path) as capture:
+        return {offset for offset, ts, linktype, buf in capture.packets()}
+
+
+@pytest.mark.parametrize('workers', WORKERS)
+def test_split_on_records(capture, workers):
+    offsets = record_offsets(capture)
+    with open_capture(capture) as reader:
+        for start, end in reader.split(workers):
+            assert start in offsets
+
+
+def test_split_rejects_chain_inside_records(tmp_path):
+    # Whole second timestamps and equal lengths give a plausible chain
+    # 4 bytes into every record header
+    path = tmp_path / 'regular.pcap'
+    with open(path, 'wb') as f:
+        f.write(struct.pack('<IHHiIII', 0xa1b2c3d4, 2, 4, 0, 0, 65535, 1))
+        for i in range(400):
+            frame = b'\x00' * (38 + i * 7 % 90)
+            f.write(struct.pack('<IIII', 1000 + i, 0, len(frame), len(frame)))
+            f.write(frame)
+    offsets = record_offsets(str(path))
+    with open_capture(str(path)) as reader:
+        for shards in range(2, 20):
+            for start, end in reader.split(shards):
+                assert start in offsets
+
+
+def test_sharded_matches_single_process(capture):
+    single = results(capture, 1)
+    for workers in WORKERS:
+        assert results(capture, workers) == single
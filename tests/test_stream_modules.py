@@ -0,0 +1,138 @@
+# Script:   test_stream_modules.py
+# Desc:     Tests of TCP stream reassembly with segments out of order
+# Author:   Jacob Connell Nov 2019
+# Note: Run setup.py before use!
+
+import socket
+from packet_modules import IP_PROTO_TCP, TH_SYN, Packet
+from parse_modules import FindEmails, ImageTable
+from stream_modules import StreamReassembler
+
+CLIENT = socket.inet_aton('10.0.0.1')
+SERVER = socket.inet_aton('93.184.0.1')
+REQUEST = (b'GET /img/cat.gif?v=1 HTTP/1.1\r\nHost: www.example.com\r\n'
+           b'User-Agent: test\r\n\r\n')
+RESPONSE = b'HTTP/1.1 200 OK\r\nContent-Length: 0\r\n\r\n'
+SMTP = [b'HELO test\r\n', b'MAIL FROM: <alice@example.com>\r\n',
+        b'RCPT TO: <bob@example.org>\r\n', b'QUIT\r\n']
+
+
+def segment(ts, payload, seq, dport=80, flags=0, reply=False):
+    '''Returns a client to server TCP segment, or server to client with
+    reply set'''
+    src, dst, sport = (SERVER, CLIENT, dport) if reply else \
+        (CLIENT, SERVER, 40000)
+    return Packet(ts, 60 + len(payload), src, dst, IP_PROTO_TCP, sport,
+                  40000 if reply else dport, payload, seq, flags)
+
+
+def split_request(cut=10, seq=1000):
+    '''Returns the request as two segments'''
+    return [segment(1.0, REQUEST[:cut], seq),
+            segment(1.1, REQUEST[cut:], (seq + cut) & 0xffffffff)]
+
+
+def run(packets, analyser):
+    '''Feeds packets to a reassembler subscribed by analyser'''
+    reassembler = StreamReassembler()
+    reassembler.subscribe(analyser)
+    for pkt in packets:
+        reassembler.add_packet(pkt)
+    reassembler.flush()
+    return analyser
+
+
+def image_uris(packets):
+    return run(packets, ImageTable()).URIs
+
+
+def emails(packets, dport=25):
+    return sorted(run(packets, FindEmails()).my_emails)
+
+
+def test_http_in_order():
+    assert image_uris(split_request()) == ['www.example.com/img/cat.gif?v=1']
+
+
+def test_http_swapped_after_syn():
+    first, second = split_request()
+    packets = [segment(0.9, b'', 999, flags=TH_SYN), second, first]
+    assert image_uris(packets) == ['www.example.com/img/cat.gif?v=1']
+
+
+def test_http_swapped_without_syn_then_response():
+    first, second = split_request()
+    packets = [second, first, segment(1.2, RESPONSE, 5000, reply=True)]
+    assert image_uris(packets) == ['www.example.com/img/cat.gif?v=1']
+
+
+def test_http_swapped_without_syn_at_end_of_capture():
+    first, second = split_request()
+    assert image_uris([second, first]) == ['www.example.com/img/cat.gif?v=1']
+
+
+def test_http_swapped_without_syn_across_reorder_window():
+    first, second = split_request()
+    later = [segment(3.0, REQUEST, 1000 + len(REQUEST))]
+    assert image_uris([second, first] + later) == \
+        ['www.example.com/img/cat.gif?v=1'] * 2
+
+
+def test_later_requests_on_a_swapped_stream_are_kept():
+    first, second = split_request()
+    more = [segment(1.2 + i, REQUEST, 1000 + len(REQUEST) * (i + 1))
+            for i in range(3)]
+    assert len(image_uris([second, first] + more)) == 4
+
+
+def test_http_tiny_first_segment():
+    assert image_uris(split_request(cut=2)) == \
+        ['www.example.com/img/cat.gif?v=1']
+
+
+def test_http_tiny_first_segment_after_syn():
+    packets = [segment(0.9, b'', 999, flags=TH_SYN)] + split_request(cut=2)
+    assert image_uris(packets) == ['www.example.com/img/cat.gif?v=1']
+
+
+def test_sequence_wrap():
+    first, second = split_request(seq=0xffffffff - 4)
+    assert second.seq < first.seq
+    assert image_uris([second, first]) == ['www.example.com/img/cat.gif?v=1']
+
+
+def test_retransmission_after_start():
+    first, second = split_request()
+    assert image_uris([first, second, first, second]) == \
+        ['www.example.com/img/cat.gif?v=1']
+
+
+def test_smtp_swapped_first_segments():
+    seq, packets = 2000, []
+    for i, command in enumerate(SMTP):
+        packets.append(segment(1.0 + i / 10, command, seq, dport=25))
+        seq += len(command)
+    packets[0], packets[1] = packets[1], packets[0]
+    assert emails(packets) == ['From:alice@example.com', 'To:bob@example.org']
+
+
+def test_smtp_swapped_after_syn():
+    seq, packets = 2001, [segment(0.5, b'', 2000, dport=25, flags=TH_SYN)]
+    for i, command in enumerate(SMTP):
+        packets.append(segment(1.0 + i / 10, command, seq, dport=25))
+        seq += len(command)
+    packets[1], packets[2] = packets[2], packets[1]
+    assert emails(packets) == ['From:alice@example.com', 'To:bob@example.org']
+
+
+def test_unwanted_stream_is_ignored():
+    packets = [segment(1.0, b'\x16\x03\x01 not http', 1000, dport=443),
+               segment(1.1, b'more', 1014, dport=443),
+               segment(1.2, b'\x16\x03\x03 reply', 5000, dport=443,
+                       reply=True)]
+    reassembler = StreamReassembler()
+    reassembler.subscribe(ImageTable())
+    for pkt in packets:
+        reassembler.add_packet(pkt)
+    assert reassembler.streams[(CLIENT, 40000, SERVER, 443)] is None
+    assert reassembler.total_bytes == len(packets[2].payload)